@@ -201,6 +201,24 @@ class TestFileAgent(unittest.TestCase, test_helpers.TrimDictEqual):
     chk = dict(dfile=stat(mode=pysyncml.SYNCTYPE_REFRESH_FROM_SERVER, hereAdd=4))
     self.assertTrimDictEqual(stats, chk)
 
+  #----------------------------------------------------------------------------
+  def test_sync_refreshClient_multiMessage(self):
+    # the items are listed children-first and do not fit into a single
+    # message, so the parents must be sent first across all the pages
+    root = self.serverItems.add(FolderItem(name='main'))
+    for idx in range(4):
+      sub = self.serverItems.add(FolderItem(name='dir%d' % (idx,), parent=root.id))
+      for fidx in range(8):
+        self.serverItems.add(FileItem(name='file%d.txt' % (fidx,), body='x' * 4000, parent=sub.id))
+    getAll = self.serverItems.getAll
+    self.serverItems.getAll = lambda: list(reversed(getAll()))
+    stats = self.mobile.sync(mode=pysyncml.SYNCTYPE_REFRESH_FROM_SERVER)
+    self.assertEqual(
+      sorted([e.path for e in self.mobileItems.entries.values()]),
+      sorted([e.path for e in self.serverItems.entries.values()]))
+    chk = dict(mfile=stat(mode=pysyncml.SYNCTYPE_REFRESH_FROM_SERVER, hereAdd=37))
+    self.assertTrimDictEqual(stats, chk)
+
   # #----------------------------------------------------------------------------
   # def test_sync_addClient(self):
   #   # step 1: initial sync
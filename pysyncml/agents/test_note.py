@@ -19,12 +19,13 @@
 # along with this program. If not, see http://www.gnu.org/licenses/.
 #------------------------------------------------------------------------------
 
-import unittest, sys, os, logging, six
+import unittest, sys, os, shutil, tempfile, logging, six
+import xml.etree.ElementTree as ET
 import sqlalchemy
 import pysyncml
 from .note import BaseNoteAgent
 from ..items.note import NoteItem
-from .. import state, constants
+from .. import state, constants, protocol
 from ..common import adict, fullClassname
 from ..change import CompositeMergerFactory, TextMergerFactory
 from .. import test_helpers
@@ -126,6 +127,12 @@ class TestNoteAgent(unittest.TestCase, test_helpers.TrimDictEqual):
     if self.serverOptions is not None:
       if 'conflictPolicy' in self.serverOptions:
         self.server.conflictPolicy = self.serverOptions['conflictPolicy']
+      if 'codec' in self.serverOptions:
+        self.server.codec = pysyncml.Codec.factory(self.serverOptions['codec'])
+      if 'incremental' in self.serverOptions:
+        self.serverContext.incremental = self.serverOptions['incremental']
+      if 'spoolDir' in self.serverOptions:
+        self.serverContext.spoolDir = self.serverOptions['spoolDir']
     return self.server
 
   #----------------------------------------------------------------------------
@@ -286,6 +293,190 @@ class TestNoteAgent(unittest.TestCase, test_helpers.TrimDictEqual):
     chk = dict(dnote=stat(mode=pysyncml.SYNCTYPE_SLOW_SYNC))
     self.assertTrimDictEqual(stats, chk)
 
+  #----------------------------------------------------------------------------
+  def test_slowsync_multiMessage(self):
+    # both the server (8KB) and the mobile (40KB) have limits on message
+    # sizes, which should force both sides to split their sync commands
+    # into multiple messages.
+    self.server.maxMsgSize = 8192
+    self.refreshAdapters()
+    for idx in range(20):
+      self.mobileItems.add(NoteItem(name='mobile%02d' % (idx,), body='m' * 1000))
+    for idx in range(60):
+      self.serverItems.add(NoteItem(name='server%02d' % (idx,), body='s' * 2000))
+    stats = self.mobile.sync(mode=pysyncml.SYNCTYPE_SLOW_SYNC)
+    self.assertEqual(len(self.serverItems.entries), 80)
+    self.assertEqual(len(self.mobileItems.entries), 80)
+    self.assertEqual(sorted([e.name for e in self.serverItems.entries.values()]),
+                     sorted([e.name for e in self.mobileItems.entries.values()]))
+    chk = dict(mnote=stat(mode=pysyncml.SYNCTYPE_SLOW_SYNC, hereAdd=60, peerAdd=20))
+    self.assertTrimDictEqual(stats, chk)
+    # and a subsequent two-way sync should have nothing left to do
+    self.refreshAdapters()
+    stats = self.mobile.sync()
+    chk = dict(mnote=stat(mode=pysyncml.SYNCTYPE_TWO_WAY))
+    self.assertTrimDictEqual(stats, chk)
+
+  #----------------------------------------------------------------------------
+  def test_slowsync_multiMessage_maxMsgSize(self):
+    # the server accepts (very) large messages, but the mobile's sync
+    # commands are still split into messages of at most MAX_MSG_SIZE
+    for idx in range(20):
+      self.mobileItems.add(NoteItem(name='mobile%02d' % (idx,), body='m' * 1000))
+    handler  = self.mobile.peer._handleRequestRemote
+    requests = []
+    def countRequests(*args, **kw):
+      requests.append(None)
+      return handler(*args, **kw)
+    self.mobile.peer._handleRequestRemote = countRequests
+    maxMsgSize = protocol.MAX_MSG_SIZE
+    protocol.MAX_MSG_SIZE = 8192
+    try:
+      stats = self.mobile.sync(mode=pysyncml.SYNCTYPE_SLOW_SYNC)
+    finally:
+      protocol.MAX_MSG_SIZE = maxMsgSize
+    self.assertGreater(self.mobile.peer.maxMsgSize, 8192)
+    self.assertGreater(len(requests), 4)
+    self.assertEqual(sorted([e.name for e in self.serverItems.entries.values()]),
+                     sorted([e.name for e in self.mobileItems.entries.values()]))
+    chk = dict(mnote=stat(mode=pysyncml.SYNCTYPE_SLOW_SYNC, peerAdd=20))
+    self.assertTrimDictEqual(stats, chk)
+
+  #----------------------------------------------------------------------------
+  def test_slowsync_multiMessage_unordered(self):
+    # the server agent returns its items in no particular order, and
+    # they change while they are being paged to the mobile
+    for idx in range(60):
+      self.serverItems.add(NoteItem(name='server%02d' % (idx,), body='s' * 2000))
+    getAll = self.serverItems.getAll
+    calls  = []
+    gone   = []
+    def getAllUnordered():
+      calls.append(None)
+      items = getAll()
+      items = items[7:] + items[:7]
+      # the last listed item is deleted before it is sent
+      gone.append(self.serverItems.entries.pop(items[-1].id).id)
+      self.serverItems.add(NoteItem(name='server-new', body='s' * 2000))
+      return items
+    get     = self.serverItems.get
+    fetched = []
+    def getOrInvalid(itemID):
+      fetched.append(int(itemID))
+      if int(itemID) not in self.serverItems.entries:
+        raise pysyncml.InvalidItem(itemID)
+      return get(itemID)
+    self.serverItems.getAll = getAllUnordered
+    self.serverItems.get    = getOrInvalid
+    self.mobile.sync(mode=pysyncml.SYNCTYPE_SLOW_SYNC)
+    # the items are only listed once, so the later pages skip deleted
+    # items and leave new ones to the next sync
+    self.assertEqual(len(calls), 1)
+    self.assertIn(gone[0], fetched)
+    self.assertEqual(len(self.mobileItems.entries), 59)
+    self.assertEqual(sorted([e.name for e in self.serverItems.entries.values()
+                             if e.name != 'server-new']),
+                     sorted([e.name for e in self.mobileItems.entries.values()]))
+
+  #----------------------------------------------------------------------------
+  def test_slowsync_largeObjects(self):
+    # items larger than the peer's max message size must be split into
+    # chunks (including multi-byte characters straddling chunk boundaries)
+    self.server.maxMsgSize = 8192
+    self.refreshAdapters()
+    self.mobile.maxMsgSize = 16384
+    self.mobileItems.add(NoteItem(name='mobile-small', body='m' * 100))
+    self.mobileItems.add(NoteItem(name='mobile-large', body=u'\u30c6\u30b9\u30c8' * 7000))
+    self.serverItems.add(NoteItem(name='server-large', body='s' * 30000))
+    self.serverItems.add(NoteItem(name='server-small', body='s' * 100))
+    stats = self.mobile.sync(mode=pysyncml.SYNCTYPE_SLOW_SYNC)
+    self.assertEqual(len(self.serverItems.entries), 4)
+    self.assertEqual(len(self.mobileItems.entries), 4)
+    self.assertEqual(sorted([(e.name, e.body) for e in self.serverItems.entries.values()]),
+                     sorted([(e.name, e.body) for e in self.mobileItems.entries.values()]))
+    chk = dict(mnote=stat(mode=pysyncml.SYNCTYPE_SLOW_SYNC, hereAdd=2, peerAdd=2))
+    self.assertTrimDictEqual(stats, chk)
+
+  #----------------------------------------------------------------------------
+  def test_largeObjects_spool(self):
+    spoolDir = tempfile.mkdtemp()
+    try:
+      self.server.maxMsgSize = 8192
+      self.refreshAdapters(serverOptions=dict(spoolDir=spoolDir))
+      self.mobileItems.add(NoteItem(name='mobile-large', body='m' * 30000))
+      self.mobile.sync(mode=pysyncml.SYNCTYPE_SLOW_SYNC)
+      self.assertEqual([e.body for e in self.serverItems.entries.values()], ['m' * 30000])
+      # the spool is removed once the object is complete...
+      self.assertEqual(os.listdir(spoolDir), [])
+      session = state.Session()
+      session.dsstates[self.serverStore.uri] = adict()
+      def receive(tag):
+        xnode = ET.Element(tag)
+        ET.SubElement(ET.SubElement(xnode, 'Meta'), 'Size').text = '10'
+        xitem = ET.SubElement(xnode, 'Item')
+        ET.SubElement(ET.SubElement(xitem, 'Source'), 'LocURI').text = 'item-1'
+        ET.SubElement(xitem, 'Data').text = 'abcde'
+        ET.SubElement(xitem, 'MoreData')
+        return self.server.protocol.t2c_xchunk2item(
+          self.server, session, self.serverStore, xnode, xnode.find('Item/Data'),
+          'text/plain', None, None)
+      # ... or when the transfer fails...
+      self.assertIsNone(receive('Add'))
+      self.assertEqual(len(os.listdir(spoolDir)), 1)
+      self.assertRaises(pysyncml.ProtocolError, receive, 'Replace')
+      self.assertEqual(os.listdir(spoolDir), [])
+      self.assertIsNone(session.dsstates[self.serverStore.uri].recvObject)
+      # ... or when the session is dropped
+      self.assertIsNone(receive('Add'))
+      sessions = state.MemorySessionStore()
+      sessions.put('sid', session)
+      sessions.delete('sid')
+      self.assertEqual(os.listdir(spoolDir), [])
+    finally:
+      shutil.rmtree(spoolDir)
+
+  #----------------------------------------------------------------------------
+  def test_sync_xmlWriterCodec(self):
+    self.refreshAdapters(serverOptions=dict(codec=pysyncml.CODEC_XML_WRITER))
+    self.mobile.codec = pysyncml.Codec.factory(pysyncml.CODEC_XML_WRITER)
+    self.mobileItems.add(NoteItem(name='mobile', body=u'\u30c6\u30b9\u30c8 & <m>'))
+    self.serverItems.add(NoteItem(name='server', body=u'\u30c6\u30b9\u30c8 & <s>'))
+    stats = self.mobile.sync(mode=pysyncml.SYNCTYPE_SLOW_SYNC)
+    self.assertEqual(sorted([(e.name, e.body) for e in self.serverItems.entries.values()]),
+                     sorted([(e.name, e.body) for e in self.mobileItems.entries.values()]))
+    self.assertEqual(len(self.mobileItems.entries), 2)
+    chk = dict(mnote=stat(mode=pysyncml.SYNCTYPE_SLOW_SYNC, hereAdd=1, peerAdd=1))
+    self.assertTrimDictEqual(stats, chk)
+
+  #----------------------------------------------------------------------------
+  def test_sync_wbxmlCodec(self):
+    self.refreshAdapters(serverOptions=dict(codec=pysyncml.CODEC_WBXML))
+    self.mobile.codec = pysyncml.Codec.factory(pysyncml.CODEC_WBXML)
+    self.mobileItems.add(NoteItem(name='mobile', body=u'\u30c6\u30b9\u30c8 & <m>'))
+    self.serverItems.add(NoteItem(name='server', body=u'\u30c6\u30b9\u30c8 & <s>'))
+    stats = self.mobile.sync(mode=pysyncml.SYNCTYPE_SLOW_SYNC)
+    self.assertEqual(sorted([(e.name, e.body) for e in self.serverItems.entries.values()]),
+                     sorted([(e.name, e.body) for e in self.mobileItems.entries.values()]))
+    self.assertEqual(len(self.mobileItems.entries), 2)
+    chk = dict(mnote=stat(mode=pysyncml.SYNCTYPE_SLOW_SYNC, hereAdd=1, peerAdd=1))
+    self.assertTrimDictEqual(stats, chk)
+
+  #----------------------------------------------------------------------------
+  def test_sync_incremental(self):
+    self.refreshAdapters(serverOptions=dict(incremental=True))
+    self.mobileContext.incremental = True
+    self.server.maxMsgSize = 8192
+    for idx in range(10):
+      self.mobileItems.add(NoteItem(name='mobile%02d' % (idx,), body='m' * 1000))
+    for idx in range(10):
+      self.serverItems.add(NoteItem(name='server%02d' % (idx,), body='s' * 1000))
+    stats = self.mobile.sync(mode=pysyncml.SYNCTYPE_SLOW_SYNC)
+    self.assertEqual(sorted([e.name for e in self.serverItems.entries.values()]),
+                     sorted([e.name for e in self.mobileItems.entries.values()]))
+    self.assertEqual(len(self.mobileItems.entries), 20)
+    chk = dict(mnote=stat(mode=pysyncml.SYNCTYPE_SLOW_SYNC, hereAdd=10, peerAdd=10))
+    self.assertTrimDictEqual(stats, chk)
+
   #----------------------------------------------------------------------------
   def baseline(self):
     # step 1: initial sync
@@ -344,6 +535,58 @@ class TestNoteAgent(unittest.TestCase, test_helpers.TrimDictEqual):
   def test_multiclient_add(self):
     self.baseline()
 
+  #----------------------------------------------------------------------------
+  def test_settle_batched(self):
+    self.desktop.sync()
+    self.refreshAdapters()
+    for idx in range(20):
+      item = self.desktopItems.add(NoteItem(name='n%d' % (idx,), body='n%d' % (idx,)))
+      self.desktopStore.registerChange(item.id, pysyncml.ITEM_ADDED)
+    self.refreshAdapters()
+    deletes = []
+    def count(conn, cursor, statement, *args, **kw):
+      if statement.startswith('DELETE FROM pysyncml_change'):
+        deletes.append(statement)
+    sqlalchemy.event.listen(self.desktopSyncDb, 'before_cursor_execute', count)
+    try:
+      dstats = self.desktop.sync()
+    finally:
+      sqlalchemy.event.remove(self.desktopSyncDb, 'before_cursor_execute', count)
+    self.assertTrimDictEqual(dstats, dict(dnote=stat(mode=pysyncml.SYNCTYPE_TWO_WAY, peerAdd=20)))
+    self.assertEqual(len(deletes), 1)
+    self.assertEqual(self.desktopContext._model.Change.q().count(), 0)
+
+  #----------------------------------------------------------------------------
+  def test_replace_conflictQueries(self):
+    # step 1: push some notes to the server
+    self.desktop.sync()
+    self.refreshAdapters()
+    for idx in range(20):
+      item = self.desktopItems.add(NoteItem(name='n%d' % (idx,), body='n%d' % (idx,)))
+      self.desktopStore.registerChange(item.id, pysyncml.ITEM_ADDED)
+    self.refreshAdapters()
+    self.desktop.sync()
+    # step 2: modify them all and push the changes, which requires the
+    #         server to check each of them for conflicts
+    self.refreshAdapters()
+    for item in self.desktopItems.entries.values():
+      item.body += '-bis'
+      self.desktopStore.registerChange(item.id, pysyncml.ITEM_MODIFIED)
+    self.refreshAdapters()
+    queries = []
+    def count(conn, cursor, statement, *args, **kw):
+      if statement.startswith('SELECT') and 'FROM pysyncml_change' in statement:
+        queries.append(statement)
+    sqlalchemy.event.listen(self.serverSyncDb, 'before_cursor_execute', count)
+    try:
+      dstats = self.desktop.sync()
+    finally:
+      sqlalchemy.event.remove(self.serverSyncDb, 'before_cursor_execute', count)
+    self.assertTrimDictEqual(dstats, dict(dnote=stat(mode=pysyncml.SYNCTYPE_TWO_WAY, peerMod=20)))
+    self.assertEqual(sorted([e.body for e in self.serverItems.entries.values()]),
+                     sorted(['n%d-bis' % (idx,) for idx in range(20)]))
+    self.assertLess(len(queries), 5)
+
   #----------------------------------------------------------------------------
   def test_multiclient_replace(self):
     # step 1: get notes into all stores and all synchronized
@@ -866,6 +1109,19 @@ class TestNoteAgent(unittest.TestCase, test_helpers.TrimDictEqual):
     chk = dict(dnote=stat(mode=pysyncml.SYNCTYPE_TWO_WAY))
     self.assertTrimDictEqual(dstats, chk)
 
+#------------------------------------------------------------------------------
+class TestNoteAgentChangeLog(TestNoteAgent):
+  '''
+  Runs all of the :class:`TestNoteAgent` tests with the server tracking
+  changes in a shared change log instead of per-peer change copies.
+  '''
+
+  #----------------------------------------------------------------------------
+  def refreshServer(self, current=None, options=None):
+    ret = super(TestNoteAgentChangeLog, self).refreshServer(current=current, options=options)
+    self.serverContext.changeLog = True
+    return ret
+
 #------------------------------------------------------------------------------
 # end of $Id$
 #------------------------------------------------------------------------------
@@ -26,6 +26,7 @@ synchronization engine.
 '''
 
 import sys, os, re, time, uuid, hashlib, logging, getpass, traceback
+import threading, contextlib, Queue
 import BaseHTTPServer, Cookie, urlparse, urllib, yaml, argparse
 import xml.etree.ElementTree as ET
 import sqlalchemy as sa
@@ -119,6 +120,57 @@ def hook(name):
     return wrapped
   return hookTarget
 
+#------------------------------------------------------------------------------
+class PooledHTTPServer(BaseHTTPServer.HTTPServer):
+  '''
+  An HTTP server that handles requests concurrently in a bounded pool
+  of `workers` threads (unlike ``SocketServer.ThreadingMixIn``, which
+  starts an unbounded number of threads). Requests that arrive while
+  all workers are busy are queued.
+  '''
+  daemon_threads = True
+  def __init__(self, address, handlerClass, workers):
+    BaseHTTPServer.HTTPServer.__init__(self, address, handlerClass)
+    self.requests = Queue.Queue()
+    for idx in range(workers):
+      worker = threading.Thread(target=self._work, name='syncml-worker-%d' % (idx,))
+      worker.daemon = self.daemon_threads
+      worker.start()
+  def process_request(self, request, client_address):
+    self.requests.put((request, client_address))
+  def _work(self):
+    while True:
+      request, client_address = self.requests.get()
+      try:
+        self.finish_request(request, client_address)
+      except Exception:
+        self.handle_error(request, client_address)
+      finally:
+        self.shutdown_request(request)
+
+#------------------------------------------------------------------------------
+class KeyedLocks(object):
+  '''
+  Hands out one (re-entrant) lock per key, e.g. to serialize all the
+  requests of a given SyncML peer. Locks are dropped when unused.
+  '''
+  def __init__(self):
+    self._lock  = threading.Lock()
+    self._locks = dict()   # key => [lock, refcount]
+  @contextlib.contextmanager
+  def __call__(self, key):
+    with self._lock:
+      entry = self._locks.setdefault(key, [threading.RLock(), 0])
+      entry[1] += 1
+    try:
+      with entry[0]:
+        yield
+    finally:
+      with self._lock:
+        entry[1] -= 1
+        if entry[1] <= 0:
+          del self._locks[key]
+
 #------------------------------------------------------------------------------
 class CommandLineSyncEngine(object):
   '''
@@ -155,6 +207,7 @@ class CommandLineSyncEngine(object):
                appModelVersion  = None,
                defaultDevID     = None,
                defaultListen    = 80,
+               defaultWorkers   = 4,
                devinfoParams    = dict(),
                storeParams      = dict(),
                agent            = None,
@@ -197,6 +250,7 @@ class CommandLineSyncEngine(object):
     self.appModelVersion  = appModelVersion
     self.defaultDevID     = defaultDevID
     self.defaultListen    = defaultListen
+    self.defaultWorkers   = defaultWorkers
     self.devinfoParams    = devinfoParams
     self.storeParams      = storeParams
     self.agent            = agent
@@ -343,6 +397,23 @@ class CommandLineSyncEngine(object):
              ' (implies --server and defaults to port {})',
              self.defaultListen))
 
+    self.parser.add_argument(
+      _('-w'), _('--workers'), metavar=_('COUNT'),
+      dest='workers', default=None, action='store', type=int,
+      help=_('specifies the number of requests that are handled'
+             ' concurrently in server mode (defaults to {}); requests'
+             ' from the same peer are always handled one at a time',
+             self.defaultWorkers))
+
+    self.parser.add_argument(
+      _('--sessions'), metavar=_('STORE'),
+      dest='sessions', default=None, action='store',
+      choices=('memory', 'database'),
+      help=_('specifies where server mode keeps the sessions of active'
+             ' synchronizations between messages - can be one of'
+             ' "memory" (default) or "database" (which allows multiple'
+             ' server processes to share the same data directory)'))
+
     self.parser.add_argument(
       _('-P'), _('--policy'), metavar=_('POLICY'),
       dest='policy', default=None, action='store',
@@ -392,6 +463,8 @@ class CommandLineSyncEngine(object):
     if self.options.server:
       options['server'] = True
       options['listen'] = self.options.listen
+      options['workers'] = self.options.workers
+      options['sessions'] = self.options.sessions
     self._callHooks('options.persist.save', options)
     with open(optfile, 'wb') as fp:
       yaml.dump(options, stream=fp, default_flow_style=False)
@@ -427,7 +500,8 @@ class CommandLineSyncEngine(object):
     createDb = not os.path.isfile('%s%s.db' % (self.dataDir, self.appLabel))
     self.dbengine  = sa.create_engine('sqlite:///%s%s.db' % (self.dataDir, self.appLabel))
     pysyncml.enableSqliteCascadingDeletes(self.dbengine)
-    self.dbsession = sessionmaker(bind=self.dbengine)()
+    # note: scoped so that concurrent server requests get their own session
+    self.dbsession = orm.scoped_session(sessionmaker(bind=self.dbengine))
     self._callHooks('model.setup.init')
     self.model = makeModel(self)
     self._callHooks('model.setup.extend')
@@ -437,16 +511,12 @@ class CommandLineSyncEngine(object):
     self._callHooks('model.setup.term')
 
   #----------------------------------------------------------------------------
-  def _makeAdapter(self):
+  def _makeContext(self):
     '''
-    Creates a tuple of ( Context, Adapter ) based on the options
-    specified by `self.options`. The Context is the pysyncml.Context created for
-    the storage location specified in `self.options`, and the Adapter is a newly
-    created Adapter if a previously created one was not found.
+    Creates the pysyncml.Context for the storage location specified in
+    `self.options`.
     '''
 
-    self._callHooks('adapter.create.init')
-
     # create a new pysyncml.Context. the main function that this provides is
     # to give the Adapter a storage engine to store state information across
     # synchronizations.
@@ -455,6 +525,23 @@ class CommandLineSyncEngine(object):
 
     self._callHooks('adapter.create.context', context)
 
+    return context
+
+  #----------------------------------------------------------------------------
+  def _makeAdapter(self, context=None):
+    '''
+    Creates a tuple of ( Context, Adapter ) based on the options
+    specified by `self.options`. The Context is `context` or, if not
+    specified, a new one created by :meth:`_makeContext`, and the
+    Adapter is a newly created Adapter if a previously created one was
+    not found.
+    '''
+
+    self._callHooks('adapter.create.init')
+
+    if context is None:
+      context = self._makeContext()
+
     # create an Adapter from the current context. this will either create
     # a new adapter, or load the current local adapter for the specified
     # context storage location. if it is new, then lots of required
@@ -636,8 +723,20 @@ class CommandLineSyncEngine(object):
                                      password=self.options.password)]
     self.serverConf = sconf
     self.dbsession.commit()
-    sessions = dict()
+    # note: the stored sessions wrap the SyncML session
+    release = lambda session: pysyncml.releaseSession(session.syncml)
+    if self.options.sessions == 'database':
+      sessions = pysyncml.DatabaseSessionStore(self.dbengine, release=release)
+    else:
+      sessions = pysyncml.MemorySessionStore(release=release)
+    peerLock = KeyedLocks()
     syncengine = self
+    workers = self.options.workers or self.defaultWorkers
+    # note: each worker borrows a preloaded adapter instead of creating
+    #       a new context and reloading the adapter for every request
+    context = self._makeContext()
+    pool = pysyncml.AdapterPool(
+      context, size=workers, factory=lambda: syncengine._makeAdapter(context)[1])
     class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
       def version_string(self):
         return 'pysyncml/' + pysyncml.version
@@ -650,37 +749,57 @@ class CommandLineSyncEngine(object):
             self.path_params[key] = True
           else:
             self.path_params[key] = urllib.unquote_plus(pair[1])
-      def do_POST(self):
-        self._parsePathParameters()
-        log.debug('handling POST request to "%s" (parameters: %r)', self.path, self.path_params)
-        sid = None
-        self.session = None
+      def _loadSession(self):
         if 'Cookie' in self.headers:
           cks = Cookie.SimpleCookie(self.headers["Cookie"])
           if 'sessionid' in cks:
-            sid = cks['sessionid'].value
-            if sid in sessions:
-              self.session = sessions[sid]
-              self.session.count += 1
-            else:
-              sid = None
-        if sid is None:
-          log.debug('no valid session ID found in cookies - checking path parameters')
-          sid = self.path_params.get('sessionid')
-          if sid in sessions:
-            self.session = sessions[sid]
-            self.session.count += 1
-          else:
-            sid = None
-        if sid is None:
-          while sid is None or sid in sessions:
-            sid = str(uuid.uuid4())
+            session = sessions.get(cks['sessionid'].value)
+            if session is not None:
+              return session
+        log.debug('no valid session ID found in cookies - checking path parameters')
+        sid = self.path_params.get('sessionid')
+        session = sessions.get(sid) if sid is not None else None
+        if session is None:
+          sid = str(uuid.uuid4())
           log.debug('request without valid session ID - creating new session: %s', sid)
-          self.session = pysyncml.adict(id=sid, count=1, syncml=pysyncml.Session())
-          sessions[sid] = self.session
-        log.debug('session: id=%s, count=%d', self.session.id, self.session.count)
+          session = pysyncml.adict(id=sid, count=0, syncml=pysyncml.Session())
+        return session
+      def do_POST(self):
+        self._parsePathParameters()
+        log.debug('handling POST request to "%s" (parameters: %r)', self.path, self.path_params)
+        # TODO: enforce authentication...
+        # if len(sconf.users) > 0:
+        #   ...
+        #   self.assertEqual(pysyncml.Context.getAuthInfo(request, None),
+        #                    adict(auth=pysyncml.NAMESPACE_AUTH_BASIC,
+        #                          username='guest', password='guest'))
+        #                    
+        clen = 0
+        if 'Content-Length' in self.headers:
+          clen = int(self.headers['Content-Length'])
+        request = pysyncml.adict(headers=dict((
+          ('content-type', self.headers.get('Content-Type', 'application/vnd.syncml+xml')),
+          ('content-encoding', self.headers.get('Content-Encoding')),
+          )), body=self.rfile.read(clen))
         try:
-          response = self.handleRequest()
+          # note: the requests of a given peer are handled one at a time,
+          #       so that a device cannot run overlapping sessions (and
+          #       so that its session is loaded only after the previous
+          #       request has stored it).
+          with peerLock(pysyncml.Context.getSourceID(request) or self.path_params.get('sessionid')):
+            self.session = self._loadSession()
+            self.session.count += 1
+            log.debug('session: id=%s, count=%d', self.session.id, self.session.count)
+            try:
+              response = self.handleRequest(request)
+            except Exception:
+              # a failed request abandons its session
+              sessions.delete(self.session.id)
+              release(self.session)
+              raise
+            finally:
+              syncengine.dbsession.remove()
+            sessions.put(self.session.id, self.session)
         except Exception, e:
           self.send_response(500)
           self.end_headers()
@@ -689,29 +808,18 @@ class CommandLineSyncEngine(object):
         self.send_response(200)
         if self.session.count <= 1:
           cks = Cookie.SimpleCookie()
-          cks['sessionid'] = sid
+          cks['sessionid'] = self.session.id
           self.send_header('Set-Cookie', cks.output(header=''))
         if response.contentType is not None:
           self.send_header('Content-Type', response.contentType)
+        if response.contentEncoding is not None:
+          self.send_header('Content-Encoding', response.contentEncoding)
+        self.send_header('Accept-Encoding', ', '.join(pysyncml.ENCODINGS))
         self.send_header('Content-Length', str(len(response.body)))
         self.send_header('X-PySyncML-Session', 'id=%s, count=%d' % (self.session.id, self.session.count))
         self.end_headers()
         self.wfile.write(response.body)
-      def handleRequest(self):
-        syncengine.dbsession = sessionmaker(bind=syncengine.dbengine)()
-        # TODO: enforce authentication...
-        # if len(sconf.users) > 0:
-        #   ...
-        #   self.assertEqual(pysyncml.Context.getAuthInfo(request, None),
-        #                    adict(auth=pysyncml.NAMESPACE_AUTH_BASIC,
-        #                          username='guest', password='guest'))
-        #                    
-        context, adapter = syncengine._makeAdapter()
-        clen = 0
-        if 'Content-Length' in self.headers:
-          clen = int(self.headers['Content-Length'])
-        request = pysyncml.adict(headers=dict((('content-type', 'application/vnd.syncml+xml'),)),
-                                 body=self.rfile.read(clen))
+      def handleRequest(self, request):
         self.session.syncml.effectiveID = pysyncml.Context.getTargetID(request)
         # todo: this should be a bit more robust...
         urlparts = list(urlparse.urlsplit(self.session.syncml.effectiveID))
@@ -719,16 +827,27 @@ class CommandLineSyncEngine(object):
           urlparts[2] += ';sessionid=' + self.session.id
           self.session.syncml.returnUrl = urlparse.SplitResult(*urlparts).geturl()
         response = pysyncml.Response()
-        self.stats = adapter.handleRequest(self.session.syncml, request, response)
+        with pool.borrow() as adapter:
+          self.stats = adapter.handleRequest(self.session.syncml, request, response)
         syncengine.dbsession.commit()
+        encoding = pysyncml.negotiateEncoding(self.headers.get('Accept-Encoding'))
+        if encoding is not None and context.compressMinSize is not None \
+           and len(response.body) >= context.compressMinSize:
+          response.body = pysyncml.compressContent(response.body, encoding)
+          response.contentEncoding = encoding
         return response
 
-    server = BaseHTTPServer.HTTPServer(('', sconf.port), Handler)
-    log.info('starting server on port %d', sconf.port)
+    if workers > 1:
+      server = PooledHTTPServer(('', sconf.port), Handler, workers)
+    else:
+      server = BaseHTTPServer.HTTPServer(('', sconf.port), Handler)
+    log.info('starting server on port %d (workers: %d)', sconf.port, workers)
     try:
       server.serve_forever()
     except KeyboardInterrupt:
       log.info('shutting down server (stopped by user)')
+    pool.close()
+    context.close()
     return 0
 
   #----------------------------------------------------------------------------
@@ -758,6 +877,7 @@ class CommandLineSyncEngine(object):
     s2.write('Role: %s\n' % ('server' if self.options.server else 'client',))
     if self.options.server:
       print >>s2, 'Listen port:', self.options.listen or self.defaultListen
+      print >>s2, 'Workers:', self.options.workers or self.defaultWorkers
     self._callHooks('describe', s2)
 
   #----------------------------------------------------------------------------
@@ -24,6 +24,7 @@ The ``pysyncml.codec`` is an internal package that abstracts encoding and
 decoding routines for the SyncML payload.
 '''
 
+import six
 import xml.etree.ElementTree as ET
 from . import common, constants, state
 
@@ -40,34 +41,235 @@ def remove_namespace(doc, namespace):
       elem.tag = elem.tag[nsl:]
       elem.attrib['oxmlns'] = namespace
 
-# TODO: convert this to stream-oriented...
+#: the namespaces that are removed from incoming documents
+REMOVE_NAMESPACES = (
+  constants.NAMESPACE_SYNCML,
+  str(constants.NAMESPACE_SYNCML).upper(),
+  constants.NAMESPACE_DEVINF,
+  constants.NAMESPACE_METINF,
+  )
+
+def split_namespace(tag):
+  '''
+  Returns a tuple of (namespace, tag) for the ElementTree-style `tag`,
+  where `namespace` is ``None`` unless it is one of the
+  :data:`REMOVE_NAMESPACES`.
+  '''
+  if tag[:1] != '{':
+    return (None, tag)
+  namespace, local = tag[1:].split('}', 1)
+  if namespace not in REMOVE_NAMESPACES:
+    return (None, tag)
+  return (namespace, local)
+
+#------------------------------------------------------------------------------
+class TreeBuilder(ET.TreeBuilder):
+  '''
+  An ElementTree tree builder that removes namespaces while parsing
+  (identical in effect to :func:`remove_namespace` with all of the
+  :data:`REMOVE_NAMESPACES`).
+  '''
+  def start(self, tag, attrs):
+    namespace, tag = split_namespace(tag)
+    if namespace is not None:
+      attrs = dict(attrs)
+      attrs['oxmlns'] = namespace
+    return ET.TreeBuilder.start(self, tag, attrs)
+  def end(self, tag):
+    return ET.TreeBuilder.end(self, split_namespace(tag)[1])
+
+#------------------------------------------------------------------------------
+class IncrementalElement(ET.Element):
+  '''
+  An element of a document that is being parsed by an
+  :class:`IncrementalParser`. Its children should be accessed via
+  :func:`iterchildren`, since they may not have been parsed yet.
+  '''
+  def __init__(self, tag, attrib={}, parser=None):
+    ET.Element.__init__(self, tag, attrib)
+    self._parser   = parser
+    self._complete = False
+    self._yielded  = False
+
+#------------------------------------------------------------------------------
+class IncrementalParser(object):
+  '''
+  Parses an XML document from the file-like `source` on demand, i.e.
+  as the children of its elements are requested via
+  :meth:`iterchildren`. Namespaces are removed during parsing.
+
+  `containers` is a dictionary that maps container element tags to
+  the tags of the children that they stream: a container is yielded
+  as soon as the first such child starts (instead of when the
+  container ends), so that those children can in turn be iterated
+  over as they are parsed.
+  '''
+  def __init__(self, source, containers=None):
+    self.containers = containers or dict()
+    self.stack      = []
+    self.root       = None
+    builder = TreeBuilder(
+      element_factory=lambda tag, attrib: IncrementalElement(tag, attrib, self))
+    self.events = ET.iterparse(source, ('start', 'end'), ET.XMLParser(target=builder))
+
+  def parseUntil(self, tag):
+    '''
+    Parses the document until the element `tag` starts and returns the
+    document root element.
+    '''
+    for event, elem in self._iterevents():
+      if event == 'start' and elem.tag == tag:
+        break
+    return self.root
+
+  def iterchildren(self, elem, release=True):
+    '''
+    Yields the children of `elem` as soon as each one has been parsed
+    (or, for containers, as soon as they can be streamed). If `release`
+    is truthy, each child is removed from `elem` when the next one is
+    requested, i.e. the caller must be done with it by then.
+    '''
+    # note: the underlying parser builds the tree ahead of the events
+    #       that have been processed, so the completeness of elements
+    #       is tracked by the events (not by the tree).
+    for child in list(elem):
+      if not child._complete or child._yielded:
+        continue
+      child._yielded = True
+      yield child
+      if release:
+        elem.remove(child)
+    if elem._complete:
+      return
+    for event, node in self._iterevents():
+      if event == 'start':
+        if len(self.stack) >= 3 and self.stack[-3] is elem:
+          parent = self.stack[-2]
+          if not parent._yielded and node.tag in self.containers.get(parent.tag, ()):
+            parent._yielded = True
+            yield parent
+            if release:
+              elem.remove(parent)
+        continue
+      if node is elem:
+        return
+      if len(self.stack) > 0 and self.stack[-1] is elem and not node._yielded:
+        node._yielded = True
+        yield node
+        if release and node in elem:
+          elem.remove(node)
+
+  def _iterevents(self):
+    for event, elem in self.events:
+      if event == 'start':
+        if self.root is None:
+          self.root = elem
+        self.stack.append(elem)
+      else:
+        self.stack.pop()
+        elem._complete = True
+      yield event, elem
+
+#------------------------------------------------------------------------------
+def iterchildren(elem):
+  '''
+  Iterates over the children of `elem`, which may be an element of a
+  completely parsed document or of an incrementally parsed one (see
+  :class:`IncrementalParser`). In the latter case, each child is
+  yielded as soon as it is available, and released once the next child
+  is requested.
+  '''
+  if isinstance(elem, IncrementalElement) and elem._parser is not None:
+    return elem._parser.iterchildren(elem)
+  return iter(list(elem))
 
 #------------------------------------------------------------------------------
 
 class Codec(object):
+  def Element(self, tag, attrib={}):
+    '''
+    Creates the root element of an outgoing document, which is later
+    passed to :meth:`encode`. The default implementation returns an
+    ElementTree element.
+    '''
+    return ET.Element(tag, attrib)
+  def SubElement(self, parent, tag, attrib={}):
+    '''
+    Creates a new child element of `parent` (which was created by
+    :meth:`Element` or :meth:`SubElement`).
+    '''
+    return ET.SubElement(parent, tag, attrib)
   def encode(self, xtree):
     '''returns a tuple of (contentType, data)'''
     raise NotImplementedError()
-  def decode(self, contentType, xmldata):
+  def decode(self, contentType, xmldata, incremental=False):
     '''
     Returns an ElementTree document model of `xmldata`, which has been
-    declared to be of `contentType` format/encoding.
+    declared to be of `contentType` format/encoding. If `incremental`
+    is truthy and the codec supports it, the returned document may
+    only be partially parsed (see :func:`iterchildren`).
     '''
     raise NotImplementedError()
   @staticmethod
   def factory(codec):
     if codec == constants.CODEC_XML:
       return XmlCodec()
-    # if codec == constants.CODEC_WBXML:
-    #   return WbxmlCodec()
+    if codec == constants.CODEC_XML_WRITER:
+      return XmlWriterCodec()
+    if codec == constants.CODEC_WBXML:
+      return WbxmlCodec()
     raise common.UnknownCodec('unknown or unimplemented codec "%s"' % (codec,))
   @staticmethod
-  def autoDecode(contentType, data):
+  def autoDecode(contentType, data, incremental=False):
     if not contentType.startswith(constants.TYPE_SYNCML + '+'):
       raise common.InvalidContentType('unknown or unimplemented content type "%s"'
                                       % (contentType,))
     ct = contentType[len(constants.TYPE_SYNCML) + 1:].split(';', 1)[0]
-    return Codec.factory(ct).decode(contentType, data)
+    return Codec.factory(ct).decode(contentType, data, incremental=incremental)
+  @staticmethod
+  def decodeRequest(request, incremental=False):
+    '''
+    Decodes the (possibly compressed, as declared by its
+    "content-encoding" header) body of `request` (see
+    :meth:`autoDecode`) and memoizes
+    the document model on the request as `request.xtree`, so that the
+    server-side entry points (e.g. :meth:`pysyncml.Adapter.handleRequest`)
+    all share a single parse. Note that `incremental` only has an
+    effect if the request has not been decoded yet.
+    '''
+    if request.xtree is None:
+      if incremental and request.xhdr is not None:
+        # the header has already been decoded incrementally (see
+        # decodeRequestHeader), i.e. the body has not been parsed yet
+        request.xtree = request.xhdr
+      else:
+        request.xtree = Codec._decodeRequest(request, incremental)
+    return request.xtree
+  @staticmethod
+  def decodeRequestHeader(request):
+    '''
+    Returns a document model of `request` in which (at least) the
+    SyncHdr has been decoded, and memoizes it on the request as
+    `request.xhdr`. This is used by the server-side entry points that
+    only inspect the header (e.g. :meth:`pysyncml.Context.getTargetID`),
+    so that they neither parse the complete body nor decide whether
+    :meth:`decodeRequest` parses it incrementally.
+    '''
+    if request.xtree is not None:
+      return request.xtree
+    if request.xhdr is None:
+      xhdr = Codec._decodeRequest(request, True)
+      if not isinstance(xhdr, IncrementalElement):
+        # the codec does not support incremental decoding, i.e. this is
+        # the complete document
+        request.xtree = xhdr
+        return xhdr
+      request.xhdr = xhdr
+    return request.xhdr
+  @staticmethod
+  def _decodeRequest(request, incremental):
+    body = common.decompressContent(request.body, request.headers.get('content-encoding'))
+    return Codec.autoDecode(request.headers['content-type'], body, incremental=incremental)
 
 #------------------------------------------------------------------------------
 class XmlCodec(Codec):
@@ -77,12 +279,21 @@ class XmlCodec(Codec):
       '%s+%s; charset=%s' % (constants.TYPE_SYNCML, constants.CODEC_XML, 'UTF-8'),
       ET.tostring(xtree)#, 'UTF-8')
       )
-  def decode(self, contentType, xmldata):
+  def decode(self, contentType, xmldata, incremental=False):
     expCT = '%s+%s' % (constants.TYPE_SYNCML, constants.CODEC_XML)
     if not contentType.startswith(expCT):
       raise common.ProtocolError('received unexpected content-type "%s" (expected "%s")' % \
                                  (contentType, expCT))
-    return self.removeNamespaces(ET.fromstring(xmldata))
+    if incremental:
+      # the header is parsed up-front, and the body as it is consumed
+      parser = IncrementalParser(six.StringIO(xmldata), containers={
+        constants.CMD_SYNC: (constants.CMD_ADD, constants.CMD_REPLACE, constants.CMD_DELETE)})
+      return parser.parseUntil(constants.NODE_SYNCBODY)
+    # note: removing the namespaces while parsing (instead of walking the
+    #       tree once per namespace afterwards)
+    parser = ET.XMLParser(target=TreeBuilder())
+    parser.feed(xmldata)
+    return parser.close()
   def removeNamespaces(self, xtree):
     remove_namespace(xtree, constants.NAMESPACE_SYNCML)
     remove_namespace(xtree, str(constants.NAMESPACE_SYNCML).upper())
@@ -90,12 +301,446 @@ class XmlCodec(Codec):
     remove_namespace(xtree, constants.NAMESPACE_METINF)
     return xtree
 
-# #------------------------------------------------------------------------------
-# class WbxmlCodec(Codec):
-#   name = constants.CODEC_WBXML
-#   def encode(self, adapter, session, request, xtree):
-#     request.contentType = '%s+%s' % (constants.TYPE_SYNCML, constants.CODEC_WBXML)
-#     request.body = ET.tostring(xtree)
+#------------------------------------------------------------------------------
+def encode_utf8(text):
+  '''Returns `text` (which may also be a non-string value) encoded as UTF-8.'''
+  if isinstance(text, unicode):
+    return text.encode('utf-8')
+  if not isinstance(text, str):
+    return str(text)
+  return text
+
+def escape_text(text):
+  '''Returns `text` escaped for XML character data and encoded as UTF-8.'''
+  text = encode_utf8(text)
+  if '&' in text:
+    text = text.replace('&', '&amp;')
+  if '<' in text:
+    text = text.replace('<', '&lt;')
+  if '>' in text:
+    text = text.replace('>', '&gt;')
+  return text
+
+def escape_attrib(text):
+  '''Returns `text` escaped for an XML attribute value and encoded as UTF-8.'''
+  text = escape_text(text)
+  if '"' in text:
+    text = text.replace('"', '&quot;')
+  return text
+
+#------------------------------------------------------------------------------
+class WriterElement(object):
+  '''
+  A placeholder for an element that is being streamed by an
+  :class:`XmlWriter`. It supports the small subset of the ElementTree
+  element API that is needed to build outgoing documents, i.e. setting
+  the `text` and appending complete ElementTree sub-trees.
+  '''
+  def __init__(self, writer, tag, attrib):
+    self.writer  = writer
+    self.tag     = tag
+    self.attrib  = attrib
+    self.text    = None
+    self.started = False
+  def append(self, xnode):
+    self.writer.append(self, xnode)
+
+#------------------------------------------------------------------------------
+class XmlWriter(object):
+  '''
+  Serializes a document to UTF-8 into the file-like `sink` while it is
+  being built, without creating an ElementTree document model. An
+  element is written as soon as its first child is created or it is
+  closed, which happens when one of its preceding siblings\' children
+  is created, i.e. elements must be created in document order and
+  their text must be set before they have any children.
+  '''
+  def __init__(self, sink=None):
+    self.sink  = sink if sink is not None else six.StringIO()
+    self.stack = []
+  def Element(self, tag, attrib={}):
+    if len(self.stack) > 0:
+      raise common.InternalError('document root element already created')
+    node = WriterElement(self, tag, attrib)
+    self.stack.append(node)
+    return node
+  def SubElement(self, parent, tag, attrib={}):
+    self._descend(parent)
+    node = WriterElement(self, tag, attrib)
+    self.stack.append(node)
+    return node
+  def append(self, parent, xnode):
+    self._descend(parent)
+    self._writeTree(xnode)
+  def close(self):
+    '''Closes all open elements and returns the `sink`.'''
+    while len(self.stack) > 0:
+      self._end(self.stack.pop())
+    return self.sink
+  def _descend(self, parent):
+    # close all elements below `parent` and make sure it is started
+    while len(self.stack) > 0 and self.stack[-1] is not parent:
+      self._end(self.stack.pop())
+    if len(self.stack) <= 0:
+      raise common.InternalError('element "%s" created out of document order' % (parent.tag,))
+    if not parent.started:
+      self._start(parent)
+      parent.started = True
+  def _starttag(self, tag, attrib):
+    if not attrib:
+      return '<' + tag
+    return '<' + tag + ''.join([' %s="%s"' % (key, escape_attrib(value))
+                                for key, value in attrib.items()])
+  def _start(self, node):
+    self.sink.write(self._starttag(node.tag, node.attrib) + '>')
+    if node.text is not None:
+      self.sink.write(escape_text(node.text))
+  def _end(self, node):
+    if node.started:
+      self.sink.write('</' + node.tag + '>')
+    elif node.text is None:
+      self.sink.write(self._starttag(node.tag, node.attrib) + ' />')
+    else:
+      self.sink.write(self._starttag(node.tag, node.attrib) + '>'
+                      + escape_text(node.text) + '</' + node.tag + '>')
+  def _writeTree(self, xnode):
+    if xnode.tag.startswith('{'):
+      # todo: namespaced tags are not expected in outgoing documents...
+      self.sink.write(ET.tostring(xnode, 'utf-8'))
+      return
+    self.sink.write(self._starttag(xnode.tag, xnode.attrib))
+    if xnode.text is None and len(xnode) <= 0:
+      self.sink.write(' />')
+    else:
+      self.sink.write('>')
+      if xnode.text is not None:
+        self.sink.write(escape_text(xnode.text))
+      for child in xnode:
+        self._writeTree(child)
+      self.sink.write('</' + xnode.tag + '>')
+    if xnode.tail is not None:
+      self.sink.write(escape_text(xnode.tail))
+
+#------------------------------------------------------------------------------
+class XmlWriterCodec(XmlCodec):
+  '''
+  An XML codec that serializes outgoing documents directly into a
+  UTF-8 buffer (via :class:`XmlWriter`) while they are being built,
+  instead of building an ElementTree document model and then
+  stringifying it. This is faster and, since non-ASCII characters are
+  not converted to character references, produces smaller messages
+  for non-Latin content. Decoding is identical to :class:`XmlCodec`.
+  '''
+  def Element(self, tag, attrib={}):
+    return XmlWriter().Element(tag, attrib)
+  def SubElement(self, parent, tag, attrib={}):
+    return parent.writer.SubElement(parent, tag, attrib)
+  def encode(self, xtree):
+    if not isinstance(xtree, WriterElement):
+      return super(XmlWriterCodec, self).encode(xtree)
+    return (
+      '%s+%s; charset=%s' % (constants.TYPE_SYNCML, constants.CODEC_XML, 'UTF-8'),
+      xtree.writer.close().getvalue(),
+      )
+
+#------------------------------------------------------------------------------
+# WBXML global tokens (see the WAP Binary XML Content Format specification)
+WBXML_SWITCH_PAGE = 0x00
+WBXML_END         = 0x01
+WBXML_ENTITY      = 0x02
+WBXML_STR_I       = 0x03
+WBXML_LITERAL     = 0x04
+WBXML_STR_T       = 0x83
+WBXML_OPAQUE      = 0xC3
+WBXML_CONTENT     = 0x40
+WBXML_ATTRIBUTES  = 0x80
+WBXML_CHARSET     = 106 # i.e. the IANA MIBenum for UTF-8
+
+#: the SyncML 1.2 code page 0 (SyncML) tags, starting at token 0x05
+WBXML_SYNCML_TAGS = (
+  'Add', 'Alert', 'Archive', 'Atomic', 'Chal', 'Cmd', 'CmdID', 'CmdRef',
+  'Copy', 'Cred', 'Data', 'Delete', 'Exec', 'Final', 'Get', 'Item', 'Lang',
+  'LocName', 'LocURI', 'Map', 'MapItem', 'Meta', 'MsgID', 'MsgRef',
+  'NoResp', 'NoResults', 'Put', 'Replace', 'RespURI', 'Results', 'Search',
+  'Sequence', 'SessionID', 'SftDel', 'Source', 'SourceRef', 'Status',
+  'Sync', 'SyncBody', 'SyncHdr', 'SyncML', 'Target', 'TargetRef', None,
+  'VerDTD', 'VerProto', 'NumberOfChanges', 'MoreData', 'Field', 'Filter',
+  'Record', 'FilterType', 'SourceParent', 'TargetParent', 'Move',
+  'Correlator',
+  )
+
+#: the SyncML 1.2 code page 1 (MetInf) tags, starting at token 0x05
+WBXML_METINF_TAGS = (
+  'Anchor', 'EMI', 'Format', 'FreeID', 'FreeMem', 'Last', 'Mark',
+  'MaxMsgSize', 'Mem', 'MetInf', 'Next', 'NextNonce', 'SharedMem', 'Size',
+  'Type', 'Version', 'MaxObjSize', 'FieldLevel',
+  )
+
+#: the DevInf 1.2 code page 0 tags, starting at token 0x05
+WBXML_DEVINF_TAGS = (
+  'CTCap', 'CTType', 'DataStore', 'DataType', 'DevID', 'DevInf', 'DevTyp',
+  'DisplayName', 'DSMem', 'Ext', 'FwV', 'HwV', 'Man', 'MaxGUIDSize',
+  'MaxID', 'MaxMem', 'Mod', 'OEM', 'ParamName', 'PropName', 'Rx',
+  'Rx-Pref', 'SharedMem', 'MaxSize', 'SourceRef', 'SwV', 'SyncCap',
+  'SyncType', 'Tx', 'Tx-Pref', 'ValEnum', 'VerCT', 'VerDTD', 'XNam',
+  'XVal', 'UTC', 'SupportNumberOfChanges', 'SupportLargeObjs', 'Property',
+  'PropParam', 'MaxOccur', 'NoTruncate', None, 'Filter-Rx', 'FilterCap',
+  'FilterKeyword', 'FieldLevel', 'SupportHierarchicalSync',
+  )
+
+#------------------------------------------------------------------------------
+class WbxmlDocType(object):
+  '''
+  Describes a WBXML document type, i.e. its public identifier (both
+  the well-known numeric one and the formal one) and its code pages,
+  which are a list of (namespace, tags) tuples.
+  '''
+  def __init__(self, publicID, fpi, pages):
+    self.publicID = publicID
+    self.fpi      = fpi
+    self.pages    = pages
+    self.tokens   = dict()
+    for page, (namespace, tags) in enumerate(pages):
+      for idx, tag in enumerate(tags):
+        if tag is not None:
+          self.tokens[(namespace, tag)] = (page, idx + 0x05)
+  @property
+  def namespace(self):
+    return self.pages[0][0]
+  def hasNamespace(self, namespace):
+    for ns, tags in self.pages:
+      if ns == namespace:
+        return True
+    return False
+  def tag(self, page, token):
+    if page >= len(self.pages):
+      raise common.ProtocolError('invalid WBXML code page %d' % (page,))
+    namespace, tags = self.pages[page]
+    if token < 0x05 or token - 0x05 >= len(tags) or tags[token - 0x05] is None:
+      raise common.ProtocolError('invalid WBXML token 0x%02X on code page %d' % (token, page))
+    return (namespace, tags[token - 0x05])
+
+WBXML_SYNCML_1_2 = WbxmlDocType(0x1201, '-//SYNCML//DTD SyncML 1.2//EN', [
+  (constants.NAMESPACE_SYNCML, WBXML_SYNCML_TAGS),
+  (constants.NAMESPACE_METINF, WBXML_METINF_TAGS),
+  ])
+
+WBXML_DEVINF_1_2 = WbxmlDocType(0x1203, '-//SYNCML//DTD DevInf 1.2//EN', [
+  (constants.NAMESPACE_DEVINF, WBXML_DEVINF_TAGS),
+  ])
+
+WBXML_DOCTYPES = (WBXML_SYNCML_1_2, WBXML_DEVINF_1_2)
+
+#------------------------------------------------------------------------------
+def wbxml_int(value):
+  '''Returns `value` encoded as a WBXML multi-byte unsigned integer.'''
+  ret = chr(value & 0x7F)
+  value >>= 7
+  while value > 0:
+    ret = chr(0x80 | ( value & 0x7F )) + ret
+    value >>= 7
+  return ret
+
+#------------------------------------------------------------------------------
+class WbxmlEncoder(object):
+  '''
+  Encodes an ElementTree document model of type `doctype` (a
+  :class:`WbxmlDocType`) into WBXML. The namespace of each element is
+  taken from its "xmlns" attribute, or else inherited from its parent.
+  Sub-trees in the namespace of another document type (i.e. "DevInf")
+  are encoded as a nested document and stored as opaque data. Tags that
+  are not in the document type's code pages are encoded as literals.
+  '''
+  def __init__(self, doctype):
+    self.doctype = doctype
+    self.strtbl  = six.StringIO()
+    self.strings = dict()
+    self.body    = six.StringIO()
+    self.page    = 0
+  def encode(self, xtree):
+    self._encodeNode(xtree, self.doctype.namespace)
+    strtbl = self.strtbl.getvalue()
+    return chr(0x03) + wbxml_int(self.doctype.publicID) + wbxml_int(WBXML_CHARSET) \
+      + wbxml_int(len(strtbl)) + strtbl + self.body.getvalue()
+  def _string(self, value):
+    if value not in self.strings:
+      self.strings[value] = self.strtbl.tell()
+      self.strtbl.write(value + '\x00')
+    return self.strings[value]
+  def _encodeNode(self, xnode, namespace):
+    namespace = xnode.get('xmlns', namespace)
+    for key in xnode.keys():
+      if key != 'xmlns':
+        raise common.InternalError('WBXML attributes are not supported (element "%s")' % (xnode.tag,))
+    if not self.doctype.hasNamespace(namespace):
+      for doctype in WBXML_DOCTYPES:
+        if namespace == doctype.namespace:
+          self._writeOpaque(WbxmlEncoder(doctype).encode(xnode))
+          return
+      raise common.InternalError('cannot encode namespace "%s" in WBXML' % (namespace,))
+    flags = 0
+    if xnode.text is not None or len(xnode) > 0:
+      flags = WBXML_CONTENT
+    page, token = self.doctype.tokens.get((namespace, xnode.tag), (None, None))
+    if page is None:
+      # note: literals are decoded into the namespace of their parent
+      #       element (or the current code page), which is the same as
+      #       the namespace here in practice.
+      self.body.write(chr(WBXML_LITERAL | flags) + wbxml_int(self._string(encode_utf8(xnode.tag))))
+    else:
+      if page != self.page:
+        self.body.write(chr(WBXML_SWITCH_PAGE) + chr(page))
+        self.page = page
+      self.body.write(chr(token | flags))
+    if not flags:
+      return
+    if xnode.text is not None:
+      text = encode_utf8(xnode.text)
+      if '\x00' in text:
+        self._writeOpaque(text)
+      else:
+        self.body.write(chr(WBXML_STR_I) + text + '\x00')
+    for child in xnode:
+      self._encodeNode(child, namespace)
+    self.body.write(chr(WBXML_END))
+  def _writeOpaque(self, data):
+    self.body.write(chr(WBXML_OPAQUE) + wbxml_int(len(data)) + data)
+
+#------------------------------------------------------------------------------
+class WbxmlDecoder(object):
+  '''
+  Decodes a WBXML document of one of the :data:`WBXML_DOCTYPES` into an
+  ElementTree document model that is equivalent to the one produced by
+  :class:`XmlCodec` (i.e. without namespaces, but with each element's
+  namespace stored in its "oxmlns" attribute). Opaque "Data" that is a
+  nested document (i.e. "DevInf") is decoded into a sub-tree.
+  '''
+  def __init__(self, data):
+    self.data = data
+    self.pos  = 0
+  def decode(self):
+    if self._byte() not in (0x01, 0x02, 0x03):
+      raise common.ProtocolError('unsupported WBXML version')
+    publicID = self._int()
+    fpiIndex = self._int() if publicID == 0 else None
+    charset  = self._int()
+    if charset not in (0, WBXML_CHARSET):
+      raise common.ProtocolError('unsupported WBXML charset %d' % (charset,))
+    self.strtbl = self._read(self._int())
+    if fpiIndex is not None:
+      fpi = self._strtbl(fpiIndex)
+      doctypes = [dt for dt in WBXML_DOCTYPES if dt.fpi == fpi]
+    else:
+      doctypes = [dt for dt in WBXML_DOCTYPES if dt.publicID == publicID]
+    if len(doctypes) != 1:
+      raise common.ProtocolError('unsupported WBXML document type')
+    self.doctype = doctypes[0]
+    self.page    = 0
+    ret = self._decodeNode(self._byte(), None)
+    if self.pos != len(self.data):
+      raise common.ProtocolError('unexpected data after WBXML document')
+    return ret
+  def _byte(self):
+    if self.pos >= len(self.data):
+      raise common.ProtocolError('truncated WBXML document')
+    self.pos += 1
+    return ord(self.data[self.pos - 1])
+  def _int(self):
+    ret = 0
+    while True:
+      byte = self._byte()
+      ret  = ( ret << 7 ) | ( byte & 0x7F )
+      if not byte & 0x80:
+        return ret
+  def _read(self, length):
+    if self.pos + length > len(self.data):
+      raise common.ProtocolError('truncated WBXML document')
+    self.pos += length
+    return self.data[self.pos - length:self.pos]
+  def _cstring(self, data, offset):
+    end = data.find('\x00', offset)
+    if end < 0:
+      raise common.ProtocolError('unterminated WBXML string')
+    return data[offset:end]
+  def _strtbl(self, offset):
+    if offset >= len(self.strtbl):
+      raise common.ProtocolError('invalid WBXML string table reference')
+    return self._cstring(self.strtbl, offset)
+  def _text(self, value):
+    # note: mirroring ElementTree, which returns ASCII text as `str`
+    try:
+      value = value.decode('utf-8')
+    except UnicodeDecodeError:
+      return value
+    try:
+      return value.encode('ascii')
+    except UnicodeEncodeError:
+      return value
+  def _decodeNode(self, token, namespace):
+    while token == WBXML_SWITCH_PAGE:
+      self.page = self._byte()
+      token     = self._byte()
+    if token & WBXML_ATTRIBUTES:
+      raise common.ProtocolError('WBXML attributes are not supported')
+    if token & 0x3F == WBXML_LITERAL:
+      if namespace is None:
+        namespace = self.doctype.pages[self.page][0]
+      tag = self._strtbl(self._int())
+    elif token & 0x3F < 0x05:
+      raise common.ProtocolError('unexpected WBXML token 0x%02X' % (token,))
+    else:
+      namespace, tag = self.doctype.tag(self.page, token & 0x3F)
+    xnode = ET.Element(tag, {'oxmlns': namespace})
+    if not token & WBXML_CONTENT:
+      return xnode
+    text = []
+    while True:
+      token = self._byte()
+      if token == WBXML_END:
+        break
+      if token == WBXML_STR_I:
+        text.append(self._cstring(self.data, self.pos))
+        self.pos += len(text[-1]) + 1
+      elif token == WBXML_STR_T:
+        text.append(self._strtbl(self._int()))
+      elif token == WBXML_ENTITY:
+        text.append(unichr(self._int()).encode('utf-8'))
+      elif token == WBXML_OPAQUE:
+        data = self._read(self._int())
+        if tag == 'Data' and len(xnode) <= 0 and len(text) <= 0:
+          # the data may be a nested document (e.g. "DevInf")
+          try:
+            xnode.append(WbxmlDecoder(data).decode())
+            continue
+          except common.ProtocolError:
+            pass
+        text.append(data)
+      else:
+        xnode.append(self._decodeNode(token, namespace))
+    if len(text) > 0:
+      xnode.text = self._text(''.join(text))
+    return xnode
+
+#------------------------------------------------------------------------------
+class WbxmlCodec(Codec):
+  '''
+  Encodes and decodes SyncML 1.2 messages in WBXML, i.e. the compact
+  binary representation of XML that is preferred by most mobile
+  devices. Device information is transferred as a nested DevInf 1.2
+  WBXML document. Incremental decoding is not supported.
+  '''
+  name = constants.CODEC_WBXML
+  def encode(self, xtree):
+    return (
+      '%s+%s' % (constants.TYPE_SYNCML, constants.CODEC_WBXML),
+      WbxmlEncoder(WBXML_SYNCML_1_2).encode(xtree),
+      )
+  def decode(self, contentType, data, incremental=False):
+    expCT = '%s+%s' % (constants.TYPE_SYNCML, constants.CODEC_WBXML)
+    if not contentType.startswith(expCT):
+      raise common.ProtocolError('received unexpected content-type "%s" (expected "%s")' % \
+                                 (contentType, expCT))
+    return WbxmlDecoder(data).decode()
 
 #------------------------------------------------------------------------------
 # end of $Id$
@@ -24,7 +24,7 @@ The ``pysyncml.common`` package provides some commonly used helper routines
 and classes used throughout the pysyncml package.
 '''
 
-import sys, time, calendar, inspect, six, pkg_resources, platform
+import sys, time, calendar, inspect, six, pkg_resources, platform, zlib
 import xml.etree.ElementTree as ET
 import asset
 
@@ -158,6 +158,10 @@ class IndentStream:
 #------------------------------------------------------------------------------
 class adict(dict):
   def __getattr__(self, key):
+    # note: special attributes are not looked up as keys so that adicts
+    #       can be pickled and copied.
+    if key.startswith('__') and key.endswith('__'):
+      raise AttributeError(key)
     return self.get(key, None)
   def __setattr__(self, key, value):
     self[key] = value
@@ -207,6 +211,63 @@ def num2str(num):
     s.insert(idx, ',')
   return ''.join(reversed(s))
 
+#------------------------------------------------------------------------------
+def negotiateEncoding(acceptEncoding):
+  '''
+  Returns the preferred HTTP content-encoding (i.e. compression) that
+  is supported both by pysyncml and by a peer that declared
+  `acceptEncoding` (the value of an "Accept-Encoding" header), or
+  ``None`` if there is none.
+  '''
+  accepted = []
+  for item in ( acceptEncoding or '' ).split(','):
+    params = [e.strip() for e in item.split(';')]
+    qvalue = 1.0
+    for param in params[1:]:
+      if param.startswith('q='):
+        try:
+          qvalue = float(param[2:])
+        except ValueError:
+          qvalue = 0
+    if qvalue > 0:
+      accepted.append(params[0].lower())
+  for encoding in constants.ENCODINGS:
+    if encoding in accepted:
+      return encoding
+  return None
+
+#------------------------------------------------------------------------------
+def compressContent(data, encoding):
+  '''Returns `data` compressed with the HTTP content-encoding `encoding`.'''
+  if encoding == constants.ENCODING_GZIP:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+  if encoding == constants.ENCODING_DEFLATE:
+    return zlib.compress(data)
+  raise FeatureNotSupported('unsupported content-encoding "%s"' % (encoding,))
+
+#------------------------------------------------------------------------------
+def decompressContent(data, encoding):
+  '''
+  Returns `data` decompressed from the HTTP content-encoding
+  `encoding`, which may be ``None`` (i.e. not compressed).
+  '''
+  encoding = ( encoding or constants.ENCODING_IDENTITY ).strip().lower()
+  try:
+    if encoding == constants.ENCODING_IDENTITY:
+      return data
+    if encoding == constants.ENCODING_GZIP:
+      return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if encoding == constants.ENCODING_DEFLATE:
+      try:
+        return zlib.decompress(data)
+      except zlib.error:
+        # some implementations send raw (i.e. headerless) deflate data
+        return zlib.decompress(data, -zlib.MAX_WBITS)
+  except zlib.error, e:
+    raise ProtocolError('invalid "%s" content-encoded data: %s' % (encoding, e))
+  raise ProtocolError('unsupported content-encoding "%s"' % (encoding,))
+
 #------------------------------------------------------------------------------
 def describeStats(stats, stream, title=None, details=True, totals=True, gettext=None):
   '''
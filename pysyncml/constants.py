@@ -190,9 +190,18 @@ STATUS_ATOMIC_RESPONSE_TOO_LARGE_TO_FIT = 517
 #: SyncML codecs
 CODEC_XML                               = 'xml'
 CODEC_WBXML                             = 'wbxml'
+# note: this is not a SyncML codec per-se, but selects the XML codec
+#       that serializes documents while they are being built.
+CODEC_XML_WRITER                        = 'xml-writer'
 FORMAT_B64                              = 'b64'
 FORMAT_AUTO                             = 'auto'
 
+#: HTTP content-encodings (i.e. compression), in order of preference
+ENCODING_GZIP                           = 'gzip'
+ENCODING_DEFLATE                        = 'deflate'
+ENCODING_IDENTITY                       = 'identity'
+ENCODINGS                               = (ENCODING_GZIP, ENCODING_DEFLATE)
+
 #: SyncML nodes
 NODE_SYNCML                             = 'SyncML'
 NODE_SYNCBODY                           = 'SyncBody'
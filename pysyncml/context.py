@@ -25,9 +25,9 @@ pysyncml operations via the :class:`pysyncml.Context
 <pysyncml.context.Context>` class.
 '''
 
-import sqlalchemy.ext.declarative
+import thread, threading, contextlib, Queue, sqlalchemy
 from sqlalchemy.orm.exc import NoResultFound
-from . import model, codec, router, protocol, synchronizer
+from . import common, model, codec, router, protocol, synchronizer
 
 #------------------------------------------------------------------------------
 class Context(object):
@@ -46,6 +46,9 @@ class Context(object):
                engine=None, storage=None, prefix='pysyncml', owner=None,
                autoCommit=None,
                router=None, protocol=None, synchronizer=None, codec=None,
+               incremental=False, compressMinSize=1024,
+               httpPoolSize=4, httpTimeout=None, changeLog=False,
+               sessionScope=None, spoolDir=None,
                ):
     '''
     The Context constructor accepts the following parameters, of which
@@ -65,6 +68,13 @@ class Context(object):
 
       NOTE: can be overridden by parameter `engine`.
 
+      NOTE: the engine created for a `storage` specification is shared
+      (along with its connection pool) by all contexts in the process
+      that use the same specification; see
+      :func:`pysyncml.model.getEngine`. Private in-memory sqlite
+      databases are the exception and are never shared. Call
+      :meth:`close` when done to return the connection to the pool.
+
       NOTE: the storage driver **MUST** support cascading deletes;
       this is done automatically for connections created directly by
       pysyncml for mySQL and sqlite, but it is up to the calling
@@ -128,30 +138,105 @@ class Context(object):
     :param codec:
 
       specify the codec used to encode the SyncML commands - typically
-      either ``\'xml\'`` (the default) or ``\'wbxml\'``. It can also
-      be an object that implements the :class:`pysyncml.codec.Codec`
-      interface.
+      either ``\'xml\'`` (the default) or ``\'wbxml\'``. The
+      ``\'xml-writer\'`` codec also produces XML, but serializes it
+      directly to UTF-8 while the outgoing message is being built,
+      which is faster and more compact for non-ASCII content. It can
+      also be an object that implements the
+      :class:`pysyncml.codec.Codec` interface.
+
+    :param incremental:
+
+      if truthy, incoming SyncML messages are parsed incrementally:
+      each "Sync" sub-command is dispatched to the synchronizer (and
+      then released) as soon as it has been parsed, instead of only
+      after the entire message has been parsed. This keeps memory flat
+      for large incoming packages, but note that a malformed message
+      may then only be detected after some of its commands have been
+      applied. Defaults to ``False``.
+
+    :param compressMinSize:
+
+      the minimum size (in bytes) of an outgoing HTTP message body
+      for it to be compressed (with gzip or deflate, whichever is
+      preferred) when the peer has declared that it accepts compressed
+      messages. If ``None``, outgoing messages are never compressed.
+      Compressed incoming messages are always accepted. Defaults to
+      1024.
+
+    :param httpPoolSize:
+
+      the maximum number of (keep-alive) connections that are pooled
+      per remote peer. Defaults to 4.
+
+    :param httpTimeout:
+
+      the timeout (in seconds) for connecting to and receiving data
+      from remote peers. This can also be a (connect, read) tuple.
+      Defaults to ``None``, i.e. wait forever.
+
+    :param changeLog:
+
+      if truthy, changes registered with local stores are appended
+      once to a shared per-store change log instead of being copied
+      to every bound peer store. Each peer binding keeps a cursor into
+      the log and pulls the changes past it when it next synchronizes.
+      This reduces storage and writes from O(peers x changes) to
+      O(changes), which is primarily useful for servers with many
+      peers per owner. Defaults to ``False``.
+
+    :param sessionScope:
+
+      a callable that returns a hashable key identifying the current
+      scope (e.g. the current greenlet) -- each scope gets its own
+      storage session, and therefore its own adapter objects. Defaults
+      to ``None``, i.e. one session per thread. This makes a single
+      context safe to share between concurrent requests, as long as
+      each request calls :meth:`Adapter` (and uses the objects it
+      returns) within its own scope and then calls :meth:`close`.
+      Note that `router`, `protocol`, `synchronizer` and `codec`
+      objects passed to this constructor are shared by all scopes.
+
+    :param spoolDir:
+
+      the directory in which large objects that are received in chunks
+      are spooled until their last chunk arrives. The spool files are
+      referenced by the SyncML session, so servers that resume
+      sessions on other hosts must use a shared directory. Defaults to
+      ``None``, i.e. the system\'s temporary directory.
 
     '''
     self.autoCommit = autoCommit if autoCommit is not None else engine is None
+    # note: an :class:`AdapterPool` temporarily overrides the current
+    #       scope with that of the borrowed adapter.
+    self._scope = threading.local()
+    sessionScope = sessionScope or thread.get_ident
+    def scopefunc():
+      return getattr(self._scope, 'key', None) or sessionScope()
     self._model = model.createModel(
       engine     = engine,
       storage    = storage,
       prefix     = prefix,
       owner_id   = owner,
       context    = self,
+      scopefunc  = scopefunc,
       )
     self.router       = router
     self.protocol     = protocol
     self.synchronizer = synchronizer
     self.codec        = codec
-    for attr in dir(self._model):
-      if attr in ('DatabaseObject', 'RawDatabaseObject', 'Version', 'Adapter'):
+    self.incremental  = incremental
+    self.compressMinSize = compressMinSize
+    self.httpPoolSize = httpPoolSize
+    self.httpTimeout  = httpTimeout
+    self.changeLog    = changeLog
+    self.spoolDir     = spoolDir
+    # device ID => adapter ID of known peers (see `Adapter.getPeer`)
+    self._peerIDs     = dict()
+    for attr in self._model.classes:
+      if attr == 'Adapter':
         continue
-      value = getattr(self._model, attr)
-      if issubclass(value.__class__, sqlalchemy.ext.declarative.DeclarativeMeta) \
-         and value != self._model.DatabaseObject:
-        setattr(self, attr, value)
+      setattr(self, attr, getattr(self._model, attr))
 
   #----------------------------------------------------------------------------
   # TODO: add a method to delete all entries with a specific owner...
@@ -228,7 +313,8 @@ class Context(object):
     if isinstance(ret.codec, basestring):
       ret.codec = codec.Codec.factory(ret.codec)
     if ret.devID is not None:
-      peers = ret.getKnownPeers()
+      # note: only need to know if there is exactly one peer
+      peers = self._model.Adapter.q(isLocal=False).limit(2).all()
       if len(peers) == 1 and peers[0].url is not None:
         ret._peer = peers[0]
     return ret
@@ -284,15 +370,21 @@ class Context(object):
   #----------------------------------------------------------------------------
   @staticmethod
   def getAuthInfo(request, authorizer):
-    xtree = codec.Codec.autoDecode(request.headers['content-type'], request.body)
+    xtree = codec.Codec.decodeRequestHeader(request)
     return protocol.Protocol.getAuthInfo(xtree, None, authorizer)
 
   #----------------------------------------------------------------------------
   @staticmethod
   def getTargetID(request):
-    xtree = codec.Codec.autoDecode(request.headers['content-type'], request.body)
+    xtree = codec.Codec.decodeRequestHeader(request)
     return protocol.Protocol.getTargetID(xtree)
 
+  #----------------------------------------------------------------------------
+  @staticmethod
+  def getSourceID(request):
+    xtree = codec.Codec.decodeRequestHeader(request)
+    return protocol.Protocol.getSourceID(xtree)
+
   #----------------------------------------------------------------------------
   def save(self):
     # TODO: is this just here for the test classes?... might this be better
@@ -302,6 +394,141 @@ class Context(object):
       self._model.session.flush()
       self._model.session.commit()
 
+  #----------------------------------------------------------------------------
+  def close(self):
+    '''
+    Closes this context's storage session for the current scope (see
+    the `sessionScope` parameter), which returns its database
+    connection to the (shared) engine pool. Any uncommitted changes
+    are discarded.
+    '''
+    self._model.session.remove()
+
+#------------------------------------------------------------------------------
+class AdapterPool(object):
+  '''
+  A pool of `size` preconstructed local adapters of `context` (as
+  created by calling `factory`, which defaults to
+  :meth:`Context.Adapter`) that server requests can borrow, so that a
+  request does not need to reload the adapter, its device info and
+  stores, nor rebuild its router, protocol and synchronizer::
+
+    pool = pysyncml.AdapterPool(context, size=4)
+    ...
+    with pool.borrow() as adapter:
+      adapter.handleRequest(session, request, response)
+      context.save()
+
+  Each pooled adapter lives in its own storage session, which the
+  borrowing thread uses for the duration of the borrow. The current
+  peer and the negotiated routing state are kept in the SyncML
+  session, so any adapter can serve any request. When an adapter is
+  returned, uncommitted (even if flushed) changes are rolled back and
+  everything but the adapter\'s own objects (i.e. peers, changes,
+  mappings, etc.) is evicted from its session so that it is reloaded
+  by the next request.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, context, size=4, factory=None):
+    self.context = context
+    self.factory = factory or context.Adapter
+    self._slots  = Queue.Queue()
+    for idx in range(size):
+      self._slots.put(common.adict(
+        key=('pysyncml.pool', id(self), idx), adapter=None, pinned=None, active=False, dirty=False))
+
+  #----------------------------------------------------------------------------
+  @contextlib.contextmanager
+  def borrow(self):
+    '''
+    Returns a context manager that borrows an adapter from this pool
+    (blocking until one is available) and returns it when done.
+    '''
+    slot  = self._slots.get()
+    scope = self.context._scope
+    prev  = getattr(scope, 'key', None)
+    scope.key = slot.key
+    try:
+      if slot.adapter is None:
+        self._load(slot)
+      yield slot.adapter
+    finally:
+      try:
+        self._reset(slot)
+      finally:
+        scope.key = prev
+        self._slots.put(slot)
+
+  #----------------------------------------------------------------------------
+  def _load(self, slot):
+    # note: the adapter's own objects stay loaded across commits
+    session = self.context._model.session()
+    session.expire_on_commit = False
+    # track whether the session has an open transaction and whether any
+    # (possibly flushed) work was written in it that must be rolled back
+    def write(conn, cursor, statement, *args):
+      if not statement.lstrip().upper().startswith('SELECT'):
+        slot.dirty = True
+    def begin(session, transaction, connection):
+      slot.active = True
+      sqlalchemy.event.listen(connection, 'before_cursor_execute', write)
+    def end(*args):
+      slot.active = slot.dirty = False
+    sqlalchemy.event.listen(session, 'after_begin', begin)
+    sqlalchemy.event.listen(session, 'after_commit', end)
+    sqlalchemy.event.listen(session, 'after_rollback', end)
+    adapter = self.factory()
+    # note: saving here so that a newly created adapter survives the
+    #       rollback when it is first returned (see _reset())
+    self.context.save()
+    pinned  = [adapter, adapter.devinfo]
+    for store in adapter._stores:
+      pinned.append(store)
+      pinned.extend(store._contentTypes)
+    adapter._peer = None
+    slot.pinned   = set(obj for obj in pinned if obj is not None)
+    slot.adapter  = adapter
+
+  #----------------------------------------------------------------------------
+  def _reset(self, slot):
+    model   = self.context._model
+    session = model.session()
+    # note: a failed request may have written changes without committing
+    #       them. rolling back expires all objects, so it is only done if
+    #       needed; a read-only transaction is simply ended, which keeps
+    #       the adapter's own objects loaded.
+    if slot.dirty or session.new or session.dirty or session.deleted:
+      session.rollback()
+    elif slot.active:
+      session.commit()
+    model.changes.clear()
+    model.mappings.clear()
+    if slot.adapter is not None:
+      slot.adapter._peer = None
+    for obj in list(session):
+      # note: expunging cascades, so some objects may already be gone
+      if obj not in slot.pinned and obj in session:
+        session.expunge(obj)
+
+  #----------------------------------------------------------------------------
+  def close(self):
+    '''
+    Closes the storage sessions of all the pooled adapters, which must
+    all have been returned.
+    '''
+    scope = self.context._scope
+    prev  = getattr(scope, 'key', None)
+    try:
+      for idx in range(self._slots.qsize()):
+        slot = self._slots.get()
+        scope.key = slot.key
+        self.context._model.session.remove()
+        slot.adapter = slot.pinned = None
+        self._slots.put(slot)
+    finally:
+      scope.key = prev
+
 #------------------------------------------------------------------------------
 # end of $Id$
 #------------------------------------------------------------------------------
@@ -23,13 +23,13 @@
 The ``pysyncml.model`` module provides the data model for the SyncML adapter.
 '''
 
-import time, re, json, logging, sqlalchemy
-from sqlalchemy.orm import scoped_session, sessionmaker
+import time, re, json, logging, threading, weakref, sqlalchemy
+from sqlalchemy.orm import scoped_session, sessionmaker, object_session
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy import Column, Integer, Boolean, String, Text, ForeignKey
 from sqlalchemy.orm import relation, synonym, backref
 from .. import common, constants
-from . import adapter, devinfo, store, mapping
+from . import adapter, devinfo, store, mapping, migrate
 
 log = logging.getLogger(__name__)
 
@@ -40,6 +40,51 @@ def enableSqliteCascadingDeletes(engine):
   from sqlalchemy import event
   event.listen(engine, 'connect', onConnect)
 
+#------------------------------------------------------------------------------
+# note: engines created from a storage URL are shared by all contexts
+#       in the process that use the same URL, so that connections are
+#       pooled across contexts (and requests) instead of being opened
+#       for every new context. private in-memory sqlite databases are
+#       never shared, since that would also share their content.
+_engines     = dict()
+_enginesLock = threading.Lock()
+
+# the pool parameters of shared engines (see sqlalchemy.create_engine)
+enginePoolOptions = dict(pool_size=5, max_overflow=10, pool_recycle=3600)
+
+#------------------------------------------------------------------------------
+def isMemoryStorage(storage):
+  url = sqlalchemy.engine.url.make_url(storage)
+  return url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:')
+
+#------------------------------------------------------------------------------
+def getEngine(storage):
+  '''
+  Returns the process-wide (pooling) engine for the storage URL
+  `storage`, creating it on first use.
+  '''
+  if isMemoryStorage(storage):
+    return _createEngine(storage)
+  with _enginesLock:
+    if storage not in _engines:
+      _engines[storage] = _createEngine(storage, **enginePoolOptions)
+    return _engines[storage]
+
+#------------------------------------------------------------------------------
+def _createEngine(storage, **kw):
+  if not storage.startswith('sqlite'):
+    engine = sqlalchemy.create_engine(storage, **kw)
+  else:
+    if kw:
+      # note: sqlalchemy does not pool file-based sqlite connections by
+      #       default; pooled connections are only ever used by one
+      #       thread at a time, so the pysqlite thread check can go.
+      kw['poolclass']    = sqlalchemy.pool.QueuePool
+      kw['connect_args'] = dict(check_same_thread=False)
+    engine = sqlalchemy.create_engine(storage, **kw)
+    enableSqliteCascadingDeletes(engine)
+  return engine
+
 # TODO: look into making all backref's lazy... so that the full recursive
 #       loading of objects is not needed... see:
 #         http://docs.sqlalchemy.org/en/rel_0_7/orm/collections.html
@@ -47,38 +92,38 @@ def enableSqliteCascadingDeletes(engine):
 #       reloads for every message...
 
 #------------------------------------------------------------------------------
-def createModel(engine       = None,
-                storage      = 'sqlite:///:memory:',
-                prefix       = 'pysyncml',
-                sessionMaker = None,
-                owner_id     = None,
-                context      = None,
-                ):
-
-  if not re.match('^[a-z_]+$', prefix, re.IGNORECASE):
-    raise common.InvalidContext('invalid storage prefix "%s" - valid chars: alphabet and underscore'
-                                % (prefix,))
+# note: the model classes are generated (and the storage schema version is
+#       checked) only once per engine and prefix; the contexts then bind
+#       them to their own session and owner (see :class:`Model`).
+_schemas     = weakref.WeakKeyDictionary()
+_schemasLock = threading.Lock()
 
-  if engine is None:
-    log.debug('configuring pysyncml model to use storage "%s" with prefix "%s"', storage, prefix)
-    engine = sqlalchemy.create_engine(storage)
-    if engine.dialect.driver == 'pysqlite' or storage.startswith('sqlite://'):
-      enableSqliteCascadingDeletes(engine)
-  else:
-    log.debug('configuring pysyncml model to use engine %r with prefix "%s"', engine, prefix)
+#------------------------------------------------------------------------------
+class Schema(object):
+  '''
+  The model classes for a given storage prefix, which are shared by all
+  the contexts that use the same engine and prefix.
+  '''
+  version = 4
+  def __init__(self, prefix):
+    self.prefix = prefix
+    self.classes = []
 
-  # TODO: THIS IS INCORRECT! THE SESSION SHOULD NOT BE MADE HERE, BUT INSTEAD
-  #       WHEN A TRANSACTION BEGINS...
-  if sessionMaker is None:
-    session = sessionmaker(bind=engine)()
-  else:
-    # sessionMaker.configure(bind=engine)
-    session = sessionMaker()
+#------------------------------------------------------------------------------
+def getSchema(engine, prefix):
+  '''
+  Returns the (cached) :class:`Schema` for storage prefix `prefix` in
+  the database `engine`, creating the model classes and checking or
+  creating the storage tables on first use.
+  '''
+  with _schemasLock:
+    schemas = _schemas.setdefault(engine, dict())
+    if prefix not in schemas:
+      schemas[prefix] = _createSchema(engine, prefix)
+    return schemas[prefix]
 
-  # TODO: this needs to be made much more efficient... ie. it should create
-  #       the classes once, and have a "context" that will pre-populate the
-  #       .owner, instead of here where the classes are generated for every
-  #       request to the server (client-side, this is not so bad...).
+#------------------------------------------------------------------------------
+def _createSchema(engine, prefix):
 
   #------------------------------------------------------------------------------
   class DatabaseObject(object):
@@ -92,11 +137,17 @@ def createModel(engine       = None,
     id       = Column(Integer, autoincrement=True, primary_key=True)
     # TODO: make the owner_id read-only somehow...
     # TODO: make type(owner) configurable...
-    owner    = Column(Integer, default=owner_id)
-    _context = context
-    @classmethod
-    def q(cls, **kw):
-      return session.query(cls).filter_by(owner=owner_id).filter_by(**kw)
+    # note: the owner is set by the session when the object is flushed
+    owner    = Column(Integer)
+    @property
+    def _context(self):
+      context = self.__dict__.get('_boundContext')
+      if context is not None:
+        return context
+      session = object_session(self)
+      if session is None or 'pysyncml.context' not in session.info:
+        raise common.InternalError('%s object is not bound to a context' % (self.__class__.__name__,))
+      return session.info['pysyncml.context']
     def _setDefaults(self):
       # TODO: this seems like such a broken way of setting default values
       #       such that they are made available before a session.flush()...
@@ -115,44 +166,37 @@ def createModel(engine       = None,
                         if getattr(self, col.name) is not None])
       return ret + '>'
 
-  RawDatabaseObject = declarative_base()
-  DatabaseObject    = declarative_base(cls=DatabaseObject)
-  #----------------------------------------------------------------------------
-  class Model:
-
-    def __init__(self, engine, session):
-      self.RawDatabaseObject = RawDatabaseObject
-      self.DatabaseObject    = DatabaseObject
-      self.engine            = engine
-      self.prefix            = prefix
-      self.session           = session
-      self.version           = 1
-      self.context           = context
-
-    class Version(RawDatabaseObject):
-      __tablename__     = prefix + '_migrate'
-      repository_id     = Column(String(250), nullable=False, primary_key=True)
-      repository_path   = Column(Text)
-      version           = Column(Integer, default=None)
-
-    # class Route(DatabaseObject):
-    #   # note: these are "manual" routes - automatic routes do not get an
-    #   #       entry here, only a Binding (which manual routes also get)
-    #   adapter_id        = Column(Integer, ForeignKey('%s_adapter.id' % (prefix,),
-    #                                                  onupdate='CASCADE', ondelete='CASCADE'),
-    #                              nullable=False, index=True)
-    #   adapter           = relation('Adapter', backref=backref('routes', # order_by=id,
-    #                                                           cascade='all, delete-orphan',
-    #                                                           passive_deletes=True))
-
-    #   sourceUri         = Column(String(4095), nullable=True)
-    #   targetUri         = Column(String(4095), nullable=True)
-
-  model = Model(engine, session)
+  schema = Schema(prefix)
+  schema.RawDatabaseObject = declarative_base()
+  schema.DatabaseObject    = declarative_base(cls=DatabaseObject)
+
+  class Version(schema.RawDatabaseObject):
+    __tablename__     = prefix + '_migrate'
+    repository_id     = Column(String(250), nullable=False, primary_key=True)
+    repository_path   = Column(Text)
+    version           = Column(Integer, default=None)
+  schema.Version = Version
+
+  # class Route(DatabaseObject):
+  #   # note: these are "manual" routes - automatic routes do not get an
+  #   #       entry here, only a Binding (which manual routes also get)
+  #   adapter_id        = Column(Integer, ForeignKey('%s_adapter.id' % (prefix,),
+  #                                                  onupdate='CASCADE', ondelete='CASCADE'),
+  #                              nullable=False, index=True)
+  #   adapter           = relation('Adapter', backref=backref('routes', # order_by=id,
+  #                                                           cascade='all, delete-orphan',
+  #                                                           passive_deletes=True))
+
+  #   sourceUri         = Column(String(4095), nullable=True)
+  #   targetUri         = Column(String(4095), nullable=True)
 
   # TODO: there must be a way to "discover" packages...
   for module in (adapter, devinfo, store, mapping):
-    module.decorateModel(model)
+    module.decorateModel(schema)
+  for attr, value in vars(schema).items():
+    if isinstance(value, type) and value is not schema.DatabaseObject \
+       and issubclass(value, schema.DatabaseObject):
+      schema.classes.append(attr)
 
   # TODO: it would be *great* if i could use sqlalchemy-migrate for this...
   try:
@@ -177,16 +221,148 @@ def createModel(engine       = None,
     # TODO: delete tables first?...
     # TODO: this should be controllable by the invoking context...
     log.warn('pysyncml database migration table not found - assuming new and creating all')
-    RawDatabaseObject.metadata.create_all(model.engine)
-    DatabaseObject.metadata.create_all(model.engine)
-    version = model.Version(repository_id=prefix, repository_path='migration', version=model.version)
-    model.session.add(version)
-    model.session.flush()
-    model.session.commit()
-  elif version != model.version:
-    raise NotImplementedError('pysyncml database version out of sync and no upgrade path implemented')
-
-  return model
+    schema.RawDatabaseObject.metadata.create_all(engine)
+    schema.DatabaseObject.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add(Version(repository_id=prefix, repository_path='migration', version=schema.version))
+    session.commit()
+    session.close()
+  elif version != schema.version:
+    migrate.upgrade(engine, schema, version)
+
+  return schema
+
+#------------------------------------------------------------------------------
+class BoundClass(object):
+  '''
+  A model class bound to a :class:`Model`, i.e. to a context's session
+  and owner: its :meth:`q` only queries objects of that owner, and
+  objects that are created by calling it are bound to that context.
+  All other attributes are those of the model class.
+  '''
+  def __init__(self, model, cls):
+    self._model = model
+    self._class = cls
+  def __getattr__(self, key):
+    return getattr(self._class, key)
+  def __call__(self, *args, **kw):
+    ret = self._class.__new__(self._class)
+    # note: binding before initialization, since the initialization
+    #       may already need the context (e.g. to flush the session)
+    ret.__dict__['_boundContext'] = self._model.context
+    ret.__init__(*args, **kw)
+    return ret
+  def q(self, **kw):
+    # note: registered changes and new mappings are buffered, so they
+    #       need to be written out before they are queried.
+    if self is self._model.Change:
+      self._model.changes.flush()
+    elif self is self._model.Mapping:
+      self._model.mappings.flush()
+    return self._model.session.query(self._class) \
+      .filter_by(owner=self._model.owner).filter_by(**kw)
+  def get(self, id):
+    # note: served from the session's identity map if already loaded
+    ret = self._model.session.query(self._class).get(id)
+    if ret is None or ret.owner != self._model.owner:
+      return None
+    return ret
+
+#------------------------------------------------------------------------------
+class Model(object):
+  '''
+  A context's view of a :class:`Schema`, i.e. its model classes bound
+  (as :class:`BoundClass` objects) to the context's session and owner.
+
+  The `session` is a ``scoped_session``, i.e. every thread (or other
+  scope) transparently gets its own session, and the change and
+  mapping buffers are kept per session. Model objects (and therefore
+  adapters) must only be used in the scope that loaded them.
+  '''
+  def __init__(self, schema, engine, session, owner, context):
+    self.RawDatabaseObject = schema.RawDatabaseObject
+    self.DatabaseObject    = schema.DatabaseObject
+    self.Version           = schema.Version
+    self.engine            = engine
+    self.prefix            = schema.prefix
+    self.session           = session
+    self.owner             = owner
+    self.version           = schema.version
+    self.context           = context
+    self.classes           = schema.classes
+    for attr in schema.classes:
+      setattr(self, attr, BoundClass(self, getattr(schema, attr)))
+
+  @property
+  def changes(self):
+    return self._buffer('pysyncml.changes', store.ChangeBuffer)
+
+  @property
+  def mappings(self):
+    return self._buffer('pysyncml.mappings', mapping.MappingCache)
+
+  def _buffer(self, key, cls):
+    info = self.session.info
+    if key not in info:
+      info[key] = cls(self)
+    return info[key]
+
+#------------------------------------------------------------------------------
+def createModel(engine       = None,
+                storage      = 'sqlite:///:memory:',
+                prefix       = 'pysyncml',
+                sessionMaker = None,
+                owner_id     = None,
+                context      = None,
+                scopefunc    = None,
+                ):
+
+  if not re.match('^[a-z_]+$', prefix, re.IGNORECASE):
+    raise common.InvalidContext('invalid storage prefix "%s" - valid chars: alphabet and underscore'
+                                % (prefix,))
+
+  if engine is None:
+    log.debug('configuring pysyncml model to use storage "%s" with prefix "%s"', storage, prefix)
+    engine = getEngine(storage)
+  else:
+    log.debug('configuring pysyncml model to use engine %r with prefix "%s"', engine, prefix)
+
+  schema = getSchema(engine, prefix)
+
+  # note: sessions are created lazily, once per thread (or `scopefunc`
+  #       scope), so that a single context can serve concurrent requests.
+  if sessionMaker is None:
+    sessionMaker = sessionmaker(bind=engine)
+
+  # the owner and context are bound to the session (instead of to the
+  # model classes, which are shared)
+  from sqlalchemy import event
+  def setOwner(session, flush_context, instances):
+    for obj in session.new:
+      if isinstance(obj, schema.DatabaseObject) and obj.owner is None:
+        obj.owner = owner_id
+
+  # buffered changes and mappings are written out when the session is
+  # committed (and dropped when it is rolled back)
+  def flushBuffers(session):
+    for key in ('pysyncml.changes', 'pysyncml.mappings'):
+      if key in session.info:
+        session.info[key].flush()
+  def clearBuffers(session):
+    for key in ('pysyncml.changes', 'pysyncml.mappings'):
+      if key in session.info:
+        session.info[key].clear()
+
+  def makeSession():
+    session = sessionMaker()
+    session.info['pysyncml.context'] = context
+    event.listen(session, 'before_flush', setOwner)
+    event.listen(session, 'before_commit', flushBuffers)
+    event.listen(session, 'after_rollback', clearBuffers)
+    return session
+
+  return Model(schema, engine, scoped_session(makeSession, scopefunc=scopefunc),
+               owner_id, context)
 
 #------------------------------------------------------------------------------
 # end of $Id$
@@ -28,7 +28,7 @@ import sys, os, time, logging
 from sqlalchemy import orm
 from sqlalchemy import Column, Integer, Boolean, String, Text, ForeignKey
 from sqlalchemy.orm import relation, synonym, backref
-import requests
+import requests, requests.adapters
 from requests.structures import CaseInsensitiveDict as idict
 
 from .. import common, constants, codec, state
@@ -90,7 +90,7 @@ def decorateModel(model):
       if peer is self._peer:
         return
       if peer is not None and peer.id is None:
-        model.session.add(peer)
+        self._context._model.session.add(peer)
       self._peer = peer
 
     #--------------------------------------------------------------------------
@@ -112,7 +112,11 @@ def decorateModel(model):
     #--------------------------------------------------------------------------
     def _initHelpers(self):
       if not self.isLocal:
-        self._ckjar = idict()
+        # note: the HTTP session (which pools the connections to the
+        #       peer and keeps its cookies) is created on first use.
+        self._http = None
+        # the content-encoding that the peer accepts for requests
+        self._encoding = None
 
     #--------------------------------------------------------------------------
     def cleanUri(self, uri):
@@ -120,7 +124,29 @@ def decorateModel(model):
 
     #--------------------------------------------------------------------------
     def getKnownPeers(self):
-      return model.Adapter.q(isLocal=False).all()
+      return self._context._model.Adapter.q(isLocal=False).all()
+
+    #--------------------------------------------------------------------------
+    def getPeer(self, devID):
+      '''
+      Returns the known peer with device ID `devID`, or ``None`` if
+      there is no such peer. The peer\'s ID is cached by the context,
+      so that subsequent lookups are served by primary key (and
+      therefore usually from the session) instead of by query.
+      '''
+      context = self._context
+      Adapter = context._model.Adapter
+      peerID  = context._peerIDs.get(devID)
+      if peerID is not None:
+        peer = Adapter.get(peerID)
+        if peer is not None and peer.devID == devID and not peer.isLocal:
+          return peer
+      peer = Adapter.q(isLocal=False, devID=devID).first()
+      if peer is None:
+        context._peerIDs.pop(devID, None)
+        return None
+      context._peerIDs[devID] = peer.id
+      return peer
 
     #--------------------------------------------------------------------------
     def addStore(self, store):
@@ -138,7 +164,7 @@ def decorateModel(model):
     def _dbsave(self):
       # if model.context.autoCommit:
       #   model.session.commit()
-      model.context.save()
+      self._context.save()
 
     #--------------------------------------------------------------------------
     def sync(self, mode=constants.SYNCTYPE_AUTO):
@@ -199,7 +225,11 @@ def decorateModel(model):
 
       commands = self.protocol.initialize(self, session)
 
-      self._transmit(session, commands)
+      try:
+        self._transmit(session, commands)
+      finally:
+        # note: the session ends here, even if it failed mid-object
+        state.releaseSession(session)
       self._dbsave()
       return self._session2stats(session)
 
@@ -244,11 +274,11 @@ def decorateModel(model):
       xtree = self.protocol.commands2tree(self, session, commands)
       (request.contentType, request.body) = self.codec.encode(xtree)
 
-      # update the session with the last request commands so that
-      # when we receive the response package, it can be compared against
-      # that.
+      # update the session with (references to) the last request
+      # commands so that when we receive the response package, it can be
+      # compared against that.
       # TODO: should that only be done on successful transmit?...
-      session.lastCommands = commands
+      session.lastCommands = state.commandRefs(commands)
       if response is None:
         self.peer.handleRequest(session, request, adapter=self)
       else:
@@ -265,10 +295,17 @@ def decorateModel(model):
 
     #--------------------------------------------------------------------------
     def _handleRequestLocal(self, session, request, response=None):
+      if session.isServer and session.peerID is not None:
+        # note: the current peer is part of the session state, so that
+        #       any (e.g. pooled) adapter can resume the session.
+        self.peer = self.getPeer(session.peerID)
       commands = self._receive(session, request) or []
       log.debug('beginning negotiation of response to device "%s" (s%d.m%d)',
                 self.peer.devID, session.id, session.msgID)
-      if session.msgID > 20:
+      # note: messages that are part of a multi-message package (i.e. a
+      #       sync that is paged to honor MaxMsgSize) do not count towards
+      #       the runaway-conversation limit.
+      if session.msgID - ( session.partialMsgs or 0 ) > 20:
         log.error('too many client/server messages, pending commands: %r', commands)
         raise common.ProtocolError('too many client/server messages')
       self._transmit(session, commands, response)
@@ -276,25 +313,53 @@ def decorateModel(model):
         self._dbsave()
         return self._session2stats(session)
 
+    #----------------------------------------------------------------------------
+    def _getHttpSession(self):
+      '''
+      Returns the HTTP session that is used for all requests to this
+      (remote) peer, so that connections are kept alive and reused
+      across all the messages of all synchronizations with it.
+      '''
+      if self._http is None:
+        self._http = requests.Session()
+        pool = requests.adapters.HTTPAdapter(
+          pool_connections = 1,
+          pool_maxsize     = self._context.httpPoolSize)
+        self._http.mount('http://', pool)
+        self._http.mount('https://', pool)
+      return self._http
+
     #----------------------------------------------------------------------------
     def _handleRequestRemote(self, session, request, adapter):
-      res = requests.post(
+      headers = {
+        'content-type'    : request.contentType or 'application/vnd.syncml+xml',
+        'accept-encoding' : ', '.join(constants.ENCODINGS),
+        'x-syncml-client' : 'pysyncml/' + common.version,
+        }
+      body = request.body
+      # note: request bodies are only compressed once the peer has
+      #       declared (in a response) that it accepts that.
+      minSize = adapter._context.compressMinSize
+      if self._encoding is not None and minSize is not None and len(body) >= minSize:
+        body = common.compressContent(body, self._encoding)
+        headers['content-encoding'] = self._encoding
+      res = self._getHttpSession().post(
         session.respUri or self.url,
-        headers  = {
-          'content-type'    : request.contentType or 'application/vnd.syncml+xml',
-          'x-syncml-client' : 'pysyncml/' + common.version,
-          },
-        cookies  = self._ckjar,
-        data     = request.body,
+        headers  = headers,
+        data     = body,
+        timeout  = self._context.httpTimeout,
         )
       # TODO: improve this handling
       if res.status_code != 200:
         log.error('unexpected response: [%d] %s', res.status_code, res.reason)
         raise common.ProtocolError('error response: [%d] %s'
                                    % (res.status_code, res.reason))
-      self._ckjar.update(res.cookies)
+      self._encoding = common.negotiateEncoding(res.headers.get('accept-encoding'))
+      # note: `requests` has already decompressed the response body
+      headers = idict(res.headers)
+      headers.pop('content-encoding', None)
       adapter.handleRequest(session, state.Request(
-        body=res.content, headers=res.headers))
+        body=res.content, headers=headers))
 
     #--------------------------------------------------------------------------
     def _receive(self, session, request):
@@ -303,7 +368,7 @@ def decorateModel(model):
         session.nextMsgID
       else:
         session.lastCommands = session.lastCommands or []
-      xtree = codec.Codec.autoDecode(request.headers['content-type'], request.body)
+      xtree = codec.Codec.decodeRequest(request, incremental=self._context.incremental)
       return self.protocol.tree2commands(self, session, session.lastCommands, xtree)
 
     #----------------------------------------------------------------------------
@@ -27,18 +27,118 @@ stored only on the server-side.
 
 import sys, logging, inspect
 import xml.etree.ElementTree as ET
-from sqlalchemy import Column, Integer, Boolean, String, Text, ForeignKey
+from sqlalchemy import Column, Integer, Boolean, String, Text, ForeignKey, Index
 from sqlalchemy.orm import relation, synonym, backref
 from sqlalchemy.orm.exc import NoResultFound
 from .. import constants, common
 
 log = logging.getLogger(__name__)
 
+#------------------------------------------------------------------------------
+class MappingCache(object):
+  '''
+  Caches the GUID <=> LUID mappings of the peer stores of a model
+  (i.e. a context). The mappings of a store are loaded with a single
+  query when first needed and new mappings are written back in bulk
+  when the session is committed or when mappings are queried.
+  '''
+
+  CHUNK_SIZE = 500
+
+  #----------------------------------------------------------------------------
+  def __init__(self, model):
+    self.model  = model
+    # store ID => adict(guid2luid, luid2guid, dirty)
+    self.stores = dict()
+
+  #----------------------------------------------------------------------------
+  def _key(self, value):
+    if value is None or isinstance(value, basestring):
+      return value
+    return str(value)
+
+  #----------------------------------------------------------------------------
+  def _load(self, store):
+    if store.id is None:
+      self.model.session.flush()
+    ret = self.stores.get(store.id)
+    if ret is not None:
+      return ret
+    ret = common.adict(guid2luid=dict(), luid2guid=dict(), dirty=dict())
+    query = self.model.Mapping.q(store_id=store.id) \
+      .with_entities(self.model.Mapping.guid, self.model.Mapping.luid)
+    for guid, luid in query:
+      ret.guid2luid[guid] = luid
+      if luid is not None:
+        ret.luid2guid[luid] = guid
+    self.stores[store.id] = ret
+    return ret
+
+  #----------------------------------------------------------------------------
+  def getLuid(self, store, guid):
+    '''
+    Returns the LUID that `guid` is mapped to in peer store `store`,
+    or ``None`` if it is not mapped.
+    '''
+    return self._load(store).guid2luid.get(self._key(guid))
+
+  #----------------------------------------------------------------------------
+  def getGuid(self, store, luid):
+    '''
+    Returns the GUID that `luid` of peer store `store` is mapped to,
+    or ``None`` if it is not mapped.
+    '''
+    return self._load(store).luid2guid.get(self._key(luid))
+
+  #----------------------------------------------------------------------------
+  def setMapping(self, store, guid, luid):
+    '''
+    Maps `guid` to `luid` in peer store `store`, replacing any previous
+    mapping of `guid`.
+    '''
+    cache = self._load(store)
+    guid  = self._key(guid)
+    luid  = self._key(luid)
+    prev  = cache.guid2luid.get(guid)
+    if prev is not None and cache.luid2guid.get(prev) == guid:
+      del cache.luid2guid[prev]
+    cache.guid2luid[guid] = luid
+    if luid is not None:
+      cache.luid2guid[luid] = guid
+    cache.dirty[guid] = luid
+
+  #----------------------------------------------------------------------------
+  def flush(self):
+    # note: the dirty mappings are swapped out first since flushing
+    #       queries mappings, which in turn flushes the cache.
+    dirty = [(storeID, cache.dirty.items())
+             for storeID, cache in self.stores.items() if len(cache.dirty) > 0]
+    for cache in self.stores.values():
+      cache.dirty = dict()
+    Mapping = self.model.Mapping
+    for storeID, mappings in dirty:
+      for idx in range(0, len(mappings), self.CHUNK_SIZE):
+        guids = [guid for guid, luid in mappings[idx:idx + self.CHUNK_SIZE]]
+        Mapping.q(store_id=storeID).filter(Mapping.guid.in_(guids)) \
+          .delete(synchronize_session=False)
+      self.model.session.execute(Mapping.__table__.insert(), [
+        dict(owner=self.model.owner, store_id=storeID, guid=guid, luid=luid)
+        for guid, luid in mappings])
+
+  #----------------------------------------------------------------------------
+  def clear(self):
+    self.stores = dict()
+
 #------------------------------------------------------------------------------
 def decorateModel(model):
 
   #----------------------------------------------------------------------------
   class Mapping(model.DatabaseObject):
+    __table_args__ = (
+      Index('ix_%s_mapping_store_guid' % (model.prefix,), 'owner', 'store_id', 'guid'),
+      Index('ix_%s_mapping_store_luid' % (model.prefix,), 'owner', 'store_id', 'luid'),
+      model.DatabaseObject.__table_args__,
+      )
     store_id          = Column(Integer, ForeignKey('%s_store.id' % (model.prefix,),
                                                    onupdate='CASCADE', ondelete='CASCADE'),
                                nullable=False, index=True)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: metagriffin <mg.github@uberdev.org>
+# date: 2012/05/19
+# copy: (C) Copyright 2012-EOT metagriffin -- see LICENSE.txt
+#------------------------------------------------------------------------------
+# This software is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses/.
+#------------------------------------------------------------------------------
+
+'''
+The ``pysyncml.model.migrate`` module upgrades existing pysyncml
+storage to the current schema version (see
+:attr:`pysyncml.model.Schema.version`). Each migration upgrades the
+storage by one version and only performs additive, online changes,
+i.e. it creates tables, adds nullable columns and creates indexes.
+'''
+
+import logging
+import sqlalchemy
+from .. import common
+
+log = logging.getLogger(__name__)
+
+#------------------------------------------------------------------------------
+def createTable(conn, table):
+  table.create(bind=conn, checkfirst=True)
+
+#------------------------------------------------------------------------------
+def addColumn(conn, column):
+  '''
+  Adds `column` (which must be nullable) to its table if it does not
+  exist yet.
+  '''
+  table = column.table
+  if column.name in [col['name'] for col in sqlalchemy.inspect(conn).get_columns(table.name)]:
+    return
+  log.info('adding column "%s" to table "%s"', column.name, table.name)
+  prep = conn.dialect.identifier_preparer
+  conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+    prep.format_table(table), prep.format_column(column),
+    column.type.compile(dialect=conn.dialect)))
+
+#------------------------------------------------------------------------------
+def createIndex(conn, table, name):
+  '''
+  Creates the index named `name`, as declared on `table`, if it does
+  not exist yet.
+  '''
+  if name in [idx['name'] for idx in sqlalchemy.inspect(conn).get_indexes(table.name)]:
+    return
+  for index in table.indexes:
+    if index.name == name:
+      log.info('creating index "%s" on table "%s"', name, table.name)
+      index.create(bind=conn)
+      return
+  raise common.InternalError('no index "%s" declared on table "%s"' % (name, table.name))
+
+#------------------------------------------------------------------------------
+def initChangeCursors(conn, schema):
+  '''
+  Points the change log cursor of all bindings that do not have one
+  yet at the start of the log, so that they pull every logged change
+  (see :meth:`pysyncml.model.store.Store.pullChanges`).
+  '''
+  table = schema.Binding.__table__
+  conn.execute(table.update().where(table.c.changeCursor == None).values(changeCursor=0))
+
+#------------------------------------------------------------------------------
+def migrate_1_to_2(conn, schema):
+  # the shared change log and the binding reverse-lookup index
+  createTable(conn, schema.ChangeLog.__table__)
+  addColumn(conn, schema.Binding.__table__.c.changeCursor)
+  initChangeCursors(conn, schema)
+  createIndex(conn, schema.Binding.__table__, 'ix_%s_binding_uri' % (schema.prefix,))
+
+#------------------------------------------------------------------------------
+def migrate_2_to_3(conn, schema):
+  # owner-prefixed composite indexes for the change and mapping lookups
+  createIndex(conn, schema.Change.__table__, 'ix_%s_change_store_item' % (schema.prefix,))
+  createIndex(conn, schema.Mapping.__table__, 'ix_%s_mapping_store_guid' % (schema.prefix,))
+  createIndex(conn, schema.Mapping.__table__, 'ix_%s_mapping_store_luid' % (schema.prefix,))
+
+#------------------------------------------------------------------------------
+def migrate_3_to_4(conn, schema):
+  # the negotiated transmit content-type cached on the binding
+  addColumn(conn, schema.Binding.__table__.c.contentType)
+  addColumn(conn, schema.Binding.__table__.c.contentVersion)
+  # storage upgraded to version 2 before its cursors were initialized
+  initChangeCursors(conn, schema)
+
+#------------------------------------------------------------------------------
+# version => migration that upgrades storage from that version
+migrations = {
+  1: migrate_1_to_2,
+  2: migrate_2_to_3,
+  3: migrate_3_to_4,
+  }
+
+#------------------------------------------------------------------------------
+def upgrade(engine, schema, version):
+  '''
+  Upgrades the storage of `schema` in `engine` from schema version
+  `version` to the current version, one migration (and transaction)
+  at a time, so that an interrupted upgrade resumes where it stopped.
+  '''
+  if version > schema.version:
+    raise common.InvalidContext(
+      'pysyncml storage version %d is newer than the supported version %d'
+      % (version, schema.version))
+  table = schema.Version.__table__
+  while version < schema.version:
+    if version not in migrations:
+      raise common.InvalidContext(
+        'no upgrade path for pysyncml storage version %d' % (version,))
+    log.warn('upgrading pysyncml storage "%s" from version %d to %d',
+             schema.prefix, version, version + 1)
+    with engine.begin() as conn:
+      migrations[version](conn, schema)
+      conn.execute(table.update()
+                   .where(table.c.repository_id == schema.prefix)
+                   .values(version=version + 1))
+    version += 1
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
@@ -26,15 +26,120 @@ the datastore meta information and, if the datastore is local, an
 agent to execute data interactions.
 '''
 
-import sys, json, logging
+import sys, json, logging, collections, sqlalchemy
 import xml.etree.ElementTree as ET
-from sqlalchemy import Column, Integer, Boolean, String, Text, ForeignKey
+from sqlalchemy import Column, Integer, Boolean, String, Text, ForeignKey, Index
 from sqlalchemy.orm import relation, synonym, backref
 from sqlalchemy.orm.exc import NoResultFound
 from .. import common, constants, ctype
 
 log = logging.getLogger(__name__)
 
+#------------------------------------------------------------------------------
+class ChangeBuffer(object):
+  '''
+  Buffers the changes that are registered with the local stores of a
+  model (i.e. a context) and writes them to the database in bulk when
+  the session is committed or when changes are queried.
+
+  Repeated changes to the same item are coalesced, i.e. an addition
+  followed by a modification remains an addition, an addition followed
+  by a deletion cancels out, and changeSpecs are concatenated. Changes
+  that exclude different peers are kept in separate groups, which are
+  written in the order in which they were registered, so that the
+  changes to an item are always applied in call order.
+
+  The buffer also collects the pending changes of peer stores that
+  have been settled (i.e. acknowledged by the peer), which are then
+  deleted with one statement per store and state.
+  '''
+
+  CHUNK_SIZE = 500
+
+  #----------------------------------------------------------------------------
+  def __init__(self, model):
+    self.model  = model
+    self.clear()
+
+  #----------------------------------------------------------------------------
+  def __len__(self):
+    return sum([len(changes) for key, store, changes in self.groups])
+
+  #----------------------------------------------------------------------------
+  def register(self, store, itemID, state, changeSpec=None, excludePeerID=None):
+    key = (store.uri, excludePeerID)
+    idx = self._latest.get(key)
+    # note: a change can only be coalesced into its group if no later
+    #       group (i.e. with a different exclusion) touched the item
+    if idx is None or self._touched.get((store.uri, itemID), -1) > idx:
+      idx = len(self.groups)
+      self.groups.append((key, store, collections.OrderedDict()))
+      self._latest[key] = idx
+    changes = self.groups[idx][2]
+    changes[itemID] = self.coalesce(changes.get(itemID), state, changeSpec)
+    self._touched[(store.uri, itemID)] = idx
+
+  #----------------------------------------------------------------------------
+  def coalesce(self, previous, state, changeSpec):
+    if previous is None:
+      return (state, changeSpec)
+    pstate, pspec = previous
+    if changeSpec is not None:
+      if pspec is None:
+        changeSpec = None
+      else:
+        changeSpec = pspec + ';' + changeSpec
+        if len(changeSpec) > self.model.Change.__table__.c.changeSpec.type.length:
+          changeSpec = None
+    if pstate == constants.ITEM_ADDED:
+      if state == constants.ITEM_MODIFIED:
+        return (constants.ITEM_ADDED, changeSpec)
+      if state == constants.ITEM_DELETED:
+        # note: the item may be unknown to the peers, but pending
+        #       changes (from a previous flush) must still be dropped.
+        return (None, None)
+    if pstate == constants.ITEM_DELETED and state == constants.ITEM_ADDED:
+      return (constants.ITEM_MODIFIED, None)
+    return (state, changeSpec)
+
+  #----------------------------------------------------------------------------
+  def settle(self, store, itemID, state):
+    '''
+    Queues the deletion of the pending change with state `state` of
+    item `itemID` in peer store `store`.
+    '''
+    if store.id is None:
+      self.model.session.flush()
+    self.settled.setdefault((store.id, state), set()).add(str(itemID))
+
+  #----------------------------------------------------------------------------
+  def flush(self):
+    # note: the buffer is swapped out first since flushing queries
+    #       changes, which in turn flushes the buffer.
+    groups, settled = self.groups, self.settled
+    self.clear()
+    Change = self.model.Change
+    for (storeID, state), itemIDs in settled.items():
+      itemIDs = list(itemIDs)
+      for idx in range(0, len(itemIDs), self.CHUNK_SIZE):
+        Change.q(store_id=storeID, state=state) \
+          .filter(Change.itemID.in_(itemIDs[idx:idx + self.CHUNK_SIZE])) \
+          .delete(synchronize_session=False)
+    for (uri, excludePeerID), store, changes in groups:
+      store._flushChanges(
+        [(itemID,) + change for itemID, change in changes.items()], excludePeerID)
+
+  #----------------------------------------------------------------------------
+  def clear(self):
+    # [((uri, excludePeerID), store, {itemID: (state, changeSpec)})]
+    self.groups   = []
+    # (uri, excludePeerID) => index of its latest group
+    self._latest  = dict()
+    # (uri, itemID) => index of the latest group that changed the item
+    self._touched = dict()
+    # (storeID, state) => set(itemID)
+    self.settled  = dict()
+
 #------------------------------------------------------------------------------
 def decorateModel(model):
 
@@ -141,6 +246,14 @@ def decorateModel(model):
         raise common.InternalError('unexpected merging of stores with different URIs (%s != %s)'
                                    % (self.uri, store.uri))
       self.displayName   = store.displayName
+      if self.adapter is not None and self.adapter.isLocal \
+          and [str(ct) for ct in self.contentTypes or []] \
+          != [str(ct) for ct in store.contentTypes or []]:
+        # the peer stores bound to this store must re-negotiate their
+        # transmit content-type (see Router.getBestTransmitContentType)
+        self._context._model.Binding.q(uri=self.uri) \
+          .update({model.Binding.contentType: None, model.Binding.contentVersion: None},
+                  synchronize_session='fetch')
       if cmp(self._contentTypes, store._contentTypes) != 0:
         # todo: this is a bit drastic... perhaps have an operational setting
         #       which controls how paranoid to be?...
@@ -152,59 +265,255 @@ def decorateModel(model):
       self.agent         = store.agent
       return self
 
+    #----------------------------------------------------------------------------
+    def _queryPeerStoreIDs(self, excludePeerID=None):
+      '''
+      Returns a query that selects the IDs of all the peer (i.e. remote)
+      stores that are bound to this local store, optionally excluding
+      the stores of peer `excludePeerID`. This is resolved entirely in
+      the database via the indexed `Binding.uri` reverse lookup.
+      '''
+      cmodel = self._context._model
+      query = cmodel.session.query(model.Binding.store_id) \
+        .join(model.Store, model.Store.id == model.Binding.store_id) \
+        .join(model.Adapter, model.Adapter.id == model.Store.adapter_id) \
+        .filter(model.Binding.uri == self.uri,
+                model.Binding.owner == cmodel.owner,
+                model.Adapter.isLocal == False,
+                model.Adapter.owner == cmodel.owner)
+      if excludePeerID is not None:
+        query = query.filter(model.Adapter.id != excludePeerID)
+      return query
+
     #----------------------------------------------------------------------------
     def clearChanges(self):
+      cmodel = self._context._model
       if self.adapter.isLocal:
-        # TODO: THIS NEEDS TO BE SIGNIFICANTLY OPTIMIZED!... either:
-        #         a) optimize this reverse lookup, or
-        #         b) use a query that targets exactly the set of stores needed
-        #       note that a pre-emptive model.session.flush() may be necessary.
-        for peer in self.adapter.getKnownPeers():
-          for store in peer._stores:
-            if store.binding is not None and store.binding.uri == self.uri:
-              store.clearChanges()
+        peerIDs = self._queryPeerStoreIDs().subquery()
+        cmodel.Change.q().filter(model.Change.store_id.in_(peerIDs)) \
+          .delete(synchronize_session='fetch')
+        # note: the log entries are skipped (instead of deleted) to keep
+        #       the log sequence intact (see pullChanges())
+        head = cmodel.session.query(sqlalchemy.func.max(model.ChangeLog.id)).scalar()
+        if head is not None:
+          cmodel.Binding.q(uri=self.uri) \
+            .filter(model.Binding.changeCursor != None) \
+            .update({model.Binding.changeCursor: head}, synchronize_session='fetch')
         return
       if self.id is None:
-        model.session.flush()
-      model.Change.q(store_id=self.id).delete()
+        cmodel.session.flush()
+      cmodel.Change.q(store_id=self.id).delete()
 
     #----------------------------------------------------------------------------
     def registerChange(self, itemID, state, changeSpec=None, excludePeerID=None):
       if self.adapter.isLocal:
-        # TODO: THIS NEEDS TO BE SIGNIFICANTLY OPTIMIZED!... either:
-        #         a) optimize this reverse lookup, or
-        #         b) use a query that targets exactly the set of stores needed
-        #       note that a pre-emptive model.session.flush() may be necessary.
-        for peer in self.adapter.getKnownPeers():
-          if excludePeerID is not None and peer.id == excludePeerID:
-            continue
-          for store in peer._stores:
-            if store.binding is not None and store.binding.uri == self.uri:
-              store.registerChange(itemID, state, changeSpec=changeSpec)
+        self._context._model.changes.register(
+          self, str(itemID), state, changeSpec, excludePeerID)
         return
+      cmodel = self._context._model
       if self.id is None:
-        model.session.flush()
+        cmodel.session.flush()
       itemID = str(itemID)
       change = None
       if changeSpec is not None:
         try:
-          change = model.Change.q(store_id=self.id, itemID=itemID).one()
+          change = cmodel.Change.q(store_id=self.id, itemID=itemID).one()
           change.state = state
           if change.changeSpec is not None:
             change.changeSpec += ';' + changeSpec
-            if len(change.changeSpec) > model.Change.c.changeSpec.type.length:
+            if len(change.changeSpec) > model.Change.__table__.c.changeSpec.type.length:
               change.changeSpec = None
         except NoResultFound:
           change = None
       if change is None:
-        model.Change.q(store_id=self.id, itemID=itemID).delete()
-        change = model.Change(store_id=self.id, itemID=itemID,
-                              state=state, changeSpec=changeSpec)
-        model.session.add(change)
+        cmodel.Change.q(store_id=self.id, itemID=itemID).delete()
+        change = cmodel.Change(store_id=self.id, itemID=itemID,
+                               state=state, changeSpec=changeSpec)
+        cmodel.session.add(change)
+
+    #----------------------------------------------------------------------------
+    def _flushChanges(self, changes, excludePeerID):
+      # writes buffered local `changes` (see ChangeBuffer) either to the
+      # shared change log of this store or to all bound peer stores.
+      if self._context.changeLog:
+        self._appendChangeLog(changes, excludePeerID)
+      else:
+        self._flushPeerChanges(changes, excludePeerID)
+
+    #----------------------------------------------------------------------------
+    def _appendChangeLog(self, changes, excludePeerID):
+      # appends the local `changes` to this store's change log, i.e. one
+      # row per change independent of the number of peers. the peers
+      # pull them into their pending changes when they next synchronize
+      # (see pullChanges()).
+      cmodel = self._context._model
+      if self.id is None:
+        cmodel.session.flush()
+      registered = common.ts()
+      rows = [dict(store_id=self.id, owner=cmodel.owner, peer_id=excludePeerID,
+                   itemID=itemID, state=state, registered=registered,
+                   changeSpec=changeSpec)
+              for itemID, state, changeSpec in changes]
+      if len(rows) > 0:
+        cmodel.session.execute(model.ChangeLog.__table__.insert(), rows)
+
+    #----------------------------------------------------------------------------
+    def _queryChangeLog(self):
+      # returns a query for the change log entries of the local store(s)
+      # that this (peer) store is bound to.
+      return self._context._model.ChangeLog.q() \
+        .join(model.Store, model.Store.id == model.ChangeLog.store_id) \
+        .filter(model.Store.uri == self.binding.uri)
+
+    #----------------------------------------------------------------------------
+    def pullChanges(self):
+      '''
+      Merges the changes that were appended to the change log of the
+      local store bound to this (peer) store since the binding's cursor
+      into this store's pending changes, and advances the cursor. Log
+      entries that have been pulled by all peers are then discarded.
+      '''
+      if not self._context.changeLog or self.adapter.isLocal or self.binding is None:
+        return
+      cmodel  = self._context._model
+      binding = self.binding
+      cmodel.changes.flush()
+      entries = self._queryChangeLog()
+      if binding.changeCursor is None:
+        if binding.sourceAnchor is None and binding.targetAnchor is None:
+          # a new binding only needs changes from here on, since the
+          # initial synchronization is a full one
+          binding.changeCursor = binding._changeLogHead()
+          return
+        # note: a binding that has already synchronized (e.g. one that
+        #       predates the change log) must never skip logged changes
+        binding.changeCursor = 0
+      entries = entries \
+        .filter(model.ChangeLog.id > binding.changeCursor) \
+        .order_by(model.ChangeLog.id) \
+        .with_entities(model.ChangeLog.id, model.ChangeLog.peer_id, model.ChangeLog.itemID,
+                       model.ChangeLog.state, model.ChangeLog.changeSpec)
+      cursor  = binding.changeCursor
+      changes = collections.OrderedDict()
+      for seq, peerID, itemID, state, changeSpec in entries.yield_per(ChangeBuffer.CHUNK_SIZE):
+        cursor = seq
+        if peerID is not None and peerID == self.adapter_id:
+          continue
+        changes[itemID] = cmodel.changes.coalesce(changes.get(itemID), state, changeSpec)
+      if cursor == binding.changeCursor:
+        return
+      changes  = changes.items()
+      registered = common.ts()
+      for idx in range(0, len(changes), ChangeBuffer.CHUNK_SIZE):
+        chunk   = changes[idx:idx + ChangeBuffer.CHUNK_SIZE]
+        pending = cmodel.Change.q(store_id=self.id) \
+          .filter(model.Change.itemID.in_([itemID for itemID, change in chunk]))
+        current = dict([(chg.itemID, (chg.state, chg.changeSpec)) for chg in pending])
+        pending.delete(synchronize_session='fetch')
+        rows = []
+        for itemID, (state, changeSpec) in chunk:
+          if itemID in current:
+            state, changeSpec = cmodel.changes.coalesce(current[itemID], state, changeSpec)
+          if state is None:
+            continue
+          rows.append(dict(store_id=self.id, owner=cmodel.owner, itemID=itemID,
+                           state=state, registered=registered, changeSpec=changeSpec))
+        if len(rows) > 0:
+          cmodel.session.execute(model.Change.__table__.insert(), rows)
+      binding.changeCursor = cursor
+      cmodel.session.flush()
+      # discard the entries that all bound peers have pulled. note that
+      # the entry at the cursor is kept so that the log is never emptied,
+      # since some databases (e.g. sqlite) would then re-use its IDs.
+      # note: bindings without a cursor have not pulled anything yet
+      mincursor = cmodel.session.query(
+        sqlalchemy.func.min(sqlalchemy.func.coalesce(model.Binding.changeCursor, 0))) \
+        .filter(model.Binding.uri == binding.uri,
+                model.Binding.owner == cmodel.owner).scalar()
+      if mincursor is not None:
+        stores = cmodel.session.query(model.Store.id).filter(
+          model.Store.uri == binding.uri, model.Store.owner == cmodel.owner)
+        cmodel.ChangeLog.q() \
+          .filter(model.ChangeLog.id < mincursor,
+                  model.ChangeLog.store_id.in_(stores.subquery())) \
+          .delete(synchronize_session=False)
+
+    #----------------------------------------------------------------------------
+    def _flushPeerChanges(self, changes, excludePeerID):
+      # writes the local `changes`, a list of (itemID, state, changeSpec)
+      # tuples, to all bound peer stores using set-based statements,
+      # i.e. the number of queries issued depends neither on the number
+      # of peers nor (other than by chunk) on the number of changes. the
+      # semantics mirror the per-store logic in
+      # registerChange(): pending changes are merged if a changeSpec is
+      # provided, otherwise they are replaced. a `state` of ``None``
+      # only drops pending changes.
+      cmodel   = self._context._model
+      peerIDs  = self._queryPeerStoreIDs(excludePeerID)
+      storeIDs = [row[0] for row in peerIDs]
+      if len(storeIDs) <= 0:
+        return
+      replace  = [chg for chg in changes if chg[2] is None]
+      for idx in range(0, len(replace), ChangeBuffer.CHUNK_SIZE):
+        itemIDs = [chg[0] for chg in replace[idx:idx + ChangeBuffer.CHUNK_SIZE]]
+        cmodel.Change.q() \
+          .filter(model.Change.store_id.in_(peerIDs.subquery()),
+                  model.Change.itemID.in_(itemIDs)) \
+          .delete(synchronize_session='fetch')
+      registered = common.ts()
+      rows = [dict(store_id=storeID, owner=cmodel.owner, itemID=itemID,
+                   state=state, registered=registered, changeSpec=None)
+              for itemID, state, changeSpec in replace if state is not None
+              for storeID in storeIDs]
+      if len(rows) > 0:
+        cmodel.session.flush()
+        cmodel.session.execute(model.Change.__table__.insert(), rows)
+      merge = [chg for chg in changes if chg[2] is not None]
+      for idx in range(0, len(merge), ChangeBuffer.CHUNK_SIZE):
+        self._mergePeerChanges(peerIDs, storeIDs, merge[idx:idx + ChangeBuffer.CHUNK_SIZE])
+
+    #----------------------------------------------------------------------------
+    def _mergePeerChanges(self, peerIDs, storeIDs, changes):
+      # merges the `changes` that have a changeSpec into the pending
+      # changes of the peer stores `storeIDs` (selected by `peerIDs`).
+      # the changeSpecs are concatenated here (and dropped if they get
+      # too long), so that the merged changes can replace the pending
+      # ones with one DELETE and one multi-row INSERT.
+      cmodel  = self._context._model
+      table   = model.Change.__table__
+      itemIDs = [chg[0] for chg in changes]
+      current = cmodel.Change.q() \
+        .filter(model.Change.store_id.in_(peerIDs.subquery()),
+                model.Change.itemID.in_(itemIDs))
+      pending = dict()
+      for storeID, itemID, registered, changeSpec in current.with_entities(
+          model.Change.store_id, model.Change.itemID,
+          model.Change.registered, model.Change.changeSpec):
+        pending[(storeID, itemID)] = (registered, changeSpec)
+      if len(pending) > 0:
+        current.delete(synchronize_session='fetch')
+      now  = common.ts()
+      rows = []
+      for itemID, state, changeSpec in changes:
+        for storeID in storeIDs:
+          if (storeID, itemID) not in pending:
+            registered, spec = now, changeSpec
+          else:
+            registered, spec = pending[(storeID, itemID)]
+            # note: a pending change without a changeSpec stays without
+            if spec is not None:
+              spec += ';' + changeSpec
+              if len(spec) > table.c.changeSpec.type.length:
+                spec = None
+          rows.append(dict(store_id=storeID, owner=cmodel.owner, itemID=itemID,
+                           state=state, registered=registered, changeSpec=spec))
+      cmodel.session.flush()
+      cmodel.session.execute(table.insert(), rows)
 
     #--------------------------------------------------------------------------
     def getRegisteredChanges(self):
-      return model.Change.q(store_id=self.id)
+      self.pullChanges()
+      return self._context._model.Change.q(store_id=self.id)
 
     #----------------------------------------------------------------------------
     def describe(self, s1):
@@ -340,16 +649,35 @@ def decorateModel(model):
     # todo: this uri *could* be replaced by an actual reference to the Store object...
     #       and then the getSourceStore() method can go away...
     #       *BUT* this would require a one-to-many Adapter<=>Adapter relationship...
-    uri               = Column(String(4095), nullable=True)
+    uri               = Column(String(4095), nullable=True, index=True)
     autoMapped        = Column(Boolean)
     sourceAnchor      = Column(String(4095), nullable=True)
     targetAnchor      = Column(String(4095), nullable=True)
+    changeCursor      = Column(Integer, nullable=True)  # note: last pulled ChangeLog.id
+    # note: the negotiated transmit content-type and version (see
+    #       Router.getBestTransmitContentType); NULL means not negotiated yet.
+    contentType       = Column(String(4095), nullable=True)
+    contentVersion    = Column(String(255), nullable=True)
 
     def getSourceStore(self, adapter):
       return adapter.stores[self.uri]
 
+    def _changeLogHead(self):
+      # returns the ID of the last change log entry of the local store(s)
+      # that this binding refers to, or 0 if there is none.
+      cmodel = self._context._model
+      return cmodel.session.query(sqlalchemy.func.max(model.ChangeLog.id)) \
+        .join(model.Store, model.Store.id == model.ChangeLog.store_id) \
+        .filter(model.Store.uri == self.uri,
+                model.Store.owner == cmodel.owner,
+                model.ChangeLog.owner == cmodel.owner).scalar() or 0
+
   #----------------------------------------------------------------------------
   class Change(model.DatabaseObject):
+    __table_args__ = (
+      Index('ix_%s_change_store_item' % (model.prefix,), 'owner', 'store_id', 'itemID', 'state'),
+      model.DatabaseObject.__table_args__,
+      )
     store_id          = Column(Integer, ForeignKey('%s_store.id' % (model.prefix,),
                                                    onupdate='CASCADE', ondelete='CASCADE'),
                                nullable=False, index=True)
@@ -361,10 +689,22 @@ def decorateModel(model):
     registered        = Column(Integer, default=common.ts)
     changeSpec        = Column(String(4095))
 
+  class ChangeLog(model.DatabaseObject):
+    # note: the `id` is the sequence number of the change in the log.
+    store_id          = Column(Integer, ForeignKey('%s_store.id' % (model.prefix,),
+                                                   onupdate='CASCADE', ondelete='CASCADE'),
+                               nullable=False, index=True)
+    peer_id           = Column(Integer)   # note: the peer that is excluded, if any
+    itemID            = Column(String(4095), nullable=False)
+    state             = Column(Integer)   # note: NULL only drops pending changes
+    registered        = Column(Integer, default=common.ts)
+    changeSpec        = Column(String(4095))
+
   model.Store           = Store
   model.ContentTypeInfo = ContentTypeInfo
   model.Binding         = Binding
   model.Change          = Change
+  model.ChangeLog       = ChangeLog
 
 #------------------------------------------------------------------------------
 # end of $Id$
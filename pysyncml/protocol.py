@@ -24,12 +24,24 @@ The ``pysyncml.protocol`` is an internal package that does all of the actual
 "work" for the SyncML Adapter.
 '''
 
-import sys, time, base64, logging, traceback
+import sys, os, time, base64, codecs, tempfile, logging, traceback
 import xml.etree.ElementTree as ET
 from . import common, constants, state
+from .codec import iterchildren
 
 log = logging.getLogger(__name__)
 
+# the following are used to estimate the rendered size of commands so
+# that outgoing messages can be kept under the peer's MaxMsgSize
+MSG_SIZE_RESERVE    = 1024
+CMD_SIZE_OVERHEAD   = 64
+FIELD_SIZE_OVERHEAD = 32
+
+# outgoing messages are kept under this size even if the peer accepts
+# larger ones (or has not declared a MaxMsgSize), so that the sync
+# commands are paged, i.e. only one message worth is held in memory
+MAX_MSG_SIZE        = 1048576
+
 #------------------------------------------------------------------------------
 def badStatus(xnode):
   code  = xnode.findtext('Data')
@@ -75,6 +87,12 @@ class Protocol(object):
       return authorizer.authorize(uri, data)
     raise common.UnknownAuthType('unknown/unimplemented auth type "%s"' % (authtype,))
 
+  #----------------------------------------------------------------------------
+  @staticmethod
+  def getSourceID(xtree):
+    assert xtree.tag == 'SyncML'
+    return xtree.findtext('SyncHdr/Source/LocURI')
+
   #----------------------------------------------------------------------------
   @staticmethod
   def getTargetID(xtree):
@@ -104,13 +122,12 @@ class Protocol(object):
       session.id     = int(xhdr.findtext('SessionID'))
       session.msgID  = int(xhdr.findtext('MsgID'))
       if adapter.peer is None or adapter.peer.devID != peerID:
-        for peer in adapter.getKnownPeers():
-          # TODO: i should delete unused peers here... ie. anything that
-          #       hasn't been used in some configurable number of seconds,
-          #       which should probably default to something like a month.
-          if peer.devID == peerID:
-            adapter.peer = peer
-            break
+        # TODO: i should delete unused peers somewhere... ie. anything that
+        #       hasn't been used in some configurable number of seconds,
+        #       which should probably default to something like a month.
+        peer = adapter.getPeer(peerID)
+        if peer is not None:
+          adapter.peer = peer
         else:
           log.info('registering new peer "%s"' % (peerID,))
           peer = adapter._context._model.Adapter(devID=peerID, isLocal=False)
@@ -137,10 +154,52 @@ class Protocol(object):
       #       idea being, if two "client" peers are communicating in
       #       the event of server unavailability, then they may need
       #       to know each-others limitations...
-      cmd.maxMsgSize = common.getMaxMemorySize(adapter.context)
-      cmd.maxObjSize = common.getMaxMemorySize(adapter.context)
+      cmd.maxMsgSize = adapter.maxMsgSize or common.getMaxMemorySize(adapter.context)
+      cmd.maxObjSize = adapter.maxObjSize or common.getMaxMemorySize(adapter.context)
     return [cmd]
 
+  #----------------------------------------------------------------------------
+  def estimateSize(self, command):
+    '''
+    Returns a rough (and generally pessimistic) estimate of the number
+    of bytes that `command` will occupy once it has been rendered into
+    a SyncML message. This is used to page outgoing "Sync" commands
+    across multiple messages so as to honor the peer's MaxMsgSize.
+    '''
+    ret = CMD_SIZE_OVERHEAD
+    for key, value in command.items():
+      if value is None:
+        continue
+      if isinstance(value, basestring):
+        ret += FIELD_SIZE_OVERHEAD + self._textSize(value)
+      elif isinstance(value, list):
+        ret += sum([self.estimateSize(e) for e in value])
+      elif ET.iselement(value):
+        ret += len(ET.tostring(value))
+      else:
+        ret += FIELD_SIZE_OVERHEAD + len(str(value))
+    return ret
+
+  #----------------------------------------------------------------------------
+  def _textSize(self, value):
+    # note: this accounts for XML escaping and for non-ASCII characters
+    #       being rendered as character references (as the XML codec does)
+    ret = 4 * value.count('&') + 3 * ( value.count('<') + value.count('>') )
+    if isinstance(value, unicode):
+      value = value.encode('ascii', 'xmlcharrefreplace')
+    return ret + len(value)
+
+  #----------------------------------------------------------------------------
+  def getMessageSpace(self, adapter, session, commands):
+    '''
+    Returns the estimated number of bytes that are still available in
+    the message being built from `commands` before the peer's
+    MaxMsgSize (capped at `MAX_MSG_SIZE`) is reached.
+    '''
+    maxMsgSize = min(adapter.peer.maxMsgSize or MAX_MSG_SIZE, MAX_MSG_SIZE)
+    return maxMsgSize - MSG_SIZE_RESERVE \
+      - sum([self.estimateSize(cmd) for cmd in commands])
+
   #----------------------------------------------------------------------------
   def negotiate(self, adapter, session, commands):
 
@@ -175,14 +234,25 @@ class Protocol(object):
         ))
     else:
       log.debug('have peer.devinfo - not requesting from target')
+      session.msgSpace = self.getMessageSpace(adapter, session, commands)
       commands += adapter.synchronizer.actions(adapter, session) or []
+      session.msgSpace = None
+      # if any datastore still has pending sync commands, this message
+      # is not final: the peer will respond with an "Alert 222" (next
+      # message) and the remainder will be sent then.
+      for ds in session.dsstates.values():
+        if ds.sendCursor is not None:
+          return commands
 
     commands.append(state.Command(name=constants.CMD_FINAL))
     return commands
 
   #----------------------------------------------------------------------------
   def commands2tree(self, adapter, session, commands):
-    '''Consumes state.Command commands and converts them to an ET protocol tree'''
+    '''
+    Consumes state.Command commands and converts them to a protocol
+    tree (an ET protocol tree for all but streaming codecs)
+    '''
 
     # todo: trap errors...
 
@@ -196,178 +266,185 @@ class Protocol(object):
     if hdrcmd.version != constants.SYNCML_VERSION_1_2:
       raise common.FeatureNotSupported('unsupported SyncML version "%s"' % (hdrcmd.version,))
 
-    xsync = ET.Element(constants.NODE_SYNCML)
-    xhdr  = ET.SubElement(xsync, hdrcmd.name)
+    # note: the document is built via the codec so that codecs can
+    #       serialize it while it is being built (see XmlWriterCodec)
+    codec = adapter.codec
+    xsync = codec.Element(constants.NODE_SYNCML)
+    xhdr  = codec.SubElement(xsync, hdrcmd.name)
     if hdrcmd.version == constants.SYNCML_VERSION_1_2:
-      ET.SubElement(xhdr, 'VerDTD').text = constants.SYNCML_DTD_VERSION_1_2
-      ET.SubElement(xhdr, 'VerProto').text = hdrcmd.version
+      codec.SubElement(xhdr, 'VerDTD').text = constants.SYNCML_DTD_VERSION_1_2
+      codec.SubElement(xhdr, 'VerProto').text = hdrcmd.version
 
-    ET.SubElement(xhdr, 'SessionID').text = hdrcmd.sessionID
-    ET.SubElement(xhdr, 'MsgID').text = hdrcmd.msgID
-    xsrc = ET.SubElement(xhdr, 'Source')
-    ET.SubElement(xsrc, 'LocURI').text = hdrcmd.source
+    codec.SubElement(xhdr, 'SessionID').text = hdrcmd.sessionID
+    codec.SubElement(xhdr, 'MsgID').text = hdrcmd.msgID
+    xsrc = codec.SubElement(xhdr, 'Source')
+    codec.SubElement(xsrc, 'LocURI').text = hdrcmd.source
     if hdrcmd.sourceName is not None:
-      ET.SubElement(xsrc, 'LocName').text = hdrcmd.sourceName
-    xtgt = ET.SubElement(xhdr, 'Target')
-    ET.SubElement(xtgt, 'LocURI').text = hdrcmd.target
+      codec.SubElement(xsrc, 'LocName').text = hdrcmd.sourceName
+    xtgt = codec.SubElement(xhdr, 'Target')
+    codec.SubElement(xtgt, 'LocURI').text = hdrcmd.target
     if hdrcmd.targetName is not None:
-      ET.SubElement(xtgt, 'LocName').text = hdrcmd.targetName
+      codec.SubElement(xtgt, 'LocName').text = hdrcmd.targetName
     if hdrcmd.respUri is not None:
-      ET.SubElement(xhdr, 'RespURI').text = hdrcmd.respUri
+      codec.SubElement(xhdr, 'RespURI').text = hdrcmd.respUri
 
     if hdrcmd.auth is not None and not session.authAccepted:
       if hdrcmd.auth != constants.NAMESPACE_AUTH_BASIC:
         raise NotImplementedError('auth method "%s"' % (common.auth2string(hdrcmd.auth),))
       if hdrcmd.auth == constants.NAMESPACE_AUTH_BASIC:
-        xcred = ET.SubElement(xhdr, 'Cred')
-        xmeta = ET.SubElement(xcred, 'Meta')
-        ET.SubElement(xmeta, 'Format', {'xmlns': constants.NAMESPACE_METINF}).text = 'b64'
-        ET.SubElement(xmeta, 'Type', {'xmlns': constants.NAMESPACE_METINF}).text   = hdrcmd.auth
-        ET.SubElement(xcred, 'Data').text = base64.b64encode(
+        xcred = codec.SubElement(xhdr, 'Cred')
+        xmeta = codec.SubElement(xcred, 'Meta')
+        codec.SubElement(xmeta, 'Format', {'xmlns': constants.NAMESPACE_METINF}).text = 'b64'
+        codec.SubElement(xmeta, 'Type', {'xmlns': constants.NAMESPACE_METINF}).text   = hdrcmd.auth
+        codec.SubElement(xcred, 'Data').text = base64.b64encode(
           '%s:%s' % (adapter.peer.username, adapter.peer.password))
     if hdrcmd.maxMsgSize is not None or hdrcmd.maxObjSize is not None:
-      xmeta = ET.SubElement(xhdr, 'Meta')
+      xmeta = codec.SubElement(xhdr, 'Meta')
       if hdrcmd.maxMsgSize is not None:
-        ET.SubElement(xmeta, 'MaxMsgSize', {'xmlns': constants.NAMESPACE_METINF}).text = hdrcmd.maxMsgSize
+        codec.SubElement(xmeta, 'MaxMsgSize', {'xmlns': constants.NAMESPACE_METINF}).text = hdrcmd.maxMsgSize
       if hdrcmd.maxObjSize is not None:
-        ET.SubElement(xmeta, 'MaxObjSize', {'xmlns': constants.NAMESPACE_METINF}).text = hdrcmd.maxObjSize
+        codec.SubElement(xmeta, 'MaxObjSize', {'xmlns': constants.NAMESPACE_METINF}).text = hdrcmd.maxObjSize
 
-    xbody = ET.SubElement(xsync, constants.NODE_SYNCBODY)
+    xbody = codec.SubElement(xsync, constants.NODE_SYNCBODY)
 
     for cmdidx, cmd in enumerate(commands):
 
-      xcmd = ET.SubElement(xbody, cmd.name)
+      xcmd = codec.SubElement(xbody, cmd.name)
       if cmd.cmdID is not None:
-        ET.SubElement(xcmd, 'CmdID').text = cmd.cmdID
+        codec.SubElement(xcmd, 'CmdID').text = cmd.cmdID
 
       if cmd.name == constants.CMD_ALERT:
-        ET.SubElement(xcmd, 'Data').text = str(cmd.data)
-        xitem = ET.SubElement(xcmd, 'Item')
-        ET.SubElement(ET.SubElement(xitem, 'Source'), 'LocURI').text = cmd.source
-        ET.SubElement(ET.SubElement(xitem, 'Target'), 'LocURI').text = cmd.target
+        codec.SubElement(xcmd, 'Data').text = str(cmd.data)
+        xitem = codec.SubElement(xcmd, 'Item')
+        codec.SubElement(codec.SubElement(xitem, 'Source'), 'LocURI').text = cmd.source
+        codec.SubElement(codec.SubElement(xitem, 'Target'), 'LocURI').text = cmd.target
         if cmd.lastAnchor is not None \
            or cmd.nextAnchor is not None \
            or cmd.maxObjSize is not None:
-          xmeta = ET.SubElement(xitem, 'Meta')
-          xanch = ET.SubElement(xmeta, 'Anchor', {'xmlns': constants.NAMESPACE_METINF})
+          xmeta = codec.SubElement(xitem, 'Meta')
+          xanch = codec.SubElement(xmeta, 'Anchor', {'xmlns': constants.NAMESPACE_METINF})
           if cmd.lastAnchor is not None:
-            ET.SubElement(xanch, 'Last').text = cmd.lastAnchor
+            codec.SubElement(xanch, 'Last').text = cmd.lastAnchor
           if cmd.nextAnchor is not None:
-            ET.SubElement(xanch, 'Next').text = cmd.nextAnchor
+            codec.SubElement(xanch, 'Next').text = cmd.nextAnchor
           if cmd.maxObjSize is not None:
-            ET.SubElement(xmeta, 'MaxObjSize', {'xmlns': constants.NAMESPACE_METINF}).text = cmd.maxObjSize
+            codec.SubElement(xmeta, 'MaxObjSize', {'xmlns': constants.NAMESPACE_METINF}).text = cmd.maxObjSize
         continue
 
       if cmd.name == constants.CMD_STATUS:
-        ET.SubElement(xcmd, 'MsgRef').text    = cmd.msgRef
-        ET.SubElement(xcmd, 'CmdRef').text    = cmd.cmdRef
-        ET.SubElement(xcmd, 'Cmd').text       = cmd.statusOf
+        codec.SubElement(xcmd, 'MsgRef').text    = cmd.msgRef
+        codec.SubElement(xcmd, 'CmdRef').text    = cmd.cmdRef
+        codec.SubElement(xcmd, 'Cmd').text       = cmd.statusOf
         if cmd.sourceRef is not None:
-          ET.SubElement(xcmd, 'SourceRef').text = cmd.sourceRef
+          codec.SubElement(xcmd, 'SourceRef').text = cmd.sourceRef
         if cmd.targetRef is not None:
-          ET.SubElement(xcmd, 'TargetRef').text = cmd.targetRef
-        ET.SubElement(xcmd, 'Data').text      = cmd.statusCode
+          codec.SubElement(xcmd, 'TargetRef').text = cmd.targetRef
+        codec.SubElement(xcmd, 'Data').text      = cmd.statusCode
         if cmd.nextAnchor is not None or cmd.lastAnchor is not None:
-          xdata = ET.SubElement(ET.SubElement(xcmd, 'Item'), 'Data')
-          xanch = ET.SubElement(xdata, 'Anchor', {'xmlns': constants.NAMESPACE_METINF})
+          xdata = codec.SubElement(codec.SubElement(xcmd, 'Item'), 'Data')
+          xanch = codec.SubElement(xdata, 'Anchor', {'xmlns': constants.NAMESPACE_METINF})
           if cmd.lastAnchor is not None:
-            ET.SubElement(xanch, 'Last').text = cmd.lastAnchor
+            codec.SubElement(xanch, 'Last').text = cmd.lastAnchor
           if cmd.nextAnchor is not None:
-            ET.SubElement(xanch, 'Next').text = cmd.nextAnchor
+            codec.SubElement(xanch, 'Next').text = cmd.nextAnchor
         # NOTE: this is NOT standard SyncML...
         if cmd.errorCode is not None or cmd.errorMsg is not None:
-          xerr = ET.SubElement(xcmd, 'Error')
+          xerr = codec.SubElement(xcmd, 'Error')
           if cmd.errorCode is not None:
-            ET.SubElement(xerr, 'Code').text = cmd.errorCode
+            codec.SubElement(xerr, 'Code').text = cmd.errorCode
           if cmd.errorMsg is not None:
-            ET.SubElement(xerr, 'Message').text = cmd.errorMsg
+            codec.SubElement(xerr, 'Message').text = cmd.errorMsg
           if cmd.errorTrace is not None:
-            ET.SubElement(xerr, 'Trace').text = cmd.errorTrace
+            codec.SubElement(xerr, 'Trace').text = cmd.errorTrace
         continue
 
       if cmd.name in [constants.CMD_GET, constants.CMD_PUT]:
-        ET.SubElement(ET.SubElement(xcmd, 'Meta'), 'Type',
+        codec.SubElement(codec.SubElement(xcmd, 'Meta'), 'Type',
                       {'xmlns': constants.NAMESPACE_METINF}).text = cmd.type
         if cmd.source is not None or cmd.target is not None or cmd.data:
-          xitem = ET.SubElement(xcmd, 'Item')
+          xitem = codec.SubElement(xcmd, 'Item')
         if cmd.source is not None:
-          xsrc = ET.SubElement(xitem, 'Source')
-          ET.SubElement(xsrc, 'LocURI').text  = cmd.source
-          ET.SubElement(xsrc, 'LocName').text = cmd.source
+          xsrc = codec.SubElement(xitem, 'Source')
+          codec.SubElement(xsrc, 'LocURI').text  = cmd.source
+          codec.SubElement(xsrc, 'LocName').text = cmd.source
         if cmd.target is not None:
-          xtgt = ET.SubElement(xitem, 'Target')
-          ET.SubElement(xtgt, 'LocURI').text  = cmd.target
-          ET.SubElement(xtgt, 'LocName').text = cmd.target
+          xtgt = codec.SubElement(xitem, 'Target')
+          codec.SubElement(xtgt, 'LocURI').text  = cmd.target
+          codec.SubElement(xtgt, 'LocName').text = cmd.target
         if cmd.data is not None:
           if isinstance(cmd.data, basestring):
-            ET.SubElement(xitem, 'Data').text = cmd.data
+            codec.SubElement(xitem, 'Data').text = cmd.data
           else:
-            ET.SubElement(xitem, 'Data').append(cmd.data)
+            codec.SubElement(xitem, 'Data').append(cmd.data)
         continue
 
       if cmd.name == constants.CMD_RESULTS:
-        ET.SubElement(xcmd, 'MsgRef').text    = cmd.msgRef
-        ET.SubElement(xcmd, 'CmdRef').text    = cmd.cmdRef
-        ET.SubElement(ET.SubElement(xcmd, 'Meta'), 'Type',
+        codec.SubElement(xcmd, 'MsgRef').text    = cmd.msgRef
+        codec.SubElement(xcmd, 'CmdRef').text    = cmd.cmdRef
+        codec.SubElement(codec.SubElement(xcmd, 'Meta'), 'Type',
                       {'xmlns': constants.NAMESPACE_METINF}).text = cmd.type
-        xitem = ET.SubElement(xcmd, 'Item')
-        xsrc = ET.SubElement(xitem, 'Source')
-        ET.SubElement(xsrc, 'LocURI').text  = cmd.source
-        ET.SubElement(xsrc, 'LocName').text = cmd.source
+        xitem = codec.SubElement(xcmd, 'Item')
+        xsrc = codec.SubElement(xitem, 'Source')
+        codec.SubElement(xsrc, 'LocURI').text  = cmd.source
+        codec.SubElement(xsrc, 'LocName').text = cmd.source
         if cmd.data is not None:
           if isinstance(cmd.data, basestring):
-            ET.SubElement(xitem, 'Data').text = cmd.data
+            codec.SubElement(xitem, 'Data').text = cmd.data
           else:
-            ET.SubElement(xitem, 'Data').append(cmd.data)
+            codec.SubElement(xitem, 'Data').append(cmd.data)
         continue
 
       if cmd.name == constants.CMD_SYNC:
-        ET.SubElement(ET.SubElement(xcmd, 'Source'), 'LocURI').text = cmd.source
-        ET.SubElement(ET.SubElement(xcmd, 'Target'), 'LocURI').text = cmd.target
+        codec.SubElement(codec.SubElement(xcmd, 'Source'), 'LocURI').text = cmd.source
+        codec.SubElement(codec.SubElement(xcmd, 'Target'), 'LocURI').text = cmd.target
         if cmd.noc is not None:
-          ET.SubElement(xcmd, 'NumberOfChanges').text = cmd.noc
+          codec.SubElement(xcmd, 'NumberOfChanges').text = cmd.noc
         if cmd.data is not None:
           for scmd in cmd.data:
-            xscmd = ET.SubElement(xcmd, scmd.name)
+            xscmd = codec.SubElement(xcmd, scmd.name)
             if scmd.cmdID is not None:
-              ET.SubElement(xscmd, 'CmdID').text = scmd.cmdID
-            if scmd.type is not None or \
+              codec.SubElement(xscmd, 'CmdID').text = scmd.cmdID
+            if scmd.type is not None or scmd.size is not None or \
               ( scmd.format is not None and scmd.format != constants.FORMAT_AUTO ):
-              xsmeta = ET.SubElement(xscmd, 'Meta')
+              xsmeta = codec.SubElement(xscmd, 'Meta')
               # todo: implement auto encoding determination...
               #       (the current implementation just lets XML encoding do it,
               #        which is for most things good enough, but not so good
               #        for sequences that need a large amount escaping such as
               #        binary data...)
               if scmd.format is not None and scmd.format != constants.FORMAT_AUTO:
-                ET.SubElement(xsmeta, 'Format', {'xmlns': constants.NAMESPACE_METINF}).text = scmd.format
+                codec.SubElement(xsmeta, 'Format', {'xmlns': constants.NAMESPACE_METINF}).text = scmd.format
               if scmd.type is not None:
-                ET.SubElement(xsmeta, 'Type', {'xmlns': constants.NAMESPACE_METINF}).text = scmd.type
-            xsitem = ET.SubElement(xscmd, 'Item')
+                codec.SubElement(xsmeta, 'Type', {'xmlns': constants.NAMESPACE_METINF}).text = scmd.type
+              if scmd.size is not None:
+                codec.SubElement(xsmeta, 'Size', {'xmlns': constants.NAMESPACE_METINF}).text = scmd.size
+            xsitem = codec.SubElement(xscmd, 'Item')
             if scmd.source is not None:
-              ET.SubElement(ET.SubElement(xsitem, 'Source'), 'LocURI').text = scmd.source
+              codec.SubElement(codec.SubElement(xsitem, 'Source'), 'LocURI').text = scmd.source
             if scmd.sourceParent is not None:
-              ET.SubElement(ET.SubElement(xsitem, 'SourceParent'), 'LocURI').text = scmd.sourceParent
+              codec.SubElement(codec.SubElement(xsitem, 'SourceParent'), 'LocURI').text = scmd.sourceParent
             if scmd.target is not None:
-              ET.SubElement(ET.SubElement(xsitem, 'Target'), 'LocURI').text = scmd.target
+              codec.SubElement(codec.SubElement(xsitem, 'Target'), 'LocURI').text = scmd.target
             if scmd.targetParent is not None:
-              ET.SubElement(ET.SubElement(xsitem, 'TargetParent'), 'LocURI').text = scmd.targetParent
+              codec.SubElement(codec.SubElement(xsitem, 'TargetParent'), 'LocURI').text = scmd.targetParent
             if scmd.data is not None:
               if isinstance(scmd.data, basestring):
-                ET.SubElement(xsitem, 'Data').text = scmd.data
+                codec.SubElement(xsitem, 'Data').text = scmd.data
               else:
-                ET.SubElement(xsitem, 'Data').append(scmd.data)
+                codec.SubElement(xsitem, 'Data').append(scmd.data)
+            if scmd.moreData:
+              codec.SubElement(xsitem, 'MoreData')
         continue
 
       if cmd.name == constants.CMD_MAP:
-        ET.SubElement(ET.SubElement(xcmd, 'Source'), 'LocURI').text = cmd.source
-        ET.SubElement(ET.SubElement(xcmd, 'Target'), 'LocURI').text = cmd.target
+        codec.SubElement(codec.SubElement(xcmd, 'Source'), 'LocURI').text = cmd.source
+        codec.SubElement(codec.SubElement(xcmd, 'Target'), 'LocURI').text = cmd.target
         if cmd.sourceItem is not None or cmd.targetItem is not None:
-          xitem = ET.SubElement(xcmd, constants.CMD_MAPITEM)
+          xitem = codec.SubElement(xcmd, constants.CMD_MAPITEM)
           if cmd.sourceItem is not None:
-            ET.SubElement(ET.SubElement(xitem, 'Source'), 'LocURI').text = cmd.sourceItem
+            codec.SubElement(codec.SubElement(xitem, 'Source'), 'LocURI').text = cmd.sourceItem
           if cmd.targetItem is not None:
-            ET.SubElement(ET.SubElement(xitem, 'Target'), 'LocURI').text = cmd.targetItem
+            codec.SubElement(codec.SubElement(xitem, 'Target'), 'LocURI').text = cmd.targetItem
         continue
 
       if cmd.name == constants.CMD_FINAL:
@@ -499,7 +576,12 @@ class Protocol(object):
         continue
 
       if child.tag == 'Meta':
-        # this should already have been consumed during the protocol.initialize() call
+        # the peer may (re-)declare its limits in any message... keep
+        # track of them so that outgoing messages can be sized to fit.
+        if child.findtext('MaxMsgSize') is not None:
+          adapter.peer.maxMsgSize = long(child.findtext('MaxMsgSize'))
+        if child.findtext('MaxObjSize') is not None:
+          adapter.peer.maxObjSize = long(child.findtext('MaxObjSize'))
         continue
 
       raise common.ProtocolError('unexpected header node "%s"' % (child.tag,))
@@ -532,145 +614,175 @@ class Protocol(object):
       log.debug('outstanding command node "s%s.m%s.c%s.%s"',
                 session.id, lastcmds[0].msgID, chkcmd.cmdID, chkcmd.name)
 
-    # first, check all the 'Status' commands
-    for child in xsync[1]:
-      if child.tag != constants.CMD_STATUS:
-        continue
-      cname = child.findtext('Cmd')
-
-      log.debug('checking status node "s%s.m%s.c%s.%s"',
-                session.id, child.findtext('MsgRef'), child.findtext('CmdRef'), cname)
-
-      # match-up status command and outstanding command with Cmd, CmdRef and MsgRef...
-      for chkcmd in chkcmds:
-        if chkcmd.cmdID == child.findtext('CmdRef') \
-           and chkcmd.name == cname \
-           and lastcmds[0].msgID == child.findtext('MsgRef'):
-          chkcmds.remove(chkcmd)
-          break
-      else:
-        raise common.ProtocolError('unexpected status node s%s.mr%s.cr%s cmd=%s'
-                                   % (session.id, child.findtext('MsgRef'), child.findtext('CmdRef'), cname))
-
-      # TODO: check for unknown elements...
+    # note: the body is evaluated in a single pass (so that it can be
+    #       parsed incrementally), but the responses to the 'Status'
+    #       commands are kept separate from those to the other commands
+    #       so that they are still returned first.
+    final   = False
+    nextmsg = False
+    cmdret  = []
 
-      code = int(child.findtext('Data'))
-      # todo: any other common elements?...
+    for child in iterchildren(xsync[1]):
 
-      targetRef = child.findtext('TargetRef')
-      if targetRef is not None:
-        # note: doing a cleanUri on chkcmd.target because it could be "./devinf12"...
-        assert adapter.peer.cleanUri(targetRef) == adapter.peer.cleanUri(chkcmd.target)
+      if final:
+        log.warning('peer sent non-last final command')
 
-      sourceRef = child.findtext('SourceRef')
-      if sourceRef is not None:
-        # note: doing a cleanUri on chkcmd.source because it could be "./devinf12"...
-        if cname == constants.CMD_SYNCHDR:
-          # this is a little odd, but syncevolution strips the sessionid path
-          # parameter off for some reason, so compensating here...
-          assert adapter.cleanUri(sourceRef) in (adapter.cleanUri(chkcmd.source),
-                                                 session.effectiveID,
-                                                 session.returnUrl) \
-                 or adapter.cleanUri(chkcmd.source).startswith(adapter.cleanUri(sourceRef))
-        else:
-          assert adapter.cleanUri(sourceRef) == adapter.cleanUri(chkcmd.source)
-
-      if cname == constants.CMD_SYNCHDR:
-        if code not in (constants.STATUS_OK, constants.STATUS_AUTHENTICATION_ACCEPTED):
-          raise badStatus(child)
-        if code == constants.STATUS_AUTHENTICATION_ACCEPTED:
-          session.authAccepted = True
-        continue
-
-      if cname == constants.CMD_ALERT:
-        if code not in (constants.STATUS_OK,):
-          raise badStatus(child)
-        # TODO: do something with the Item/Data/Anchor/Next...
-        continue
-
-      if cname == constants.CMD_GET:
-        if code not in (constants.STATUS_OK,):
-          raise badStatus(child)
-        continue
+      # check the 'Status' commands
+      if child.tag == constants.CMD_STATUS:
 
-      if cname == constants.CMD_PUT:
-        if code not in (constants.STATUS_OK,):
-          raise badStatus(child)
-        continue
+        cname = child.findtext('Cmd')
 
-      if cname == constants.CMD_RESULTS:
-        if code not in (constants.STATUS_OK,):
-          raise badStatus(child)
-        continue
+        log.debug('checking status node "s%s.m%s.c%s.%s"',
+                  session.id, child.findtext('MsgRef'), child.findtext('CmdRef'), cname)
 
-      if cname == constants.CMD_SYNC:
-        # todo: should this be moved into the synchronizer as a "settle" event?...
-        if code not in (constants.STATUS_OK,):
-          raise badStatus(child)
-        ds = session.dsstates[adapter.cleanUri(chkcmd.source)]
-        if session.isServer:
-          if ds.action == 'send':
-            ds.action = 'save'
-            continue
+        # match-up status command and outstanding command with Cmd, CmdRef and MsgRef...
+        for chkcmd in chkcmds:
+          if chkcmd.cmdID == child.findtext('CmdRef') \
+             and chkcmd.name == cname \
+             and lastcmds[0].msgID == child.findtext('MsgRef'):
+            chkcmds.remove(chkcmd)
+            break
         else:
-          if ds.action == 'send':
-            ds.action = 'recv'
-            continue
-        raise common.ProtocolError('unexpected sync state for action=%s' % (ds.action,))
-
-      if cname in (constants.CMD_ADD, constants.CMD_REPLACE, constants.CMD_DELETE,):
-        scmd = state.Command(
-          name       = cname,
-          msgID      = hdrcmd.msgID,
-          cmdID      = child.findtext('CmdID'),
-          sourceRef  = sourceRef,
-          targetRef  = targetRef,
-          data       = code,
-          )
-        res = adapter.synchronizer.settle(adapter, session, scmd, chkcmd, child)
-        ret.extend(res or [])
-        continue
-
-      if cname == constants.CMD_MAP:
-        assert not session.isServer
-        if code not in (constants.STATUS_OK,):
-          raise badStatus(child)
-        continue
-
-      raise common.ProtocolError('unexpected status for command "%s"' % (cname,))
-
-    # TODO: is this right?... or should i be getting pissed off and
-    #       raising hell that all my commands were not addressed?...
-    ret.extend(chkcmds)
-
-    final = False
+          raise common.ProtocolError('unexpected status node s%s.mr%s.cr%s cmd=%s'
+                                     % (session.id, child.findtext('MsgRef'), child.findtext('CmdRef'), cname))
+
+        # TODO: check for unknown elements...
+
+        code = int(child.findtext('Data'))
+        # todo: any other common elements?...
+
+        targetRef = child.findtext('TargetRef')
+        if targetRef is not None:
+          # note: doing a cleanUri on chkcmd.target because it could be "./devinf12"...
+          assert adapter.peer.cleanUri(targetRef) == adapter.peer.cleanUri(chkcmd.target)
+
+        sourceRef = child.findtext('SourceRef')
+        if sourceRef is not None:
+          # note: doing a cleanUri on chkcmd.source because it could be "./devinf12"...
+          if cname == constants.CMD_SYNCHDR:
+            # this is a little odd, but syncevolution strips the sessionid path
+            # parameter off for some reason, so compensating here...
+            assert adapter.cleanUri(sourceRef) in (adapter.cleanUri(chkcmd.source),
+                                                   session.effectiveID,
+                                                   session.returnUrl) \
+                   or adapter.cleanUri(chkcmd.source).startswith(adapter.cleanUri(sourceRef))
+          else:
+            assert adapter.cleanUri(sourceRef) == adapter.cleanUri(chkcmd.source)
 
-    # second, check all the non-'Status' commands
-    for idx, child in enumerate(xsync[1]):
-      if child.tag == constants.CMD_STATUS:
-        continue
+        if cname == constants.CMD_SYNCHDR:
+          if code not in (constants.STATUS_OK, constants.STATUS_AUTHENTICATION_ACCEPTED):
+            raise badStatus(child)
+          if code == constants.STATUS_AUTHENTICATION_ACCEPTED:
+            session.authAccepted = True
+          continue
+
+        if cname == constants.CMD_ALERT:
+          if code not in (constants.STATUS_OK,):
+            raise badStatus(child)
+          # TODO: do something with the Item/Data/Anchor/Next...
+          continue
+
+        if cname == constants.CMD_GET:
+          if code not in (constants.STATUS_OK,):
+            raise badStatus(child)
+          continue
+
+        if cname == constants.CMD_PUT:
+          if code not in (constants.STATUS_OK,):
+            raise badStatus(child)
+          continue
+
+        if cname == constants.CMD_RESULTS:
+          if code not in (constants.STATUS_OK,):
+            raise badStatus(child)
+          continue
+
+        if cname == constants.CMD_SYNC:
+          # todo: should this be moved into the synchronizer as a "settle" event?...
+          if code not in (constants.STATUS_OK,):
+            raise badStatus(child)
+          ds = session.dsstates[adapter.cleanUri(chkcmd.source)]
+          if ds.action == 'send' and ds.sendCursor is not None:
+            # more sync commands for this datastore are still pending
+            continue
+          if session.isServer:
+            if ds.action == 'send':
+              ds.action = 'save'
+              continue
+          else:
+            if ds.action == 'send':
+              ds.action = 'recv'
+              continue
+          raise common.ProtocolError('unexpected sync state for action=%s' % (ds.action,))
+
+        if cname in (constants.CMD_ADD, constants.CMD_REPLACE, constants.CMD_DELETE,):
+          scmd = state.Command(
+            name       = cname,
+            msgID      = hdrcmd.msgID,
+            cmdID      = child.findtext('CmdID'),
+            sourceRef  = sourceRef,
+            targetRef  = targetRef,
+            data       = code,
+            )
+          res = adapter.synchronizer.settle(adapter, session, scmd, chkcmd, child)
+          ret.extend(res or [])
+          continue
+
+        if cname == constants.CMD_MAP:
+          assert not session.isServer
+          if code not in (constants.STATUS_OK,):
+            raise badStatus(child)
+          continue
+
+        raise common.ProtocolError('unexpected status for command "%s"' % (cname,))
+
+      # check the non-'Status' commands
       log.debug('handling command "%s"', child.tag)
+      if child.tag == constants.CMD_ALERT \
+         and child.findtext('Data') == str(constants.STATUS_NEXT_MESSAGE):
+        nextmsg = True
       if child.tag in (constants.CMD_ALERT, constants.CMD_GET, constants.CMD_PUT,
                        constants.CMD_SYNC, constants.CMD_RESULTS, constants.CMD_MAP):
         # todo: trap errors...
         res = getattr(self, 't2c_' + child.tag.lower())(adapter, session, lastcmds, xsync, child)
-        ret.extend(res or [])
+        cmdret.extend(res or [])
         continue
       if child.tag == constants.CMD_FINAL:
-        if idx + 1 != len(list(xsync[1])):
-          log.warning('peer sent non-last final command')
         final = True
         continue
       raise common.ProtocolError('unexpected command node "%s"' % (child.tag,))
 
-    if not final:
-      ret.append(state.Command(
-        name       = constants.CMD_ALERT,
-        cmdID      = session.nextCmdID,
-        data       = constants.STATUS_NEXT_MESSAGE,
-        source     = adapter.devinfo.devID,
-        target     = adapter.peer.devID,
-        ))
+    # note: commands that the peer did not respond to are not re-sent
+    #       (only references to them are kept, see `state.commandRefs`).
+    # TODO: should i be getting pissed off and raising hell that all my
+    #       commands were not addressed?...
+    for chkcmd in chkcmds:
+      log.warning('no status received for command "s%s.m%s.c%s.%s"',
+                  session.id, lastcmds[0].msgID, chkcmd.cmdID, chkcmd.name)
+    ret.extend(cmdret)
+
+    if final:
+      # the peer has completed its package: confirm that i received the
+      # right number of changes, and any datastores that were receiving
+      # (potentially multi-message) sync commands move on
+      for ds in session.dsstates.values():
+        if ds.recvNoc is not None and ds.recvNoc != ( ds.recvCount or 0 ):
+          raise common.ProtocolError('number-of-changes mismatch (received %d, expected %d)'
+                                     % (ds.recvCount or 0, ds.recvNoc))
+        ds.recvNoc   = None
+        ds.recvCount = None
+        if ds.action == 'recv':
+          ds.action = 'send' if session.isServer else 'done'
+    else:
+      session.partialMsgs = ( session.partialMsgs or 0 ) + 1
+      if not nextmsg:
+        ret.append(state.Command(
+          name       = constants.CMD_ALERT,
+          cmdID      = session.nextCmdID,
+          data       = constants.STATUS_NEXT_MESSAGE,
+          source     = adapter.devinfo.devID,
+          target     = adapter.peer.devID,
+          ))
 
     return ret
 
@@ -765,6 +877,12 @@ class Protocol(object):
   def t2c_alert(self, adapter, session, lastcmds, xsync, xnode):
     code = int(xnode.findtext('Data'))
     statusCode = constants.STATUS_OK
+    if code == constants.STATUS_NEXT_MESSAGE:
+      # the peer is requesting the next message of a multi-message
+      # package -- the pending commands get added during negotiate().
+      return [self.makeStatus(session, xsync, xnode,
+                              targetRef=xnode.findtext('Item/Target/LocURI'),
+                              sourceRef=xnode.findtext('Item/Source/LocURI'))]
     if code not in (
       constants.ALERT_TWO_WAY,
       constants.ALERT_SLOW_SYNC,
@@ -805,7 +923,7 @@ class Protocol(object):
       if uri in session.dsstates:
         ds = session.dsstates[uri]
       else:
-        adapter.router.addRoute(uri, ruri, autoMapped=True)
+        adapter.router.addRoute(uri, ruri, autoMapped=True, session=session)
         peerStore = adapter.peer.stores[ruri]
         ds = common.adict(
           # TODO: perhaps share this "constructor" with router/adapter?...
@@ -874,41 +992,55 @@ class Protocol(object):
       cmdID       = xnode.findtext('CmdID'),
       source      = xnode.findtext('Source/LocURI'),
       target      = uri,
-      data        = [],
       )]
 
+    # note: a sync may be split across multiple messages, in which case
+    # the number-of-changes (if specified) is only checked once the
+    # peer's package is complete (see _tree2commands).
     noc = xnode.findtext('NumberOfChanges')
-    if noc is not None:
-      noc = int(noc)
-
-    for child in xnode:
-      if child.tag in ('CmdID', 'Target', 'Source', 'NumberOfChanges'):
-        continue
-      if child.tag in (constants.CMD_ADD, constants.CMD_REPLACE, constants.CMD_DELETE):
-        # todo: trap errors...
-        res = getattr(self, 't2c_sync_' + child.tag.lower())(adapter, session, lastcmds, store, xsync, child)
-        commands[0].data.extend(res or [])
-        continue
-      raise common.ProtocolError('unexpected sync command "%s"' % (child.tag,))
-
-    # confirm that i received the right number of changes...
-    if noc is not None and noc != len(commands[0].data):
-      raise common.ProtocolError('number-of-changes mismatch (received %d, expected %d)'
-                                 % (len(commands[0].data), noc))
+    if noc is not None and ds.recvNoc is None:
+      ds.recvNoc = int(noc)
 
+    # note: the transition out of the 'recv' state is done once the
+    #       peer's final message is received (see _tree2commands).
     if not session.isServer:
       if ds.action != 'recv':
         raise common.ProtocolError('unexpected sync state for URI "%s": action=%s'
                                    % (uri, ds.action))
-      # todo: is there really nothing else to do?...
-      ds.action = 'done'
     else:
-      if ds.action != 'alert':
+      if ds.action not in ('alert', 'recv'):
         raise common.ProtocolError('unexpected sync state for URI "%s": action=%s'
                                    % (uri, ds.action))
-      ds.action = 'send'
-
-    return adapter.synchronizer.reactions(adapter, session, commands)
+      ds.action = 'recv'
+
+    # note: large-object chunks (other than the last one) are not
+    #       dispatched; they are only acknowledged with a status.
+    chunks = []
+
+    def subcommands():
+      # note: this is a generator so that (when the message is being
+      #       parsed incrementally) each sub-command is dispatched as
+      #       soon as it has been parsed.
+      for child in iterchildren(xnode):
+        if child.tag in ('CmdID', 'Target', 'Source', 'NumberOfChanges'):
+          continue
+        if child.tag in (constants.CMD_ADD, constants.CMD_REPLACE, constants.CMD_DELETE):
+          # todo: trap errors...
+          res = getattr(self, 't2c_sync_' + child.tag.lower())(adapter, session, lastcmds, store, xsync, child)
+          for cmd in res or []:
+            if cmd.name == constants.CMD_STATUS:
+              chunks.append(cmd)
+              continue
+            ds.recvCount = ( ds.recvCount or 0 ) + 1
+            yield cmd
+          continue
+        raise common.ProtocolError('unexpected sync command "%s"' % (child.tag,))
+
+    commands[0].data = subcommands()
+    ret = adapter.synchronizer.reactions(adapter, session, commands)
+    for cmd in chunks:
+      cmd.cmdID = session.nextCmdID
+    return ret + chunks
 
   #----------------------------------------------------------------------------
   def t2c_xnode2item(self, adapter, session, lastcmds, store, xsync, xnode):
@@ -924,6 +1056,9 @@ class Protocol(object):
     if len(xitem) < 1:
       raise common.ProtocolError('"%s" command with missing data node' % (xnode.tag,))
     xitem = xitem[0]
+    if xnode.find('Item/MoreData') is not None \
+       or session.dsstates[store.uri].recvObject is not None:
+      return self.t2c_xchunk2item(adapter, session, store, xnode, xitem, ctype, ctver, format)
     if len(xitem) == 1:
       data = xitem[0]
     else:
@@ -932,9 +1067,86 @@ class Protocol(object):
         data = base64.b64decode(data)
     return store.agent.loadsItem(data, ctype, ctver)
 
+  #----------------------------------------------------------------------------
+  def t2c_xchunk2item(self, adapter, session, store, xnode, xdata, ctype, ctver, format):
+    '''
+    Spools a large-object chunk to a file in the context\'s spool
+    directory (so that objects of any size can be received with
+    bounded memory) and returns ``None`` until the last chunk has been
+    received, at which point the object is de-serialized from the
+    spool file. The spool is removed once the object is complete or
+    the transfer fails.
+    '''
+    ds = session.dsstates[store.uri]
+    if len(xdata) > 0:
+      state.releaseLargeObject(ds)
+      raise common.ProtocolError('"%s" command with non-textual large-object data'
+                                 % (xnode.tag,))
+    data = xdata.text or ''
+    if format == constants.FORMAT_B64:
+      data = base64.b64decode(data)
+    elif isinstance(data, unicode):
+      data = data.encode('utf-8')
+    source = xnode.findtext('Item/Source/LocURI')
+    target = xnode.findtext('Item/Target/LocURI')
+    lob    = ds.recvObject
+    if lob is None:
+      size = xnode.findtext('Meta/Size') or xnode.findtext('Item/Meta/Size')
+      if size is None:
+        raise common.ProtocolError('"%s" large-object command without size' % (xnode.tag,))
+      # note: the spool is referenced by path (instead of by file
+      #       object) so that the session remains serializable.
+      fd, path = tempfile.mkstemp(prefix='pysyncml-', dir=adapter._context.spoolDir)
+      os.close(fd)
+      lob = ds.recvObject = common.adict(
+        name=xnode.tag, source=source, target=target, size=int(size),
+        path=path, type=ctype, format=format)
+    elif lob.name != xnode.tag or lob.source != source or lob.target != target:
+      state.releaseLargeObject(ds)
+      raise common.ProtocolError('unexpected "%s" command during large-object transfer'
+                                 % (xnode.tag,))
+    elif not os.path.exists(lob.path):
+      # e.g. the session was resumed on a host that does not share the
+      # spool directory (see Context.spoolDir)
+      state.releaseLargeObject(ds)
+      raise common.ProtocolError('large-object spool "%s" not found' % (lob.path,))
+    try:
+      with open(lob.path, 'ab') as fp:
+        fp.write(data)
+    except:
+      state.releaseLargeObject(ds)
+      raise
+    if xnode.find('Item/MoreData') is not None:
+      return None
+    try:
+      if os.path.getsize(lob.path) != lob.size:
+        raise common.ProtocolError('large-object size mismatch (received %d, expected %d)'
+                                   % (os.path.getsize(lob.path), lob.size))
+      with open(lob.path, 'rb') as fp:
+        if lob.format != constants.FORMAT_B64:
+          fp = codecs.getreader('utf-8')(fp)
+        return store.agent.loadItem(fp, lob.type, ctver)
+    finally:
+      state.releaseLargeObject(ds)
+
+  #----------------------------------------------------------------------------
+  def t2c_sync_chunk(self, adapter, session, lastcmds, store, xsync, xnode):
+    # note: the cmdID is assigned by t2c_sync so that it is in sequence
+    return [state.Command(
+      name       = constants.CMD_STATUS,
+      msgRef     = xsync.findtext('SyncHdr/MsgID'),
+      cmdRef     = xnode.findtext('CmdID'),
+      statusOf   = xnode.tag,
+      statusCode = constants.STATUS_CHUNKED_ITEM_ACCEPTED,
+      sourceRef  = xnode.findtext('Item/Source/LocURI'),
+      targetRef  = xnode.findtext('Item/Target/LocURI'),
+      )]
+
   #----------------------------------------------------------------------------
   def t2c_sync_add(self, adapter, session, lastcmds, store, xsync, xnode):
     item = self.t2c_xnode2item(adapter, session, lastcmds, store, xsync, xnode)
+    if item is None:
+      return self.t2c_sync_chunk(adapter, session, lastcmds, store, xsync, xnode)
     return [state.Command(
       name          = constants.CMD_ADD,
       msgID         = xsync.findtext('SyncHdr/MsgID'),
@@ -948,6 +1160,8 @@ class Protocol(object):
   #----------------------------------------------------------------------------
   def t2c_sync_replace(self, adapter, session, lastcmds, store, xsync, xnode):
     item = self.t2c_xnode2item(adapter, session, lastcmds, store, xsync, xnode)
+    if item is None:
+      return self.t2c_sync_chunk(adapter, session, lastcmds, store, xsync, xnode)
     return [state.Command(
       name          = constants.CMD_REPLACE,
       msgID         = xsync.findtext('SyncHdr/MsgID'),
@@ -993,11 +1207,7 @@ class Protocol(object):
     for xitem in xnode.findall('MapItem'):
       luid = xitem.findtext('Source/LocURI')
       guid = xitem.findtext('Target/LocURI')
-      # TODO: is there a better way of doing this than DELETE + INSERT?...
-      #       ie. is there an SQL INSERT_OR_UPDATE?...
-      adapter._context._model.Mapping.q(store_id=peerStore.id, guid=guid).delete()
-      newmap = adapter._context._model.Mapping(store_id=peerStore.id, guid=guid, luid=luid)
-      adapter._context._model.session.add(newmap)
+      adapter._context._model.mappings.setMapping(peerStore, guid, luid)
     return [self.makeStatus(session, xsync, xnode,
                             targetRef=tgtUri, sourceRef=srcUri)]
 
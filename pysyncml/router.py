@@ -42,7 +42,8 @@ class Router(object):
     super(Router, self).__init__(*args, **kw)
     self.adapter = adapter
     self.routes  = dict() # key(uri) => targetUri       # these are manual routes
-    self.bestCt  = dict() # key(uri) => contentType
+    # note: the negotiated content-types depend on the peer, so they are
+    #       cached in the session (as `session.bestCt`) instead of here.
 
   #----------------------------------------------------------------------------
   def getTargetUri(self, sourceUri, mustExist=True):
@@ -75,11 +76,11 @@ class Router(object):
     raise common.NoSuchRoute(targetUri)
 
   #----------------------------------------------------------------------------
-  def addRoute(self, sourceUri, targetUri, autoMapped=False):
+  def addRoute(self, sourceUri, targetUri, autoMapped=False, session=None):
     sourceUri = self.adapter.cleanUri(sourceUri)
     # purge the best-contentType cache
-    if sourceUri in self.bestCt:
-      del self.bestCt[sourceUri]
+    if session is not None:
+      session.bestCt.pop(sourceUri, None)
     # note: not cleaning the targetUri as the peer may not have been set
     #       yet by the client if this is not being auto-mapped...
     if not autoMapped:
@@ -102,7 +103,12 @@ class Router(object):
     for rstore in self.adapter.peer.stores.values():
       if rstore.uri == targetUri:
         if rstore.binding is None or rstore.binding.uri != sourceUri:
-          rstore.binding = self.adapter._context._model.Binding(uri=sourceUri, autoMapped=autoMapped)
+          binding = self.adapter._context._model.Binding(uri=sourceUri, autoMapped=autoMapped)
+          # a new binding starts with a full sync, i.e. it only needs the
+          # changes that are logged from here on (see Store.pullChanges)
+          if self.adapter._context.changeLog:
+            binding.changeCursor = binding._changeLogHead()
+          rstore.binding = binding
         done = True
         continue
       if rstore.binding is not None and rstore.binding.uri == sourceUri:
@@ -112,14 +118,26 @@ class Router(object):
       raise common.NoSuchRoute(targetUri)
 
   #----------------------------------------------------------------------------
-  def getBestTransmitContentType(self, sourceUri):
+  def getBestTransmitContentType(self, sourceUri, session=None):
     sourceUri = self.adapter.cleanUri(sourceUri)
-    if sourceUri in self.bestCt:
-      return self.bestCt[sourceUri]
+    if session is not None and sourceUri in session.bestCt:
+      return session.bestCt[sourceUri]
     targetUri = self.getTargetUri(sourceUri)
-    best = matcher.pickTransmitContentType(
-      self.adapter.stores[sourceUri], self.adapter.peer.stores[targetUri])
-    self.bestCt[sourceUri] = best
+    # note: the negotiated content-type is persisted on the binding and
+    #       is only reset when either store's content-types change (see
+    #       Store.merge), so it is negotiated once per binding.
+    binding = self.adapter.peer.stores[targetUri].binding
+    if binding is not None and binding.uri != sourceUri:
+      binding = None
+    if binding is not None and binding.contentType is not None:
+      best = (binding.contentType, binding.contentVersion)
+    else:
+      best = matcher.pickTransmitContentType(
+        self.adapter.stores[sourceUri], self.adapter.peer.stores[targetUri])
+      if best is not None and binding is not None:
+        binding.contentType, binding.contentVersion = best
+    if session is not None:
+      session.bestCt[sourceUri] = best
     return best
 
   #----------------------------------------------------------------------------
@@ -131,6 +149,14 @@ class Router(object):
     not_srcs = self.routes.keys()
     not_tgts = [self.adapter.peer.cleanUri(e) for e in self.routes.values()]
 
+    # note: existing bindings are kept (they are reset by Store.merge when
+    #       the content-types change), so only unbound stores are matched.
+    for rstore in self.adapter.peer.stores.values():
+      if rstore.binding is not None and rstore.binding.uri in self.adapter.stores \
+          and rstore.binding.uri not in not_srcs and rstore.uri not in not_tgts:
+        not_srcs.append(rstore.binding.uri)
+        not_tgts.append(rstore.uri)
+
     srcs = [e for e in self.adapter.stores.keys() if e not in not_srcs]
     tgts = [e for e in self.adapter.peer.stores.keys() if e not in not_tgts]
 
@@ -147,7 +173,7 @@ class Router(object):
       )
 
     for src, tgt in matches:
-      self.addRoute(src, tgt, True)
+      self.addRoute(src, tgt, True, session=session)
 
     newstates = dict()
     for store in self.adapter.stores.values():
@@ -176,6 +202,9 @@ class Router(object):
         peerUri    = peerUri,
         stats      = state.Stats(),
         )
+    for uri, ds in session.dsstates.items():
+      if newstates.get(uri) is not ds:
+        state.releaseLargeObject(ds)
     session.dsstates = newstates
 
   # #----------------------------------------------------------------------------
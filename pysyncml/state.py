@@ -23,10 +23,14 @@
 The ``pysyncml.state`` is an internal package that abstracts SyncML
 state related objects, including :class:`pysyncml.state.Session`,
 :class:`pysyncml.state.Request` and
-:class:`pysyncml.state.Command`.
+:class:`pysyncml.state.Command`, as well as the server-side session
+stores (see :class:`pysyncml.state.SessionStore`).
 '''
 
+import os, time, zlib, threading, collections, sqlalchemy
+import cPickle as pickle
 from .common import adict
+from . import constants
 
 #------------------------------------------------------------------------------
 class Session(adict):
@@ -47,6 +51,7 @@ class Session(adict):
     self.cmdID     = 0
     self.dsstates  = dict()
     self.stats     = dict()
+    self.bestCt    = dict() # key(uri) => negotiated transmit contentType
     super(Session, self).__init__(*args, **kw)
   @property
   def nextMsgID(self):
@@ -67,6 +72,8 @@ class Response(adict): pass
 #------------------------------------------------------------------------------
 class Command(adict):
   nonStringAttributes = ('data',)
+  # the attributes that are kept to match responses (see `commandRefs`)
+  refAttributes = ('name', 'cmdID', 'sessionID', 'msgID', 'source', 'target', 'uri')
   def __init__(self, **kw):
     # note: explicitly overriding dict's init behavior because Command does
     #       something special with attribute values (conditionally turns them
@@ -80,6 +87,27 @@ class Command(adict):
       self[key] = str(value)
     return self
 
+#------------------------------------------------------------------------------
+def commandRefs(commands):
+  '''
+  Returns compact references to the outgoing `commands`, which are
+  kept (as ``Session.lastCommands``) until the peer responds. They
+  only carry the fields needed to match the peer's responses against
+  them (see :attr:`Command.refAttributes`). Payloads are dropped, and
+  so are the "Status" and "Final" commands, which the peer never
+  responds to.
+  '''
+  ret = []
+  for cmd in commands:
+    if cmd.name in (constants.CMD_STATUS, constants.CMD_FINAL):
+      continue
+    ref = Command(**dict((attr, cmd[attr]) for attr in Command.refAttributes
+                         if cmd.get(attr) is not None))
+    if cmd.name == constants.CMD_SYNC and cmd.data is not None:
+      ref.data = commandRefs(cmd.data)
+    ret.append(ref)
+  return ret
+
 #------------------------------------------------------------------------------
 class Stats(adict):
   def __init__(self, *args, **kw):
@@ -97,6 +125,172 @@ class Stats(adict):
     self.merged    = 0
     super(Stats, self).__init__(*args, **kw)
 
+#------------------------------------------------------------------------------
+def releaseLargeObject(dsstate):
+  '''
+  Discards the large object that is being received in the datastore
+  state `dsstate` (if any), i.e. removes its spool file.
+  '''
+  lob, dsstate.recvObject = dsstate.recvObject, None
+  if lob is None:
+    return
+  try:
+    os.unlink(lob.path)
+  except OSError:
+    pass
+
+#------------------------------------------------------------------------------
+def releaseSession(session):
+  '''
+  Releases the resources that `session` holds outside of itself, i.e.
+  the spool files of partially received large objects (see the
+  `spoolDir` parameter of :class:`pysyncml.Context`). This must be
+  called when a session is abandoned (e.g. after a failed request);
+  the session stores (see :class:`SessionStore`) do so for the
+  sessions that they drop.
+  '''
+  for ds in session.dsstates.values():
+    releaseLargeObject(ds)
+
+#------------------------------------------------------------------------------
+def dumpSession(session):
+  '''
+  Serializes `session` (see :class:`Session`) into a compact string.
+  '''
+  return zlib.compress(pickle.dumps(session, pickle.HIGHEST_PROTOCOL))
+
+#------------------------------------------------------------------------------
+def loadSession(data):
+  '''
+  Restores a session that was serialized with :func:`dumpSession`.
+  '''
+  return pickle.loads(zlib.decompress(data))
+
+#------------------------------------------------------------------------------
+class SessionStore(object):
+  '''
+  The interface of server-side session stores, which keep the (server)
+  sessions of SyncML transactions between messages. Sessions are
+  stored serialized (see :func:`dumpSession`), so :meth:`get` always
+  returns a fresh copy and any session can be resumed by any worker
+  that shares the store. Sessions that have not been stored for `ttl`
+  seconds expire. Sessions that are dropped by the store (i.e. that
+  expire, are evicted or are deleted) are passed to `release`, which
+  defaults to :func:`releaseSession` (applications that store other
+  objects than :class:`Session` must provide their own).
+  Implementations must be thread-safe.
+  '''
+  def __init__(self, ttl=1800, release=None):
+    self.ttl     = ttl
+    self.release = release or releaseSession
+  def get(self, sid):
+    '''
+    Returns the session stored as `sid`, or ``None`` if there is no
+    such session or if it has expired.
+    '''
+    raise NotImplementedError()
+  def put(self, sid, session):
+    '''
+    Stores (or replaces) `session` as `sid`.
+    '''
+    raise NotImplementedError()
+  def delete(self, sid):
+    '''
+    Removes the session stored as `sid`, if any.
+    '''
+    raise NotImplementedError()
+
+#------------------------------------------------------------------------------
+class MemorySessionStore(SessionStore):
+  '''
+  An in-process :class:`SessionStore` that holds at most `maxSize`
+  sessions: when full, the least recently used session is evicted.
+  '''
+  def __init__(self, maxSize=1000, *args, **kw):
+    super(MemorySessionStore, self).__init__(*args, **kw)
+    self.maxSize  = maxSize
+    self._entries = collections.OrderedDict()  # sid => (expires, data)
+    self._lock    = threading.Lock()
+  def __len__(self):
+    return len(self._entries)
+  def get(self, sid):
+    with self._lock:
+      entry = self._entries.pop(sid, None)
+      if entry is None:
+        return None
+      if entry[0] > time.time():
+        self._entries[sid] = entry
+    if entry[0] <= time.time():
+      self.release(loadSession(entry[1]))
+      return None
+    return loadSession(entry[1])
+  def put(self, sid, session):
+    data    = dumpSession(session)
+    dropped = []
+    with self._lock:
+      now = time.time()
+      self._entries.pop(sid, None)
+      self._entries[sid] = (now + self.ttl, data)
+      # note: entries are ordered by last use, and therefore by expiry
+      while len(self._entries) > 0 and ( len(self._entries) > self.maxSize
+          or self._entries.itervalues().next()[0] <= now ):
+        dropped.append(self._entries.popitem(last=False)[1][1])
+    for data in dropped:
+      self.release(loadSession(data))
+  def delete(self, sid):
+    with self._lock:
+      entry = self._entries.pop(sid, None)
+    if entry is not None:
+      self.release(loadSession(entry[1]))
+
+#------------------------------------------------------------------------------
+class DatabaseSessionStore(SessionStore):
+  '''
+  A :class:`SessionStore` that keeps the sessions in the table
+  ``PREFIX_session`` of the sqlalchemy `engine` (which is created if
+  it does not exist), so that it can be shared between processes.
+  Expired sessions are purged (and released) whenever a new session
+  is stored.
+  '''
+  def __init__(self, engine, prefix='pysyncml', *args, **kw):
+    super(DatabaseSessionStore, self).__init__(*args, **kw)
+    self.engine = engine
+    self.table  = sqlalchemy.Table(
+      prefix + '_session', sqlalchemy.MetaData(),
+      sqlalchemy.Column('sid', sqlalchemy.String(255), primary_key=True),
+      sqlalchemy.Column('expires', sqlalchemy.Integer, nullable=False, index=True),
+      sqlalchemy.Column('data', sqlalchemy.LargeBinary, nullable=False),
+      )
+    self.table.create(bind=engine, checkfirst=True)
+  def get(self, sid):
+    table = self.table
+    data = self.engine.execute(
+      sqlalchemy.select([table.c.data])
+      .where(table.c.sid == sid)
+      .where(table.c.expires > int(time.time()))).scalar()
+    if data is None:
+      return None
+    return loadSession(data)
+  def put(self, sid, session):
+    table   = self.table
+    values  = dict(expires=int(time.time() + self.ttl), data=dumpSession(session))
+    with self.engine.begin() as conn:
+      if conn.execute(table.update().where(table.c.sid == sid), **values).rowcount > 0:
+        return
+      expired = table.c.expires <= int(time.time())
+      dropped = [row[0] for row in conn.execute(sqlalchemy.select([table.c.data]).where(expired))]
+      conn.execute(table.delete().where(expired))
+      conn.execute(table.insert(), sid=sid, **values)
+    for data in dropped:
+      self.release(loadSession(data))
+  def delete(self, sid):
+    table = self.table
+    with self.engine.begin() as conn:
+      data = conn.execute(sqlalchemy.select([table.c.data]).where(table.c.sid == sid)).scalar()
+      conn.execute(table.delete().where(table.c.sid == sid))
+    if data is not None:
+      self.release(loadSession(data))
+
 #------------------------------------------------------------------------------
 # end of $Id$
 #------------------------------------------------------------------------------
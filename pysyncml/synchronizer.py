@@ -31,6 +31,14 @@ from . import common, constants, model, state
 
 log = logging.getLogger(__name__)
 
+# the smallest large-object chunk that will be sent in a message (even
+# if the message has less space than that available)
+MIN_CHUNK_SIZE = 1024
+
+# the number of pending changes that are fetched from the database at
+# a time when generating sync commands
+CHANGE_BATCH_SIZE = 100
+
 #------------------------------------------------------------------------------
 def badStatus(xnode):
   code  = xnode.findtext('Data')
@@ -71,6 +79,9 @@ class Synchronizer(object):
     src = adapter.stores[uri]
     tgt = adapter.peer.stores[dsstate.peerUri]
 
+    # bring the peer's pending changes up to date with the change log
+    tgt.pullChanges()
+
     # TODO: ensure that mode is acceptable...
 
     # todo: perhaps i should only specify maxObjSize if it differs from
@@ -89,8 +100,6 @@ class Synchronizer(object):
 
   #----------------------------------------------------------------------------
   def action_send(self, adapter, session, uri, dsstate):
-    store = adapter.stores[uri]
-    agent = store.agent
     peerStore = adapter.peer.stores[adapter.router.getTargetUri(uri)]
 
     cmd = state.Command(
@@ -135,130 +144,290 @@ class Synchronizer(object):
       constants.ALERT_ONE_WAY_FROM_SERVER,  # when session.isServer
       ):
       # send local changes
-      changes  = adapter._context._model.Change.q(store_id=peerStore.id)
-      cmd.data = []
-      ctype    = adapter.router.getBestTransmitContentType(uri)
-
-      # TODO: add support for hierarchical operations...
-      #       including MOVE, COPY, etc.
-
-      # TODO: this assumes that the entire object set can fit in memory...
-      #       perhaps, as a work-around, just keep a reference to the object
-      #       and then stream-based serialize it actually gets converted to
-      #       XML.
-
-      for change in changes:
-        if dsstate.conflicts is not None and change.itemID in dsstate.conflicts:
-          continue
-        scmdtype = {
-          constants.ITEM_ADDED    : constants.CMD_ADD,
-          constants.ITEM_MODIFIED : constants.CMD_REPLACE,
-          constants.ITEM_DELETED  : constants.CMD_DELETE,
-          }.get(change.state)
-        if scmdtype is None:
-          log.error('could not resolve item state %d to sync command', change.state)
-          continue
-        # todo: do something with the content-type version?...
-        scmd = state.Command(
-          name    = scmdtype,
-          cmdID   = session.nextCmdID,
-          format  = constants.FORMAT_AUTO,
-          type    = ctype[0] if change.state != constants.ITEM_DELETED else None,
-          uri     = uri,
-          )
-        # TODO: need to add hierarchical addition support here...
-        if scmdtype != constants.CMD_DELETE:
-          item = agent.getItem(change.itemID)
-          scmd.data = agent.dumpsItem(item, ctype[0], ctype[1])
-          if not isinstance(scmd.data, basestring):
-            scmd.type = scmd.data[0]
-            scmd.data = scmd.data[2]
-          if agent.hierarchicalSync and item.parent is not None:
-            scmd.sourceParent = str(item.parent)
-        if scmdtype == constants.CMD_ADD:
-          scmd.source = change.itemID
-        else:
-          if session.isServer:
-            try:
-              # todo: this is a bit of an abstraction violation...
-              query = adapter._context._model.Mapping.q(store_id=peerStore.id, guid=change.itemID)
-              scmd.target = query.one().luid
-            except NoResultFound:
-              scmd.source = change.itemID
-          else:
-            scmd.source = change.itemID
-        cmd.data.append(scmd)
-
-      cmd.noc  = len(cmd.data)
-      return [cmd]
-
-    if dsstate.mode in (
+      scmds = self._iterChanges
+    elif dsstate.mode in (
       constants.ALERT_SLOW_SYNC,
       constants.ALERT_REFRESH_FROM_SERVER,  # when session.isServer
       constants.ALERT_REFRESH_FROM_CLIENT,  # when not session.isServer
       ):
-      cmd.data = []
+      # send all items
+      scmds = self._iterItems
+    else:
+      raise common.InternalError('unexpected sync situation (action=%s, mode=%s, isServer=%s)'
+                                 % (dsstate.action, common.mode2string(dsstate.mode),
+                                    '1' if session.isServer else '0'))
 
-      items = agent.getAllItems()
+    cmd.data = []
+    if not self._sendLargeObject(adapter, session, cmd, dsstate):
+      return [cmd]
+    paged  = dsstate.sendCursor is not None
+    cursor = dsstate.sendCursor or 0
+    self._sendCommands(adapter, session, cmd, dsstate, cursor,
+                       scmds(adapter, session, uri, dsstate, peerStore, cursor))
+    if not paged and dsstate.sendCursor is None:
+      cmd.noc = len(cmd.data)
+    return [cmd]
 
-      # TODO: this assumes that the entire object set can fit in memory...
-      if agent.hierarchicalSync:
-        orditems = []            # the ordered items
-        dunitems = dict()        # lut of the ordered items
-        curitems = dict()        # lut of current items (for loop detection)
-        lutitems = dict([(item.id, item) for item in items])
-        def appenditem(item):
-          if item.id in dunitems:
-            return
-          if item.id in curitems:
-            raise common.LogicalError('recursive item hierarchy detected at item %r' % (item,))
-          curitems[item.id] = True
-          if item.parent is not None:
-            appenditem(lutitems[item.parent])
-          orditems.append(item)
-          dunitems[item.id] = item
-        for item in items:
-          curitems = dict()
-          appenditem(item)
-
-      ctype = adapter.router.getBestTransmitContentType(uri)
-
-      for item in items:
-        if dsstate.conflicts is not None and str(item.id) in dsstate.conflicts:
+  #----------------------------------------------------------------------------
+  def _sendCommands(self, adapter, session, cmd, dsstate, cursor, scmds):
+    '''
+    Pulls sync sub-commands from the generator `scmds`, which yields
+    ``(cursor, scmd)`` tuples, into sync command `cmd` until either the
+    generator is exhausted or the outgoing message is full, in which
+    case ``dsstate.sendCursor`` is set to the position to resume from.
+    Since `scmds` is lazy, items are only loaded and serialized as
+    they are needed for the current message.
+    '''
+    dsstate.sendCursor = None
+    try:
+      for nextCursor, scmd in scmds:
+        if self._isLargeObject(adapter, session, cmd, scmd):
+          cursor = nextCursor
+          if not self._sendLargeObject(adapter, session, cmd, dsstate, scmd):
+            dsstate.sendCursor = cursor
+            break
           continue
-        # TODO: these should all be non-deleted items, right?...
-        if session.isServer:
-          # check to see if this item has already been mapped. if so,
-          # then don't send it.
-          try:
-            # todo: this is a bit of an abstraction violation...
-            query = adapter._context._model.Mapping.q(store_id=peerStore.id, guid=item.id)
-            if query.one().luid is not None:
-              continue
-          except NoResultFound:
-            pass
-        # todo: do something with the content-type version?...
-        scmd  = state.Command(
-          name    = constants.CMD_ADD,
-          cmdID   = session.nextCmdID,
-          format  = constants.FORMAT_AUTO,
-          type    = ctype[0],
-          uri     = uri,
-          source  = str(item.id),
-          data    = agent.dumpsItem(item, ctype[0], ctype[1]),
-          )
+        if not self._reserveSpace(adapter, session, cmd, scmd):
+          dsstate.sendCursor = cursor
+          break
+        scmd.cmdID = session.nextCmdID
+        cmd.data.append(scmd)
+        cursor = nextCursor
+    finally:
+      scmds.close()
+
+  #----------------------------------------------------------------------------
+  def _iterChanges(self, adapter, session, uri, dsstate, peerStore, cursor):
+    agent = adapter.stores[uri].agent
+    model = adapter._context._model
+    ctype = adapter.router.getBestTransmitContentType(uri, session)
+
+    # note: the changes are streamed in batches instead of being loaded
+    #       all at once, since only as many as fit into the current
+    #       message are typically consumed.
+    changes = model.Change.q(store_id=peerStore.id)
+    if cursor:
+      changes = changes.filter(model.Change.id > cursor)
+    changes = changes.order_by(model.Change.id).yield_per(CHANGE_BATCH_SIZE)
+
+    # TODO: add support for hierarchical operations...
+    #       including MOVE, COPY, etc.
+
+    for change in changes:
+      if dsstate.conflicts is not None and change.itemID in dsstate.conflicts:
+        continue
+      scmdtype = {
+        constants.ITEM_ADDED    : constants.CMD_ADD,
+        constants.ITEM_MODIFIED : constants.CMD_REPLACE,
+        constants.ITEM_DELETED  : constants.CMD_DELETE,
+        }.get(change.state)
+      if scmdtype is None:
+        log.error('could not resolve item state %d to sync command', change.state)
+        continue
+      # todo: do something with the content-type version?...
+      scmd = state.Command(
+        name    = scmdtype,
+        format  = constants.FORMAT_AUTO,
+        type    = ctype[0] if change.state != constants.ITEM_DELETED else None,
+        uri     = uri,
+        )
+      # TODO: need to add hierarchical addition support here...
+      if scmdtype != constants.CMD_DELETE:
+        item = agent.getItem(change.itemID)
+        scmd.data = agent.dumpsItem(item, ctype[0], ctype[1])
         if not isinstance(scmd.data, basestring):
           scmd.type = scmd.data[0]
           scmd.data = scmd.data[2]
         if agent.hierarchicalSync and item.parent is not None:
           scmd.sourceParent = str(item.parent)
-        cmd.data.append(scmd)
-      cmd.noc = len(cmd.data)
-      return [cmd]
+      if scmdtype == constants.CMD_ADD:
+        scmd.source = change.itemID
+      else:
+        if session.isServer:
+          luid = model.mappings.getLuid(peerStore, change.itemID)
+          if luid is not None:
+            scmd.target = luid
+          else:
+            scmd.source = change.itemID
+        else:
+          scmd.source = change.itemID
+      yield change.id, scmd
+
+  #----------------------------------------------------------------------------
+  def _iterItems(self, adapter, session, uri, dsstate, peerStore, cursor):
+    agent = adapter.stores[uri].agent
+    model = adapter._context._model
+    ctype = adapter.router.getBestTransmitContentType(uri, session)
+
+    # note: agents do not guarantee any order (nor that the items do not
+    #       change between messages), so the IDs of the items to send are
+    #       captured in ``dsstate.sendItems`` when the transfer starts, and
+    #       a paged transfer resumes at its position in that list. items
+    #       added later are left to the next sync.
+    lutitems = dict()
+    if not cursor or dsstate.sendItems is None:
+      items = agent.getAllItems()
+      if agent.hierarchicalSync:
+        items = self._orderItems(items)
+      lutitems = dict([(str(item.id), item) for item in items])
+      dsstate.sendItems = [str(item.id) for item in items]
+      cursor = 0
+
+    for pos in xrange(cursor, len(dsstate.sendItems)):
+      itemID = dsstate.sendItems[pos]
+      if dsstate.conflicts is not None and itemID in dsstate.conflicts:
+        continue
+      # TODO: these should all be non-deleted items, right?...
+      if session.isServer:
+        # check to see if this item has already been mapped. if so,
+        # then don't send it.
+        if model.mappings.getLuid(peerStore, itemID) is not None:
+          continue
+      item = lutitems.get(itemID)
+      if item is None:
+        try:
+          item = agent.getItem(itemID)
+        except common.InvalidItem:
+          log.debug('item "%s" was deleted during the transfer - skipping', itemID)
+          continue
+      # todo: do something with the content-type version?...
+      scmd  = state.Command(
+        name    = constants.CMD_ADD,
+        format  = constants.FORMAT_AUTO,
+        type    = ctype[0],
+        uri     = uri,
+        source  = itemID,
+        data    = agent.dumpsItem(item, ctype[0], ctype[1]),
+        )
+      if not isinstance(scmd.data, basestring):
+        scmd.type = scmd.data[0]
+        scmd.data = scmd.data[2]
+      if agent.hierarchicalSync and item.parent is not None:
+        scmd.sourceParent = str(item.parent)
+      yield pos + 1, scmd
 
-    raise common.InternalError('unexpected sync situation (action=%s, mode=%s, isServer=%s)'
-                               % (dsstate.action, common.mode2string(dsstate.mode),
-                                  '1' if session.isServer else '0'))
+    dsstate.sendItems = None
+
+  #----------------------------------------------------------------------------
+  def _orderItems(self, items):
+    # returns `items` ordered so that parents precede their children
+    orditems = []            # the ordered items
+    dunitems = dict()        # lut of the ordered items
+    curitems = dict()        # lut of current items (for loop detection)
+    lutitems = dict([(item.id, item) for item in items])
+    def appenditem(item):
+      if item.id in dunitems:
+        return
+      if item.id in curitems:
+        raise common.LogicalError('recursive item hierarchy detected at item %r' % (item,))
+      curitems[item.id] = True
+      if item.parent is not None:
+        appenditem(lutitems[item.parent])
+      orditems.append(item)
+      dunitems[item.id] = item
+    for item in items:
+      curitems = dict()
+      appenditem(item)
+    return orditems
+
+  #----------------------------------------------------------------------------
+  def _reserveSpace(self, adapter, session, cmd, scmd):
+    '''
+    Reserves space in the current outgoing message for sync sub-command
+    `scmd` of sync command `cmd`. Returns ``False`` if the message is
+    full, in which case `scmd` must be deferred to the next message.
+    At least one sub-command is always accepted per message so that
+    progress is guaranteed.
+    '''
+    if session.msgSpace is None:
+      return True
+    size = adapter.protocol.estimateSize(scmd)
+    if size > session.msgSpace and len(cmd.data) > 0:
+      return False
+    session.msgSpace -= size
+    return True
+
+  #----------------------------------------------------------------------------
+  def _isLargeObject(self, adapter, session, cmd, scmd):
+    '''
+    Returns ``True`` if sync sub-command `scmd` cannot fit into the
+    current outgoing message on its own and must therefore be sent as
+    a SyncML "large object", i.e. split into chunks across multiple
+    messages. This is only done if the peer supports large objects.
+    '''
+    if session.msgSpace is None or len(cmd.data) > 0:
+      return False
+    if not isinstance(scmd.data, basestring):
+      return False
+    if adapter.peer.devinfo is None or not adapter.peer.devinfo.largeObjects:
+      return False
+    return adapter.protocol.estimateSize(scmd) > session.msgSpace
+
+  #----------------------------------------------------------------------------
+  def _sendLargeObject(self, adapter, session, cmd, dsstate, scmd=None):
+    '''
+    Adds the next chunk of the pending large object of `dsstate` (or
+    of `scmd`, which is then made the pending large object) to sync
+    command `cmd`. Returns ``True`` if there is no pending large
+    object or if the last chunk has been added, i.e. further
+    sub-commands can be added to `cmd`.
+    '''
+    if scmd is not None:
+      # note: the object is converted to UTF-8 so that the chunk sizes
+      #       (and the declared total size) are in octets.
+      if isinstance(scmd.data, unicode):
+        scmd.data = scmd.data.encode('utf-8')
+        scmd._unicode = True
+      if adapter.peer.maxObjSize is not None \
+         and len(scmd.data) > int(adapter.peer.maxObjSize):
+        # todo: report this error to the calling application...
+        log.error('not sending "%s" of item "%s": size %d exceeds peer max-obj-size %s',
+                  scmd.name, scmd.source or scmd.target,
+                  len(scmd.data), adapter.peer.maxObjSize)
+        return True
+      dsstate.sendObject = scmd
+      dsstate.sendOffset = 0
+    scmd = dsstate.sendObject
+    if scmd is None:
+      return True
+    chunk  = state.Command(**dict([(k, v) for k, v in scmd.items() if k != 'data']))
+    offset = dsstate.sendOffset
+    if offset == 0:
+      chunk.size = len(scmd.data)
+    chunk.moreData = True
+    space  = ( session.msgSpace or 0 ) - adapter.protocol.estimateSize(chunk)
+    end    = min(len(scmd.data), offset + max(space, MIN_CHUNK_SIZE))
+    while True:
+      # do not split a multi-byte UTF-8 sequence across chunks
+      while end < len(scmd.data) and end > offset + 1 \
+            and ( ord(scmd.data[end]) & 0xC0 ) == 0x80:
+        end -= 1
+      chunk.data = scmd.data[offset:end]
+      if scmd._unicode:
+        chunk.data = chunk.data.decode('utf-8')
+      chunk.moreData = True if end < len(scmd.data) else None
+      size = adapter.protocol.estimateSize(chunk)
+      if session.msgSpace is None or size <= session.msgSpace \
+         or end - offset <= MIN_CHUNK_SIZE:
+        break
+      # the rendered size (escaping, character references) is larger
+      # than the raw size: shrink the chunk proportionally and retry
+      end = offset + max(MIN_CHUNK_SIZE, ( end - offset ) * session.msgSpace / size)
+    if session.msgSpace is not None:
+      session.msgSpace -= size
+    chunk.cmdID = session.nextCmdID
+    cmd.data.append(chunk)
+    if chunk.moreData:
+      dsstate.sendOffset = end
+      return False
+    dsstate.sendObject = None
+    dsstate.sendOffset = None
+    return True
+
+  #----------------------------------------------------------------------------
+  def action_recv(self, adapter, session, uri, dsstate):
+    # nothing to send: the peer is (still) sending its sync commands
+    return None
 
   #----------------------------------------------------------------------------
   def action_save(self, adapter, session, uri, dsstate):
@@ -291,10 +460,7 @@ class Synchronizer(object):
       if method is None:
         raise common.InternalError('unexpected reaction requested to command "%s"'
                                    % (cmd.name,))
-      try:
-        ret.extend(method(adapter, session, cmd) or [])
-      finally:
-        session.hierlut = None
+      ret.extend(method(adapter, session, cmd) or [])
     return ret
 
   #----------------------------------------------------------------------------
@@ -310,12 +476,17 @@ class Synchronizer(object):
       statusCode = constants.STATUS_OK,
       )]
     store = adapter.stores[adapter.cleanUri(command.target)]
-    if store.agent.hierarchicalSync:
-      session.hierlut = dict()
     dsstate = session.dsstates[store.uri]
-    if ( not session.isServer and dsstate.mode == constants.ALERT_REFRESH_FROM_SERVER ) \
-       or ( session.isServer and dsstate.mode == constants.ALERT_REFRESH_FROM_CLIENT ):
-      # delete all local items
+    if store.agent.hierarchicalSync and dsstate.hierlut is None:
+      # note: the lookup is kept for the whole session, since the items
+      #       may be split over several messages (parents always first)
+      dsstate.hierlut = dict()
+    if not dsstate.purged and (
+      ( not session.isServer and dsstate.mode == constants.ALERT_REFRESH_FROM_SERVER )
+      or ( session.isServer and dsstate.mode == constants.ALERT_REFRESH_FROM_CLIENT ) ):
+      # delete all local items (only once, i.e. not when the items are
+      # split over several messages)
+      dsstate.purged = True
       for item in store.agent.getAllItems():
         store.agent.deleteItem(item.id)
         dsstate.stats.hereDel += 1
@@ -324,21 +495,30 @@ class Synchronizer(object):
       # delete pending changes for the remote peer
       adapter._context._model.Change.q(store_id=store.peer.id).delete()
 
-    if len(command.data) > 0:
-      # verify that i should be receiving data...
-      if not (
-        dsstate.mode == constants.ALERT_TWO_WAY
-        or dsstate.mode == constants.ALERT_SLOW_SYNC
-        or ( not session.isServer and dsstate.mode in (constants.ALERT_ONE_WAY_FROM_SERVER,
-                                                       constants.ALERT_REFRESH_FROM_SERVER) )
-        or ( session.isServer and dsstate.mode in (constants.ALERT_ONE_WAY_FROM_CLIENT,
-                                                   constants.ALERT_REFRESH_FROM_CLIENT) )
-        ):
-        raise common.ProtocolError('unexpected sync data (role=%s, mode=%s)' %
-                                   ('server' if session.isServer else 'client',
-                                    common.mode2string(dsstate.mode)))
-
-    for cmd in command.data:
+    # the pending changes for the remote peer are loaded once per sync
+    # command (instead of once per sync sub-command) for conflict detection
+    dsstate.pendingChanges = None
+    if session.isServer and dsstate.mode != constants.ALERT_REFRESH_FROM_CLIENT:
+      dsstate.pendingChanges = self.getPendingChanges(adapter, store.peer)
+
+    # note: `command.data` may be a generator (i.e. the sync commands are
+    #       being parsed as they are dispatched), so it is only iterated
+    #       over once.
+    for idx, cmd in enumerate(command.data):
+      if idx == 0:
+        # verify that i should be receiving data...
+        if not (
+          dsstate.mode == constants.ALERT_TWO_WAY
+          or dsstate.mode == constants.ALERT_SLOW_SYNC
+          or ( not session.isServer and dsstate.mode in (constants.ALERT_ONE_WAY_FROM_SERVER,
+                                                         constants.ALERT_REFRESH_FROM_SERVER) )
+          or ( session.isServer and dsstate.mode in (constants.ALERT_ONE_WAY_FROM_CLIENT,
+                                                     constants.ALERT_REFRESH_FROM_CLIENT) )
+          ):
+          raise common.ProtocolError('unexpected sync data (role=%s, mode=%s)' %
+                                     ('server' if session.isServer else 'client',
+                                      common.mode2string(dsstate.mode)))
+
       if cmd.name != constants.CMD_ADD:
         # non-'add' sync commands should only be received in non-refresh modes
         if dsstate.mode not in (constants.ALERT_TWO_WAY,
@@ -349,8 +529,29 @@ class Synchronizer(object):
                                       common.mode2string(dsstate.mode), cmd.name))
 
       ret.extend(self.reaction_syncdispatch(adapter, session, cmd, store))
+    dsstate.pendingChanges = None
     return ret
 
+  #----------------------------------------------------------------------------
+  def getPendingChanges(self, adapter, peerStore):
+    '''
+    Returns a dictionary of the pending changes of `peerStore`, keyed
+    by item ID, with a ``(id, itemID, state, changeSpec)`` adict value.
+    '''
+    model = adapter._context._model
+    query = model.Change.q(store_id=peerStore.id).with_entities(
+      model.Change.id, model.Change.itemID, model.Change.state, model.Change.changeSpec)
+    return dict([(row.itemID, common.adict(id=row.id, itemID=row.itemID,
+                                           state=row.state, changeSpec=row.changeSpec))
+                 for row in query])
+
+  #----------------------------------------------------------------------------
+  def deletePendingChange(self, adapter, session, store, change):
+    adapter._context._model.Change.q(id=change.id).delete()
+    pending = session.dsstates[store.uri].pendingChanges
+    if pending is not None:
+      pending.pop(change.itemID, None)
+
   #----------------------------------------------------------------------------
   def reaction_syncdispatch(self, adapter, session, cmd, store):
     method = getattr(self, 'reaction_sync_' + cmd.name.lower(), None)
@@ -370,9 +571,11 @@ class Synchronizer(object):
       itemID = self.getSourceMapping(adapter, session, constants.CMD_SYNC,
                                      cmd, store.peer, cmd.source)
       try:
-        change = adapter._context._model.Change.q(
-          store_id = store.peer.id,
-          itemID   = itemID).one()
+        if dsstate.pendingChanges is None:
+          dsstate.pendingChanges = self.getPendingChanges(adapter, store.peer)
+        if not isinstance(itemID, basestring) or itemID not in dsstate.pendingChanges:
+          raise NoResultFound
+        change = dsstate.pendingChanges[itemID]
 
         retcmd = state.Command(
           name       = constants.CMD_STATUS,
@@ -406,7 +609,7 @@ class Synchronizer(object):
           # both changes are deletes... that's not a conflict.
           # TODO: should i really be doing all this here?... it does not
           #       follow the pattern...
-          adapter._context._model.session.delete(change)
+          self.deletePendingChange(adapter, session, store, change)
           dsstate.stats.peerDel   += 1
           dsstate.stats.hereDel   += 1
           dsstate.stats.merged    += 1
@@ -448,7 +651,7 @@ class Synchronizer(object):
       if cmd.targetParent is not None:
         cmd.data.parent = cmd.targetParent
       elif cmd.sourceParent is not None:
-        cmd.data.parent = session.hierlut[cmd.sourceParent]
+        cmd.data.parent = session.dsstates[store.uri].hierlut[cmd.sourceParent]
     if session.isServer \
        and session.dsstates[store.uri].mode == constants.ALERT_SLOW_SYNC:
       # TODO: if the matched item is already mapped to another client-side
@@ -468,7 +671,7 @@ class Synchronizer(object):
     if curitem is not None:
       item = curitem
     if store.agent.hierarchicalSync:
-      session.hierlut[cmd.source] = item.id
+      session.dsstates[store.uri].hierlut[cmd.source] = item.id
     ret = [state.Command(
       name       = constants.CMD_STATUS,
       cmdID      = session.nextCmdID,
@@ -480,10 +683,7 @@ class Synchronizer(object):
       )]
     if session.isServer:
       peerStore = adapter.peer.stores[session.dsstates[store.uri].peerUri]
-      # todo: this is a bit of an abstraction violation...
-      adapter._context._model.Mapping.q(store_id=peerStore.id, guid=item.id).delete()
-      newmap = adapter._context._model.Mapping(store_id=peerStore.id, guid=item.id, luid=cmd.source)
-      adapter._context._model.session.add(newmap)
+      adapter._context._model.mappings.setMapping(peerStore, item.id, cmd.source)
     else:
       ret.append(state.Command(
         name       = constants.CMD_MAP,
@@ -497,25 +697,24 @@ class Synchronizer(object):
 
   #----------------------------------------------------------------------------
   def getSourceMapping(self, adapter, session, cmdctxt, cmd, peerStore, luid):
-    try:
-      curmap = adapter._context._model.Mapping.q(store_id=peerStore.id, luid=luid).one()
-      return str(curmap.guid)
-    except NoResultFound:
-      msg = 'unexpected "%s/%s" request for unmapped item ID: %r' % (cmdctxt, cmd.name, luid)
-      log.warning(msg)
-      # todo: this is a bit of a hack when cmdctxt == 'Status'...
-      return state.Command(
-        name       = constants.CMD_STATUS,
-        cmdID      = session.nextCmdID,
-        msgRef     = cmd.msgID,
-        cmdRef     = cmd.cmdID,
-        sourceRef  = cmd.source,
-        targetRef  = cmd.target,
-        statusOf   = cmd.name if cmdctxt != constants.CMD_STATUS else cmdctxt,
-        statusCode = constants.STATUS_COMMAND_FAILED,
-        errorCode  = __name__ + '.' + self.__class__.__name__ + '.GSM.10',
-        errorMsg   = msg,
-        )
+    guid = adapter._context._model.mappings.getGuid(peerStore, luid)
+    if guid is not None:
+      return str(guid)
+    msg = 'unexpected "%s/%s" request for unmapped item ID: %r' % (cmdctxt, cmd.name, luid)
+    log.warning(msg)
+    # todo: this is a bit of a hack when cmdctxt == 'Status'...
+    return state.Command(
+      name       = constants.CMD_STATUS,
+      cmdID      = session.nextCmdID,
+      msgRef     = cmd.msgID,
+      cmdRef     = cmd.cmdID,
+      sourceRef  = cmd.source,
+      targetRef  = cmd.target,
+      statusOf   = cmd.name if cmdctxt != constants.CMD_STATUS else cmdctxt,
+      statusCode = constants.STATUS_COMMAND_FAILED,
+      errorCode  = __name__ + '.' + self.__class__.__name__ + '.GSM.10',
+      errorMsg   = msg,
+      )
 
   #----------------------------------------------------------------------------
   def reaction_sync_replace(self, adapter, session, cmd, store):
@@ -563,7 +762,7 @@ class Synchronizer(object):
       except common.ConflictError, e:
         # conflict types: client=mod/server=mod or client=mod/server=del
         if store.conflictPolicy == constants.POLICY_CLIENT_WINS:
-          adapter._context._model.session.delete(cmd._change)
+          self.deletePendingChange(adapter, session, store, cmd._change)
           dsstate.stats.merged += 1
           okcmd.statusCode = constants.STATUS_CONFLICT_RESOLVED_CLIENT_DATA
           if cmd._change.state == constants.ITEM_DELETED:
@@ -573,12 +772,7 @@ class Synchronizer(object):
             #       them, this item may already have been deleted. ugh.
             dsstate.stats.hereMod += 1
             item = store.agent.addItem(item)
-            peerStore = store.peer
-            adapter._context._model.Mapping.q(store_id=peerStore.id, guid=item.id).delete()
-            newmap = adapter._context._model.Mapping(store_id=peerStore.id,
-                                                     guid=item.id,
-                                                     luid=cmd.source)
-            adapter._context._model.session.add(newmap)
+            adapter._context._model.mappings.setMapping(store.peer, item.id, cmd.source)
             store.registerChange(item.id, constants.ITEM_ADDED,
                                  excludePeerID=adapter.peer.id)
             return [okcmd]
@@ -599,7 +793,7 @@ class Synchronizer(object):
           return [cmd._conflict]
 
     # if store.agent.hierarchicalSync:
-    #   session.hierlut[cmd.source] = item.id
+    #   session.dsstates[store.uri].hierlut[cmd.source] = item.id
 
     cspec = store.agent.replaceItem(item, reportChanges=session.isServer)
     dsstate.stats.hereMod += 1
@@ -617,12 +811,12 @@ class Synchronizer(object):
         return [itemID]
       if cmd._conflict is not None:
         if store.conflictPolicy == constants.POLICY_CLIENT_WINS:
-          adapter._context._model.session.delete(cmd._change)
+          self.deletePendingChange(adapter, session, store, cmd._change)
           status = constants.STATUS_CONFLICT_RESOLVED_CLIENT_DATA
           session.dsstates[store.uri].stats.merged += 1
           # falling back to standard handling...
         elif store.conflictPolicy == constants.POLICY_SERVER_WINS:
-          adapter._context._model.session.delete(cmd._change)
+          self.deletePendingChange(adapter, session, store, cmd._change)
           store.peer.registerChange(itemID, constants.ITEM_ADDED)
           session.dsstates[store.uri].stats.merged += 1
           cmd._conflict.statusCode = constants.STATUS_CONFLICT_RESOLVED_SERVER_DATA
@@ -665,6 +859,10 @@ class Synchronizer(object):
     # TODO: check all valid values of ``data``...
     # todo: anything else in common?...
     # todo: trap errors...
+    if cmd.data == constants.STATUS_CHUNKED_ITEM_ACCEPTED:
+      # an intermediate large-object chunk: nothing to settle until the
+      # peer acknowledges the last chunk
+      return
     return getattr(self, 'settle_' + cmd.name.lower())(adapter, session, cmd, chkcmd, xnode)
 
   #----------------------------------------------------------------------------
@@ -683,11 +881,7 @@ class Synchronizer(object):
     # TODO: this could be solved by:
     #         a) never updating a Change record (only deleting and replacing)
     #         b) deleting Change records by ID instead of by store/item/state...
-    adapter._context._model.Change.q(
-      store_id  = peerStore.id,
-      itemID    = locItemID,
-      state     = constants.ITEM_ADDED,
-      ).delete()
+    adapter._context._model.changes.settle(peerStore, locItemID, constants.ITEM_ADDED)
 
   #----------------------------------------------------------------------------
   def settle_replace(self, adapter, session, cmd, chkcmd, xnode):
@@ -721,11 +915,7 @@ class Synchronizer(object):
     # TODO: this could be solved by:
     #         a) never updating a Change record (only deleting and replacing)
     #         b) deleting Change records by ID instead of by store/item/state...
-    adapter._context._model.Change.q(
-      store_id  = peerStore.id,
-      itemID    = locItemID,
-      state     = constants.ITEM_MODIFIED,
-      ).delete()
+    adapter._context._model.changes.settle(peerStore, locItemID, constants.ITEM_MODIFIED)
 
   #----------------------------------------------------------------------------
   def settle_delete(self, adapter, session, cmd, chkcmd, xnode):
@@ -769,11 +959,7 @@ class Synchronizer(object):
     # TODO: this could be solved by:
     #         a) never updating a Change record (only deleting and replacing)
     #         b) deleting Change records by ID instead of by store/item/state...
-    adapter._context._model.Change.q(
-      store_id  = peerStore.id,
-      itemID    = locItemID,
-      state     = constants.ITEM_DELETED,
-      ).delete()
+    adapter._context._model.changes.settle(peerStore, locItemID, constants.ITEM_DELETED)
 
 #------------------------------------------------------------------------------
 # end of $Id$
@@ -140,6 +140,14 @@ class TestClient(unittest.TestCase, pxml.XmlTestMixin):
         )
     self.store = self.client.addStore(self.store)
 
+  #----------------------------------------------------------------------------
+  def test_httpSession(self):
+    self.context.httpPoolSize = 2
+    peer = self.context.RemoteAdapter(url='http://www.example.com/sync')
+    http = peer._getHttpSession()
+    self.assertIs(peer._getHttpSession(), http)
+    self.assertEqual(http.get_adapter('https://www.example.com/sync')._pool_maxsize, 2)
+
   #----------------------------------------------------------------------------
   def test_sync_client_note(self):
     proxy = ProxyPeer(self.context,
@@ -21,7 +21,7 @@
 
 import unittest, re
 import xml.etree.ElementTree as ET
-from . import codec, constants
+from . import codec, common, constants
 
 #------------------------------------------------------------------------------
 class TestCodec(unittest.TestCase):
@@ -39,6 +39,147 @@ class TestCodec(unittest.TestCase):
     self.assertEqual(data, '<root>&#12486;&#12473;&#12488;</root>')
     #self.assertEqual(data, '<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n<root>\xe3\x83\x86\xe3\x82\xb9\xe3\x83\x88</root>')
 
+  #----------------------------------------------------------------------------
+  def test_writer_encode_utf8(self):
+    xcodec = codec.Codec.factory(constants.CODEC_XML_WRITER)
+    xdoc = xcodec.Element('root')
+    xdoc.text = u'\u30c6\u30b9\u30c8'
+    contentType, data = xcodec.encode(xdoc)
+    self.assertEqual(contentType, 'application/vnd.syncml+xml; charset=UTF-8')
+    self.assertEqual(data, '<root>\xe3\x83\x86\xe3\x82\xb9\xe3\x83\x88</root>')
+
+  #----------------------------------------------------------------------------
+  def test_writer_matches_tree(self):
+    xinf = ET.Element('DevInf', {'xmlns': constants.NAMESPACE_DEVINF})
+    ET.SubElement(xinf, 'Man').text = 'a&b'
+    ET.SubElement(xinf, 'Ext')
+    def build(xcodec):
+      xdoc = xcodec.Element('SyncML')
+      xhdr = xcodec.SubElement(xdoc, 'SyncHdr')
+      xcodec.SubElement(xhdr, 'MsgID').text = '1'
+      xcodec.SubElement(xcodec.SubElement(xhdr, 'Meta'), 'MaxMsgSize',
+                        {'xmlns': constants.NAMESPACE_METINF}).text = '1024'
+      xbody = xcodec.SubElement(xdoc, 'SyncBody')
+      xitem = xcodec.SubElement(xcodec.SubElement(xbody, 'Put'), 'Item')
+      xcodec.SubElement(xitem, 'Data').append(xinf)
+      xcodec.SubElement(xitem, 'MoreData')
+      xcodec.SubElement(xcodec.SubElement(xbody, 'Add'), 'Data').text = '<a & b>'
+      xcodec.SubElement(xbody, 'Final')
+      return xcodec.encode(xdoc)[1]
+    tree   = build(codec.Codec.factory(constants.CODEC_XML))
+    stream = build(codec.Codec.factory(constants.CODEC_XML_WRITER))
+    self.assertEqual(stream, tree)
+
+  #----------------------------------------------------------------------------
+  def test_writer_outOfOrder(self):
+    xcodec = codec.Codec.factory(constants.CODEC_XML_WRITER)
+    xdoc = xcodec.Element('root')
+    xone = xcodec.SubElement(xdoc, 'one')
+    xcodec.SubElement(xdoc, 'two')
+    self.assertRaises(common.InternalError, xcodec.SubElement, xone, 'three')
+
+  #----------------------------------------------------------------------------
+  def makeSyncDocument(self, count):
+    return '<SyncML xmlns="SYNCML:SYNCML1.2"><SyncHdr><MsgID>1</MsgID></SyncHdr><SyncBody>' \
+      + '<Status><CmdID>1</CmdID></Status>' \
+      + '<Sync><CmdID>2</CmdID><Target><LocURI>note</LocURI></Target>' \
+      + ''.join(['<Add><CmdID>%d</CmdID><Meta><Type xmlns="syncml:metinf">text/plain</Type></Meta>'
+                 '<Item><Data>%s</Data></Item></Add>' % (idx + 3, 'x' * 200)
+                 for idx in range(count)]) \
+      + '</Sync><Final/></SyncBody></SyncML>'
+
+  #----------------------------------------------------------------------------
+  def test_decode_namespaces(self):
+    xcodec = codec.Codec.factory(constants.CODEC_XML)
+    xdoc = xcodec.decode('application/vnd.syncml+xml', self.makeSyncDocument(2))
+    self.assertEqual(xdoc.findtext('SyncBody/Sync/Target/LocURI'), 'note')
+    self.assertEqual(xdoc.findtext('SyncBody/Sync/Add/Meta/Type'), 'text/plain')
+    self.assertEqual(xdoc.find('SyncBody/Sync/Add/Meta/Type').get('oxmlns'), constants.NAMESPACE_METINF)
+
+  #----------------------------------------------------------------------------
+  def test_decode_incremental(self):
+    xcodec = codec.Codec.factory(constants.CODEC_XML)
+    xdoc = xcodec.decode('application/vnd.syncml+xml', self.makeSyncDocument(500),
+                         incremental=True)
+    self.assertEqual(xdoc.findtext('SyncHdr/MsgID'), '1')
+    tags = []
+    for child in codec.iterchildren(xdoc[1]):
+      tags.append(child.tag)
+      if child.tag != constants.CMD_SYNC:
+        continue
+      # the sync header is available before the sync commands are parsed
+      self.assertEqual(child.findtext('Target/LocURI'), 'note')
+      adds = 0
+      for schild in codec.iterchildren(child):
+        if schild.tag != constants.CMD_ADD:
+          continue
+        if adds == 0:
+          # ... and the first command is available before the document end
+          self.assertIsNone(xdoc[1].find(constants.CMD_FINAL))
+        self.assertEqual(schild.findtext('Meta/Type'), 'text/plain')
+        self.assertEqual(schild.findtext('Item/Data'), 'x' * 200)
+        adds += 1
+      self.assertEqual(adds, 500)
+      # the sync commands are released once they have been handled
+      self.assertEqual(len(child.findall(constants.CMD_ADD)), 0)
+    self.assertEqual(tags, [constants.CMD_STATUS, constants.CMD_SYNC, constants.CMD_FINAL])
+
+  #----------------------------------------------------------------------------
+  def makeSyncTree(self):
+    xdoc = ET.Element('SyncML', {'xmlns': constants.NAMESPACE_SYNCML})
+    xhdr = ET.SubElement(xdoc, 'SyncHdr')
+    ET.SubElement(xhdr, 'MsgID').text = '1'
+    ET.SubElement(ET.SubElement(xhdr, 'Meta'), 'MaxMsgSize',
+                  {'xmlns': constants.NAMESPACE_METINF}).text = '1024'
+    xbody = ET.SubElement(xdoc, 'SyncBody')
+    xstat = ET.SubElement(xbody, 'Status')
+    ET.SubElement(xstat, 'Data').text = '200'
+    ET.SubElement(ET.SubElement(xstat, 'Error'), 'Message').text = 'non-standard'
+    xput = ET.SubElement(xbody, 'Put')
+    ET.SubElement(ET.SubElement(xput, 'Meta'), 'Type',
+                  {'xmlns': constants.NAMESPACE_METINF}).text = 'application/vnd.syncml-devinf+wbxml'
+    xinf = ET.SubElement(ET.SubElement(ET.SubElement(xput, 'Item'), 'Data'), 'DevInf',
+                         {'xmlns': constants.NAMESPACE_DEVINF})
+    ET.SubElement(xinf, 'Man').text = 'a&b'
+    ET.SubElement(ET.SubElement(xinf, 'DataStore'), 'MaxObjSize').text = '4096'
+    ET.SubElement(xinf, 'SupportLargeObjs')
+    xadd = ET.SubElement(ET.SubElement(xbody, 'Sync'), 'Add')
+    ET.SubElement(ET.SubElement(xadd, 'Item'), 'Data').text = u'\u30c6\u30b9\u30c8 <&>'
+    ET.SubElement(xbody, 'Final')
+    return xdoc
+
+  #----------------------------------------------------------------------------
+  def test_wbxml_matches_xml(self):
+    xcodec = codec.Codec.factory(constants.CODEC_XML)
+    wcodec = codec.Codec.factory(constants.CODEC_WBXML)
+    xct, xdata = xcodec.encode(self.makeSyncTree())
+    wct, wdata = wcodec.encode(self.makeSyncTree())
+    self.assertEqual(wct, 'application/vnd.syncml+wbxml')
+    self.assertLess(len(wdata), len(xdata) / 2)
+    xdoc = codec.Codec.autoDecode(xct, xdata)
+    wdoc = codec.Codec.autoDecode(wct, wdata)
+    self.assertEqual(ET.tostring(wdoc), ET.tostring(xdoc))
+
+  #----------------------------------------------------------------------------
+  def test_wbxml_tokens(self):
+    xdoc = ET.Element('SyncML')
+    ET.SubElement(ET.SubElement(xdoc, 'SyncHdr'), 'MaxMsgSize',
+                  {'xmlns': constants.NAMESPACE_METINF}).text = 'x'
+    ET.SubElement(xdoc, 'Final')
+    data = codec.Codec.factory(constants.CODEC_WBXML).encode(xdoc)[1]
+    self.assertEqual(data, '\x03\xa4\x01\x6a\x00' # version, public ID, charset, strtbl
+                     '\x6d\x6c'                  # <SyncML><SyncHdr>
+                     '\x00\x01\x4c\x03x\x00\x01'  # <MetInf:MaxMsgSize>x</MaxMsgSize>
+                     '\x01\x00\x00\x12\x01')      # </SyncHdr><SyncML:Final/></SyncML>
+
+  #----------------------------------------------------------------------------
+  def test_wbxml_invalid(self):
+    wcodec = codec.Codec.factory(constants.CODEC_WBXML)
+    ct = 'application/vnd.syncml+wbxml'
+    self.assertRaises(common.ProtocolError, wcodec.decode, ct, '\x03\xa4\x01\x6a\x00\x6d')
+    self.assertRaises(common.ProtocolError, wcodec.decode, ct, '\x03\x01\x6a\x00\x2d')
+    self.assertRaises(common.ProtocolError, wcodec.decode, 'application/vnd.syncml+xml', '')
+
 #------------------------------------------------------------------------------
 # end of $Id$
 #------------------------------------------------------------------------------
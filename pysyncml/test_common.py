@@ -54,6 +54,24 @@ class TestCommon(unittest.TestCase):
     print >>out, 'how are you?'
     self.assertMultiLineEqual(buf.getvalue(), '>>hi, there!\n>>how are you?\n')
 
+  #----------------------------------------------------------------------------
+  def test_negotiateEncoding(self):
+    self.assertEqual(common.negotiateEncoding(None), None)
+    self.assertEqual(common.negotiateEncoding('identity'), None)
+    self.assertEqual(common.negotiateEncoding('deflate, gzip'), 'gzip')
+    self.assertEqual(common.negotiateEncoding('GZIP;q=0, deflate;q=0.5'), 'deflate')
+
+  #----------------------------------------------------------------------------
+  def test_compressContent(self):
+    data = '<SyncML>' + '<Add><Data>note</Data></Add>' * 100 + '</SyncML>'
+    for encoding in constants.ENCODINGS:
+      cdata = common.compressContent(data, encoding)
+      self.assertLess(len(cdata), len(data) / 8)
+      self.assertEqual(common.decompressContent(cdata, encoding), data)
+    self.assertEqual(common.decompressContent(data, None), data)
+    self.assertRaises(common.ProtocolError, common.decompressContent, data, 'gzip')
+    self.assertRaises(common.ProtocolError, common.decompressContent, data, 'compress')
+
   #----------------------------------------------------------------------------
   def test_version(self):
     # ensure that the version is always "MAJOR.MINOR.SOMETHING"
@@ -19,7 +19,7 @@
 # along with this program. If not, see http://www.gnu.org/licenses/.
 #------------------------------------------------------------------------------
 
-import unittest, sys, os, re, time, logging
+import unittest, sys, os, re, time, logging, tempfile, shutil
 import sqlalchemy as sa, pxml
 
 import pysyncml
@@ -92,8 +92,8 @@ class TestServer(unittest.TestCase, pxml.XmlTestMixin, test_helpers.TrimDictEqua
     pysyncml.enableSqliteCascadingDeletes(self.db)
 
   #----------------------------------------------------------------------------
-  def initServer(self):
-    self.context = pysyncml.Context(engine=self.db, owner=None, autoCommit=True)
+  def initServer(self, **kw):
+    self.context = pysyncml.Context(engine=self.db, owner=None, autoCommit=True, **kw)
     self.store   = self.context.Store(uri='srv_note', displayName='Server Note Store',
                                       agent=Agent(storage=self.items))
     self.server  = self.context.Adapter(name='In-Memory Test Server')
@@ -421,6 +421,32 @@ class TestServer(unittest.TestCase, pxml.XmlTestMixin, test_helpers.TrimDictEqua
                     '</SyncML>')
     self.assertEqual(pysyncml.Context.getAuthInfo(request, None), None)
     self.assertEqual(pysyncml.Context.getTargetID(request), self.server.devID)
+    self.assertEqual(pysyncml.Context.getSourceID(request), 'test.server.devID')
+    # the request header is only decoded once
+    self.assertIsNotNone(request.xhdr)
+    body, request.body = request.body, 'not-xml'
+    self.assertEqual(pysyncml.Context.getTargetID(request), self.server.devID)
+    # compressed requests are decompressed transparently
+    request = adict(headers=dict(request.headers),
+                    body=pysyncml.compressContent(body, pysyncml.ENCODING_GZIP))
+    request.headers['content-encoding'] = pysyncml.ENCODING_GZIP
+    self.assertEqual(pysyncml.Context.getTargetID(request), self.server.devID)
+
+  #----------------------------------------------------------------------------
+  def test_decodeRequest_incremental(self):
+    # the header-only entry points do not decide how the request is parsed
+    for idx, incremental in enumerate((False, True)):
+      self.context.incremental = incremental
+      request = adict(headers=dict((('content-type', 'application/vnd.syncml+xml'),)),
+                      body=self.makeRequestInit(self.server.devID, 'INC-PEER-%d' % (idx,),
+                                                nextAnchor=ts_iso()))
+      self.assertEqual(pysyncml.Context.getSourceID(request), 'INC-PEER-%d' % (idx,))
+      self.assertEqual(pysyncml.Context.getTargetID(request), self.server.devID)
+      self.assertIsNone(request.xtree)
+      self.server.handleRequest(pysyncml.Session(), request, pysyncml.Response())
+      self.assertEqual(isinstance(request.xtree, codec.IncrementalElement), incremental)
+      self.assertEqual(self.server.peer.devID, 'INC-PEER-%d' % (idx,))
+      self.initServer()
 
   #----------------------------------------------------------------------------
   def test_auth_basic(self):
@@ -510,6 +536,27 @@ class TestServer(unittest.TestCase, pxml.XmlTestMixin, test_helpers.TrimDictEqua
       '<Device "%s.server": devType=server; manufacturerName=pysyncml; modelName=%s.server; oem=-; hardwareVersion=-; firmwareVersion=-; softwareVersion=-; utc=True; largeObjects=True; hierarchicalSync=True; numberOfChanges=True>' % (__name__, __name__))
     self.assertEqual(str(server1.devinfo), str(server2.devinfo))
 
+  #----------------------------------------------------------------------------
+  def test_model_sharedByOwners(self):
+    db = sa.create_engine('sqlite://')
+    ctxts = [pysyncml.Context(engine=db, owner=owner, autoCommit=True) for owner in (1, 2)]
+    # the model classes are only created once per engine (and prefix)
+    self.assertIs(ctxts[0]._model.DatabaseObject, ctxts[1]._model.DatabaseObject)
+    for ctxt in ctxts:
+      adapter = ctxt.Adapter(devinfo=ctxt.DeviceInfo(
+        devID             = __name__ + '.server.%d' % (ctxt._model.owner,),
+        devType           = pysyncml.DEVTYPE_SERVER,
+        manufacturerName  = 'pysyncml',
+        modelName         = __name__ + '.server',
+        ))
+      ctxt.save()
+    # ... but the owner is bound per context
+    for ctxt in ctxts:
+      adapters = ctxt._model.Adapter.q().all()
+      self.assertEqual([(a.owner, a.devID) for a in adapters],
+                       [(ctxt._model.owner, __name__ + '.server.%d' % (ctxt._model.owner,))])
+      self.assertIs(adapters[0]._context, ctxt)
+
   #----------------------------------------------------------------------------
   def test_store_saved_to_db(self):
     db = sa.create_engine('sqlite://')
@@ -1252,6 +1299,539 @@ class TestServer(unittest.TestCase, pxml.XmlTestMixin, test_helpers.TrimDictEqua
     self.assertEqual(change.state, pysyncml.ITEM_ADDED)
     self.assertEqual(change.itemID, '1000')
 
+  #----------------------------------------------------------------------------
+  def registerPeers(self, count, **kw):
+    for idx in range(count):
+      request = adict(headers=dict((('content-type', 'application/vnd.syncml+xml'),)),
+                      body=self.makeRequestInit(self.server.devID, 'NEW-PEER-%d' % (idx,),
+                                                nextAnchor=ts_iso()))
+      self.server.handleRequest(pysyncml.Session(), request, pysyncml.Response())
+      self.initServer(**kw)
+    return dict((peer.devID, peer.stores.values()[0].id)
+                for peer in self.server.getKnownPeers())
+
+  #----------------------------------------------------------------------------
+  def test_registerChange_fanout(self):
+    peers = self.registerPeers(3)
+    Change = self.context._model.Change
+    def changes():
+      return sorted([(c.store_id, c.itemID, c.state, c.changeSpec) for c in Change.q()])
+    excl = self.server.getKnownPeers()[0]
+    self.store.registerChange(7, pysyncml.ITEM_ADDED, excludePeerID=excl.id)
+    self.assertEqual(changes(), sorted(
+      [(sid, '7', pysyncml.ITEM_ADDED, None)
+       for did, sid in peers.items() if did != excl.devID]))
+    # merging a change spec updates pending changes and adds the missing one
+    self.store.registerChange(7, pysyncml.ITEM_MODIFIED, changeSpec='a')
+    self.assertEqual(changes(), sorted(
+      [(sid, '7', pysyncml.ITEM_MODIFIED, None if did != excl.devID else 'a')
+       for did, sid in peers.items()]))
+    self.store.registerChange(7, pysyncml.ITEM_MODIFIED, changeSpec='b')
+    self.assertEqual(changes(), sorted(
+      [(sid, '7', pysyncml.ITEM_MODIFIED, None if did != excl.devID else 'a;b')
+       for did, sid in peers.items()]))
+    # ... and a change without a spec replaces them
+    self.store.registerChange(7, pysyncml.ITEM_DELETED)
+    self.assertEqual(changes(), sorted(
+      [(sid, '7', pysyncml.ITEM_DELETED, None) for sid in peers.values()]))
+    # the number of statements issued does not depend on the number of peers
+    def countStatements(itemID):
+      statements = []
+      def count(*args, **kw):
+        statements.append(args[2])
+      sa.event.listen(self.db, 'before_cursor_execute', count)
+      try:
+        self.store.registerChange(itemID, pysyncml.ITEM_ADDED)
+        self.store.registerChange(itemID, pysyncml.ITEM_MODIFIED, changeSpec='c')
+        self.context._model.changes.flush()
+      finally:
+        sa.event.remove(self.db, 'before_cursor_execute', count)
+      self.assertEqual(Change.q(itemID=str(itemID)).count(), len(peers))
+      return len(statements)
+    nstmts = countStatements(8)
+    peers = self.registerPeers(6)
+    self.assertEqual(len(peers), 6)
+    self.assertEqual(countStatements(9), nstmts)
+    # ... nor on the number of changes with a changeSpec
+    def countMerges(itemIDs):
+      for itemID in itemIDs:
+        self.store.registerChange(itemID, pysyncml.ITEM_MODIFIED, changeSpec='d')
+      self.context._model.changes.flush()
+      statements = []
+      def count(*args, **kw):
+        statements.append(args[2])
+      sa.event.listen(self.db, 'before_cursor_execute', count)
+      try:
+        for itemID in itemIDs:
+          self.store.registerChange(itemID, pysyncml.ITEM_MODIFIED, changeSpec='e')
+        self.context._model.changes.flush()
+      finally:
+        sa.event.remove(self.db, 'before_cursor_execute', count)
+      self.assertEqual(
+        set([(c.itemID, c.state, c.changeSpec) for c in Change.q(store_id=peers.values()[0])
+             if c.itemID in [str(e) for e in itemIDs]]),
+        set([(str(e), pysyncml.ITEM_MODIFIED, 'd;e') for e in itemIDs]))
+      return len(statements)
+    self.assertEqual(countMerges(range(10, 12)), countMerges(range(20, 40)))
+    self.store.clearChanges()
+    self.assertEqual(Change.q().count(), 0)
+
+  #----------------------------------------------------------------------------
+  def test_registerChange_buffered(self):
+    peers = self.registerPeers(2)
+    Change = self.context._model.Change
+    self.store.registerChange(1, pysyncml.ITEM_ADDED)
+    self.store.registerChange(1, pysyncml.ITEM_MODIFIED)
+    self.store.registerChange(2, pysyncml.ITEM_ADDED)
+    self.store.registerChange(2, pysyncml.ITEM_DELETED)
+    self.store.registerChange(3, pysyncml.ITEM_DELETED)
+    self.store.registerChange(3, pysyncml.ITEM_ADDED)
+    self.store.registerChange(4, pysyncml.ITEM_MODIFIED, changeSpec='a')
+    self.store.registerChange(4, pysyncml.ITEM_MODIFIED, changeSpec='b')
+    self.assertEqual(len(self.context._model.changes), 4)
+    # the changes are only written when the session is committed...
+    self.assertEqual(self.db.execute('SELECT COUNT(*) FROM pysyncml_change').scalar(), 0)
+    self.context.save()
+    self.assertEqual(len(self.context._model.changes), 0)
+    self.assertEqual(
+      sorted([(c.store_id, c.itemID, c.state, c.changeSpec) for c in Change.q()]),
+      sorted([(sid, '1', pysyncml.ITEM_ADDED, None) for sid in peers.values()]
+             + [(sid, '3', pysyncml.ITEM_MODIFIED, None) for sid in peers.values()]
+             + [(sid, '4', pysyncml.ITEM_MODIFIED, 'a;b') for sid in peers.values()]))
+    # ... or when they are queried
+    self.store.registerChange(1, pysyncml.ITEM_DELETED)
+    self.store.registerChange(5, pysyncml.ITEM_ADDED)
+    self.store.registerChange(5, pysyncml.ITEM_DELETED)
+    self.assertEqual(
+      sorted([(c.itemID, c.state) for c in Change.q(store_id=peers.values()[0])]),
+      [('1', pysyncml.ITEM_DELETED), ('3', pysyncml.ITEM_MODIFIED), ('4', pysyncml.ITEM_MODIFIED)])
+
+  #----------------------------------------------------------------------------
+  def test_registerChange_buffered_excluded(self):
+    peers = self.registerPeers(2)
+    excl  = self.server.getKnownPeers()[0]
+    Change = self.context._model.Change
+    # changes with different exclusions are applied in call order
+    self.store.registerChange(1, pysyncml.ITEM_MODIFIED, excludePeerID=excl.id)
+    self.store.registerChange(1, pysyncml.ITEM_DELETED)
+    self.store.registerChange(2, pysyncml.ITEM_ADDED)
+    self.store.registerChange(2, pysyncml.ITEM_MODIFIED, excludePeerID=excl.id)
+    self.store.registerChange(2, pysyncml.ITEM_DELETED)
+    self.store.registerChange(3, pysyncml.ITEM_DELETED)
+    self.store.registerChange(3, pysyncml.ITEM_ADDED, excludePeerID=excl.id)
+    self.context.save()
+    self.assertEqual(
+      sorted([(c.store_id, c.itemID, c.state) for c in Change.q()]),
+      sorted([(sid, '1', pysyncml.ITEM_DELETED) for sid in peers.values()]
+             + [(sid, '2', pysyncml.ITEM_DELETED) for sid in peers.values()]
+             + [(sid, '3', pysyncml.ITEM_DELETED if did == excl.devID else pysyncml.ITEM_ADDED)
+                for did, sid in peers.items()]))
+
+  #----------------------------------------------------------------------------
+  def test_registerChange_changeLog(self):
+    self.context.changeLog = True
+    peers = self.registerPeers(2, changeLog=True)
+    model = self.context._model
+    self.store.registerChange(1, pysyncml.ITEM_ADDED)
+    self.store.registerChange(2, pysyncml.ITEM_MODIFIED)
+    self.context.save()
+    # one log entry per change, independent of the number of peers
+    self.assertEqual(model.ChangeLog.q().count(), 2)
+    self.assertEqual(model.Change.q().count(), 0)
+    pstores = [peer.stores.values()[0] for peer in self.server.getKnownPeers()]
+    self.assertEqual(
+      sorted([(c.itemID, c.state) for c in pstores[0].getRegisteredChanges()]),
+      [('1', pysyncml.ITEM_ADDED), ('2', pysyncml.ITEM_MODIFIED)])
+    # entries are only discarded once all peers have pulled them
+    self.assertEqual(model.ChangeLog.q().count(), 2)
+    self.store.registerChange(1, pysyncml.ITEM_DELETED, excludePeerID=pstores[1].adapter_id)
+    self.store.registerChange(3, pysyncml.ITEM_ADDED)
+    self.context.save()
+    pstores[1].pullChanges()
+    self.assertEqual(model.ChangeLog.q().count(), 3)
+    self.assertEqual(
+      sorted([(c.itemID, c.state) for c in pstores[1].getRegisteredChanges()]),
+      [('1', pysyncml.ITEM_ADDED), ('2', pysyncml.ITEM_MODIFIED), ('3', pysyncml.ITEM_ADDED)])
+    # ... and pulled changes are coalesced with the pending ones
+    self.assertEqual(
+      sorted([(c.itemID, c.state) for c in pstores[0].getRegisteredChanges()]),
+      [('2', pysyncml.ITEM_MODIFIED), ('3', pysyncml.ITEM_ADDED)])
+    # note: the last entry is always kept
+    self.assertEqual(model.ChangeLog.q().count(), 1)
+    # clearing changes skips the log
+    self.store.registerChange(4, pysyncml.ITEM_ADDED)
+    self.store.clearChanges()
+    self.context.save()
+    for pstore in pstores:
+      self.assertEqual(pstore.getRegisteredChanges().count(), 0)
+
+  #----------------------------------------------------------------------------
+  def test_bindingContentType(self):
+    self.registerPeers(1)
+    self.server.peer = self.server.getKnownPeers()[0]
+    binding = self.server.peer.stores.values()[0].binding
+    self.assertEqual(binding.uri, 'srv_note')
+    self.assertIsNone(binding.contentType)
+    best = self.server.router.getBestTransmitContentType('srv_note', pysyncml.Session())
+    self.assertEqual(best, ('text/plain', '1.1'))
+    self.assertEqual((binding.contentType, binding.contentVersion), best)
+    # the negotiated content-type is re-used by later sessions
+    pick = pysyncml.matcher.pickTransmitContentType
+    pysyncml.matcher.pickTransmitContentType = None
+    try:
+      self.assertEqual(
+        self.server.router.getBestTransmitContentType('srv_note', pysyncml.Session()), best)
+    finally:
+      pysyncml.matcher.pickTransmitContentType = pick
+    # ... until the content-types of the local store change
+    agent = Agent(storage=self.items)
+    agent.contentTypes = [pysyncml.ContentTypeInfo('text/plain', '1.0', preferred=True)]
+    self.server.addStore(self.context.Store(
+      uri='srv_note', displayName='Server Note Store', agent=agent))
+    self.assertIsNone(binding.contentType)
+    self.assertEqual(binding.uri, 'srv_note')
+    self.assertEqual(self.server.router.getBestTransmitContentType('srv_note'),
+                     ('text/plain', '1.0'))
+
+  #----------------------------------------------------------------------------
+  def test_getPeer(self):
+    peers = self.registerPeers(3)
+    statements = []
+    def count(conn, cursor, statement, *args, **kw):
+      if 'pysyncml_adapter' in statement:
+        statements.append(statement)
+    sa.event.listen(self.db, 'before_cursor_execute', count)
+    try:
+      peer = self.server.getPeer('NEW-PEER-1')
+      self.assertEqual(peer.devID, 'NEW-PEER-1')
+      self.assertEqual(len(statements), 1)
+      self.assertIn('devID', statements[0])
+      # the peer ID is cached, and the peer then served from the session
+      self.assertIs(self.server.getPeer('NEW-PEER-1'), peer)
+      self.assertEqual(len(statements), 1)
+      self.assertIsNone(self.server.getPeer('NO-SUCH-PEER'))
+      self.assertIsNone(self.server.getPeer(self.server.devID))
+    finally:
+      sa.event.remove(self.db, 'before_cursor_execute', count)
+    # stale cache entries are dropped
+    self.context._peerIDs['NEW-PEER-2'] = peer.id
+    self.assertEqual(self.server.getPeer('NEW-PEER-2').devID, 'NEW-PEER-2')
+    self.assertEqual(self.context._peerIDs['NEW-PEER-2'],
+                     self.server.getPeer('NEW-PEER-2').id)
+    self.assertEqual(sorted(peers.keys()), ['NEW-PEER-0', 'NEW-PEER-1', 'NEW-PEER-2'])
+
+  #----------------------------------------------------------------------------
+  def test_mappingCache(self):
+    self.registerPeers(1)
+    pstore = self.server.getKnownPeers()[0].stores.values()[0]
+    statements = []
+    def count(conn, cursor, statement, *args, **kw):
+      if 'pysyncml_mapping' in statement:
+        statements.append(statement.split()[0])
+    sa.event.listen(self.db, 'before_cursor_execute', count)
+    try:
+      mappings = self.context._model.mappings
+      for idx in range(100):
+        mappings.setMapping(pstore, idx, 'luid-%d' % (idx,))
+      mappings.setMapping(pstore, 7, 'luid-7b')
+      self.assertEqual(mappings.getLuid(pstore, 7), 'luid-7b')
+      self.assertEqual(mappings.getGuid(pstore, 'luid-7b'), '7')
+      self.assertIsNone(mappings.getGuid(pstore, 'luid-7'))
+      self.assertEqual(statements, ['SELECT'])
+      # the mappings are written in bulk when committed...
+      self.context.save()
+      self.assertEqual(statements, ['SELECT', 'DELETE', 'INSERT'])
+      # ... and loaded with a single query
+      del statements[:]
+      self.initServer()
+      pstore = self.server.getKnownPeers()[0].stores.values()[0]
+      mappings = self.context._model.mappings
+      self.assertEqual([mappings.getGuid(pstore, 'luid-%d' % (idx,)) for idx in (0, 50, 99)],
+                       ['0', '50', '99'])
+      self.assertEqual(mappings.getLuid(pstore, 7), 'luid-7b')
+      self.assertEqual(statements, ['SELECT'])
+    finally:
+      sa.event.remove(self.db, 'before_cursor_execute', count)
+    self.assertEqual(self.context._model.Mapping.q(store_id=pstore.id).count(), 100)
+
+  #----------------------------------------------------------------------------
+  def regressStorage(self, db):
+    # regresses current storage to a version 1 layout
+    for stmt in (
+      'DROP INDEX ix_pysyncml_change_store_item',
+      'DROP INDEX ix_pysyncml_mapping_store_guid',
+      'DROP INDEX ix_pysyncml_mapping_store_luid',
+      'DROP INDEX ix_pysyncml_binding_uri',
+      'ALTER TABLE pysyncml_binding DROP COLUMN "changeCursor"',
+      'ALTER TABLE pysyncml_binding DROP COLUMN "contentType"',
+      'ALTER TABLE pysyncml_binding DROP COLUMN "contentVersion"',
+      'DROP TABLE pysyncml_changelog',
+      "UPDATE pysyncml_migrate SET version=1 WHERE repository_id='pysyncml'",
+      ):
+      db.execute(stmt)
+    db.dispose()
+
+  #----------------------------------------------------------------------------
+  def test_schemaUpgrade(self):
+    path = os.path.join(tempfile.mkdtemp(), 'upgrade.db')
+    try:
+      db = sa.create_engine('sqlite:///' + path)
+      pysyncml.Context(engine=db)
+      self.regressStorage(db)
+      # re-opening the storage with a new engine upgrades it
+      db = sa.create_engine('sqlite:///' + path)
+      context = pysyncml.Context(engine=db)
+      self.assertEqual(
+        db.execute("SELECT version FROM pysyncml_migrate WHERE repository_id='pysyncml'").scalar(),
+        pysyncml.model.Schema.version)
+      insp = sa.inspect(db)
+      self.assertIn('pysyncml_changelog', insp.get_table_names())
+      columns = [col['name'] for col in insp.get_columns('pysyncml_binding')]
+      for column in ('changeCursor', 'contentType', 'contentVersion'):
+        self.assertIn(column, columns)
+      indexes = dict()
+      for table in ('change', 'mapping', 'binding'):
+        for idx in insp.get_indexes('pysyncml_' + table):
+          indexes[idx['name']] = idx['column_names']
+      self.assertEqual(indexes['ix_pysyncml_change_store_item'], ['owner', 'store_id', 'itemID', 'state'])
+      self.assertEqual(indexes['ix_pysyncml_mapping_store_guid'], ['owner', 'store_id', 'guid'])
+      self.assertEqual(indexes['ix_pysyncml_mapping_store_luid'], ['owner', 'store_id', 'luid'])
+      self.assertEqual(indexes['ix_pysyncml_binding_uri'], ['uri'])
+      # and storage from the future is refused
+      db.execute("UPDATE pysyncml_migrate SET version=99 WHERE repository_id='pysyncml'")
+      db.dispose()
+      with self.assertRaises(pysyncml.common.InvalidContext):
+        pysyncml.Context(engine=sa.create_engine('sqlite:///' + path))
+    finally:
+      shutil.rmtree(os.path.dirname(path))
+
+  #----------------------------------------------------------------------------
+  def test_schemaUpgrade_changeLog(self):
+    # a peer that synchronized against version 1 storage...
+    path = os.path.join(tempfile.mkdtemp(), 'upgrade.db')
+    try:
+      self.db = sa.create_engine('sqlite:///' + path)
+      self.initServer()
+      self.registerPeers(1)
+      binding = self.server.getKnownPeers()[0].stores.values()[0].binding
+      binding.sourceAnchor = binding.targetAnchor = ts_iso()
+      self.context.save()
+      self.context.close()
+      self.regressStorage(self.db)
+      # ... does not lose the changes logged before it next synchronizes
+      self.db = sa.create_engine('sqlite:///' + path)
+      self.initServer()
+      self.context.changeLog = True
+      pstore = self.server.getKnownPeers()[0].stores.values()[0]
+      self.assertIsNotNone(pstore.binding.sourceAnchor)
+      self.assertEqual(pstore.binding.changeCursor, 0)
+      self.store.registerChange(1, pysyncml.ITEM_ADDED)
+      self.store.registerChange(2, pysyncml.ITEM_MODIFIED)
+      self.context.save()
+      self.assertEqual(
+        sorted([(c.itemID, c.state) for c in pstore.getRegisteredChanges()]),
+        [('1', pysyncml.ITEM_ADDED), ('2', pysyncml.ITEM_MODIFIED)])
+      self.context.close()
+      self.db.dispose()
+    finally:
+      shutil.rmtree(os.path.dirname(path))
+
+  #----------------------------------------------------------------------------
+  def test_pullChanges_noChangeLog(self):
+    # without a change log, the peers' pending changes are used as-is
+    self.registerPeers(1)
+    pstore = self.server.getKnownPeers()[0].stores.values()[0]
+    self.store.registerChange(1, pysyncml.ITEM_ADDED)
+    self.context.save()
+    binding = pstore.binding
+    statements = []
+    def count(conn, cursor, statement, *args, **kw):
+      statements.append(statement)
+    sa.event.listen(self.db, 'before_cursor_execute', count)
+    try:
+      self.assertEqual([c.itemID for c in pstore.getRegisteredChanges()], ['1'])
+    finally:
+      sa.event.remove(self.db, 'before_cursor_execute', count)
+    self.assertEqual(len(statements), 1)
+    self.assertIn('FROM pysyncml_change ', statements[0])
+    self.assertIsNone(binding.changeCursor)
+
+  #----------------------------------------------------------------------------
+  def test_newBinding_changeCursor(self):
+    # a new binding starts at the head of the change log
+    self.context.changeLog = True
+    self.store.registerChange(1, pysyncml.ITEM_ADDED)
+    self.context.save()
+    head = self.context._model.ChangeLog.q().one().id
+    self.registerPeers(1)
+    pstore = self.server.getKnownPeers()[0].stores.values()[0]
+    self.assertEqual(pstore.binding.changeCursor, head)
+    self.assertEqual(pstore.getRegisteredChanges().count(), 0)
+
+  #----------------------------------------------------------------------------
+  def test_sharedEngine(self):
+    path = os.path.join(tempfile.mkdtemp(), 'shared.db')
+    try:
+      storage = 'sqlite:///' + path
+      ctxt1 = pysyncml.Context(storage=storage)
+      ctxt2 = pysyncml.Context(storage=storage)
+      self.assertIs(ctxt1._model.engine, ctxt2._model.engine)
+      self.assertIsNot(ctxt1._model.session, ctxt2._model.session)
+      ctxt1.Adapter(devID='test://shared', name='Shared')
+      ctxt1.save()
+      self.assertEqual(ctxt2.Adapter().devID, 'test://shared')
+      ctxt1.close()
+      ctxt2.close()
+      self.assertEqual(ctxt1._model.engine.pool.checkedout(), 0)
+      # private in-memory databases are never shared
+      self.assertIsNot(pysyncml.Context(storage='sqlite://')._model.engine,
+                       pysyncml.Context(storage='sqlite://')._model.engine)
+    finally:
+      pysyncml.model._engines.pop(storage).dispose()
+      shutil.rmtree(os.path.dirname(path))
+
+  #----------------------------------------------------------------------------
+  def test_sharedContext_threads(self):
+    import threading
+    path = os.path.join(tempfile.mkdtemp(), 'threads.db')
+    try:
+      storage = 'sqlite:///' + path
+      context = pysyncml.Context(storage=storage)
+      context.Adapter(devID='test://threads', name='Threads')
+      context.save()
+      server = context.Adapter()
+      results = dict()
+      def handle(idx):
+        try:
+          adapter = context.Adapter()
+          adapter.peer = context.RemoteAdapter(url='test://peer-%d' % (idx,))
+          context.save()
+          results[idx] = (adapter, context._model.session(), context._model.changes, adapter.peer.devID)
+        except Exception, e:
+          results[idx] = e
+        finally:
+          context.close()
+      threads = [threading.Thread(target=handle, args=(idx,)) for idx in range(2)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      for result in results.values():
+        if isinstance(result, Exception):
+          raise result
+      # each thread gets its own session, adapter (and peer) and buffers
+      self.assertEqual(sorted(r[3] for r in results.values()), ['test://peer-0', 'test://peer-1'])
+      objects = [server, context._model.session(), context._model.changes]
+      for result in results.values():
+        for obj in result[:3]:
+          self.assertNotIn(obj, objects)
+          objects.append(obj)
+      self.assertIsNone(server.peer)
+      self.assertEqual(sorted(peer.devID for peer in server.getKnownPeers()),
+                       ['test://peer-0', 'test://peer-1'])
+      context.close()
+    finally:
+      pysyncml.model._engines.pop(storage).dispose()
+      shutil.rmtree(os.path.dirname(path))
+
+  #----------------------------------------------------------------------------
+  def test_adapterPool(self):
+    item = self.items.add(NoteItem(name='foo', body='this is the foo'))
+    self.context.save()
+    def factory():
+      server = self.context.Adapter()
+      server.addStore(self.context.Store(uri='srv_note', displayName='Server Note Store',
+                                         agent=Agent(storage=self.items)))
+      return server
+    pool = pysyncml.AdapterPool(self.context, size=2, factory=factory)
+    def handle(session, body):
+      request  = adict(headers=dict((('content-type', 'application/vnd.syncml+xml'),)), body=body)
+      response = pysyncml.Response()
+      with pool.borrow() as adapter:
+        stats = adapter.handleRequest(session, request, response)
+        self.context.save()
+        adapters.append(adapter)
+        peers.append(adapter.peer)
+        devIDs.append(adapter.peer.devID)
+      return stats
+    adapters = []
+    peers    = []
+    devIDs   = []
+    # a session is resumed by whichever adapter is available...
+    peerAnchor = ts_iso()
+    session = pysyncml.Session()
+    self.assertTrimDictEqual(
+      handle(session, self.makeRequestInit(self.server.devID, 'POOL-PEER-1', nextAnchor=peerAnchor)),
+      dict(srv_note=stat(mode=pysyncml.SYNCTYPE_SLOW_SYNC)))
+    self.assertTrimDictEqual(
+      handle(session, self.makeRequestAlert(self.server.devID, 'POOL-PEER-1',
+                                            peerNextAnchor=peerAnchor, sessionID='2')),
+      dict(srv_note=stat(mode=pysyncml.SYNCTYPE_SLOW_SYNC)))
+    self.assertTrimDictEqual(
+      handle(session, self.makeRequestMap(self.server.devID, 'POOL-PEER-1', sessionID='2')),
+      dict(srv_note=stat(mode=pysyncml.SYNCTYPE_SLOW_SYNC, peerAdd=1)))
+    # ... and any adapter can then serve another peer
+    self.assertTrimDictEqual(
+      handle(pysyncml.Session(), self.makeRequestInit(self.server.devID, 'POOL-PEER-2',
+                                                      nextAnchor=peerAnchor)),
+      dict(srv_note=stat(mode=pysyncml.SYNCTYPE_SLOW_SYNC)))
+    self.assertEqual(len(set(adapters)), 2)
+    self.assertIs(adapters[0], adapters[2])
+    self.assertIsNot(adapters[0], adapters[1])
+    self.assertEqual(devIDs, ['POOL-PEER-1', 'POOL-PEER-1', 'POOL-PEER-1', 'POOL-PEER-2'])
+    # the pooled adapters stay in their sessions, but their peers are evicted
+    for adapter in adapters:
+      self.assertIsNone(adapter.peer)
+      self.assertTrue(sa.inspect(adapter).persistent)
+      self.assertTrue(sa.inspect(adapter.stores['srv_note']).persistent)
+      self.assertFalse(sa.inspect(adapter).expired_attributes)
+      self.assertFalse(sa.inspect(adapter.stores['srv_note']).expired_attributes)
+    for peer in peers:
+      self.assertTrue(sa.inspect(peer).detached)
+    self.assertEqual(self.context._model.Mapping.q().count(), 1)
+    pool.close()
+
+  #----------------------------------------------------------------------------
+  def test_adapterPool_rollback(self):
+    self.context.save()
+    pool  = pysyncml.AdapterPool(self.context, size=1)
+    model = self.context._model
+    # a failed request's flushed (but uncommitted) changes...
+    with self.assertRaises(ValueError):
+      with pool.borrow() as adapter:
+        model.session.add(model.Adapter(devID='GHOST', name='Ghost', isLocal=False))
+        model.session.flush()
+        raise ValueError('request failed')
+    # ... are not committed by the next borrower
+    with pool.borrow() as adapter:
+      self.assertIsNotNone(adapter.devinfo)
+      self.context.save()
+    pool.close()
+    self.assertEqual(model.Adapter.q(devID='GHOST').count(), 0)
+
+  #----------------------------------------------------------------------------
+  def test_adapterPool_reuse(self):
+    self.context.save()
+    devID = self.server.devID
+    pool  = pysyncml.AdapterPool(self.context, size=1)
+    with pool.borrow() as adapter:
+      self.assertEqual(adapter.stores['srv_note'].uri, 'srv_note')
+    statements = []
+    def count(conn, cursor, statement, *args, **kw):
+      if 'pysyncml_adapter' in statement or 'pysyncml_store' in statement:
+        statements.append(statement)
+    sa.event.listen(self.db, 'before_cursor_execute', count)
+    try:
+      # a clean borrow is not rolled back, so the pinned objects are not reloaded
+      with pool.borrow() as adapter:
+        self.assertEqual(adapter.devID, devID)
+        self.assertEqual(adapter.devinfo.devID, devID)
+        self.assertEqual(adapter.stores['srv_note'].uri, 'srv_note')
+      self.assertEqual(statements, [])
+    finally:
+      sa.event.remove(self.db, 'before_cursor_execute', count)
+    pool.close()
+
   #----------------------------------------------------------------------------
   def test_sync_update(self):
     # step 1: register some content (no need to register since no peers)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: metagriffin <mg.github@uberdev.org>
+# date: 2012/05/20
+# copy: (C) Copyright 2012-EOT metagriffin -- see LICENSE.txt
+#------------------------------------------------------------------------------
+# This software is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses/.
+#------------------------------------------------------------------------------
+
+import unittest, os, time, tempfile
+import sqlalchemy as sa
+
+from . import state
+from .common import adict
+
+#------------------------------------------------------------------------------
+class TestState(unittest.TestCase):
+
+  #----------------------------------------------------------------------------
+  def makeSession(self, peerID):
+    session = state.Session(peerID=peerID, returnUrl='http://example.com/sync')
+    session.dsstates['srv_note'] = adict(remoteUri='cli_note', mode=200)
+    session.lastCommands = [state.Command(name='Status', cmdID=1, data='200')]
+    return session
+
+  #----------------------------------------------------------------------------
+  def test_dumpSession(self):
+    session = self.makeSession('peer-1')
+    copy = state.loadSession(state.dumpSession(session))
+    self.assertIsInstance(copy, state.Session)
+    self.assertEqual(copy, session)
+    self.assertEqual(copy.dsstates['srv_note'].remoteUri, 'cli_note')
+    self.assertEqual(copy.lastCommands[0].cmdID, '1')
+    self.assertEqual(copy.nextMsgID, 2)
+
+  #----------------------------------------------------------------------------
+  def test_commandRefs(self):
+    commands = [
+      state.Command(name='SyncHdr', cmdID=0, sessionID=3, msgID=2,
+                    source='srv', target='cli', sourceName='Server'),
+      state.Command(name='Status', cmdID=1, msgRef=1, cmdRef=0, statusCode=200),
+      state.Command(name='Put', cmdID=2, source='./devinf12', type='xml', data='<DevInf/>'),
+      state.Command(name='Sync', cmdID=3, source='srv_note', target='cli_note', uri='srv_note',
+                    noc=2, data=[
+          state.Command(name='Add', cmdID=4, source='1', uri='srv_note', format='b64', data='x' * 1000),
+          state.Command(name='Delete', cmdID=5, source='2', target='20', uri='srv_note'),
+          ]),
+      state.Command(name='Final'),
+      ]
+    self.assertEqual(state.commandRefs(commands), [
+      dict(name='SyncHdr', cmdID='0', sessionID='3', msgID='2', source='srv', target='cli'),
+      dict(name='Put', cmdID='2', source='./devinf12'),
+      dict(name='Sync', cmdID='3', source='srv_note', target='cli_note', uri='srv_note', data=[
+        dict(name='Add', cmdID='4', source='1', uri='srv_note'),
+        dict(name='Delete', cmdID='5', source='2', target='20', uri='srv_note'),
+        ]),
+      ])
+    self.assertIsInstance(state.commandRefs(commands)[0], state.Command)
+
+  #----------------------------------------------------------------------------
+  def test_memoryStore(self):
+    store = state.MemorySessionStore(maxSize=2, ttl=60)
+    self.assertIsNone(store.get('a'))
+    store.put('a', self.makeSession('peer-a'))
+    store.put('b', self.makeSession('peer-b'))
+    # sessions are stored serialized, i.e. `get` returns a copy
+    session = store.get('a')
+    session.peerID = 'changed'
+    self.assertEqual(store.get('a').peerID, 'peer-a')
+    # the least recently used session is evicted
+    store.put('c', self.makeSession('peer-c'))
+    self.assertEqual(len(store), 2)
+    self.assertIsNone(store.get('b'))
+    self.assertEqual(store.get('a').peerID, 'peer-a')
+    store.delete('a')
+    self.assertIsNone(store.get('a'))
+    # and expired sessions are dropped
+    store.ttl = 0
+    store.put('d', self.makeSession('peer-d'))
+    self.assertIsNone(store.get('d'))
+    self.assertEqual(len(store), 1)
+
+  #----------------------------------------------------------------------------
+  def test_databaseStore(self):
+    db = sa.create_engine('sqlite://')
+    store = state.DatabaseSessionStore(db, ttl=60)
+    self.assertIsNone(store.get('a'))
+    store.put('a', self.makeSession('peer-a'))
+    session = store.get('a')
+    session.msgID = 3
+    store.put('a', session)
+    # any other store (i.e. worker) on the same database can resume it
+    other = state.DatabaseSessionStore(db, ttl=60)
+    self.assertEqual(other.get('a').msgID, 3)
+    self.assertEqual(other.get('a').peerID, 'peer-a')
+    other.delete('a')
+    self.assertIsNone(store.get('a'))
+    # expired sessions are not returned, and purged on the next insert
+    store.ttl = -1
+    store.put('b', self.makeSession('peer-b'))
+    self.assertIsNone(store.get('b'))
+    store.ttl = 60
+    store.put('c', self.makeSession('peer-c'))
+    self.assertEqual(
+      [row.sid for row in db.execute(sa.select([store.table.c.sid]))], ['c'])
+
+  #----------------------------------------------------------------------------
+  def test_releaseSession(self):
+    fd, path = tempfile.mkstemp(prefix='pysyncml-')
+    os.close(fd)
+    session = self.makeSession('peer-a')
+    session.dsstates['srv_note'].recvObject = adict(path=path, size=10)
+    state.releaseSession(session)
+    self.assertFalse(os.path.exists(path))
+    self.assertIsNone(session.dsstates['srv_note'].recvObject)
+    # releasing is idempotent
+    session.dsstates['srv_note'].recvObject = adict(path=path, size=10)
+    state.releaseSession(session)
+
+  #----------------------------------------------------------------------------
+  def test_storeRelease(self):
+    # the sessions dropped by the stores are released
+    released = []
+    release  = lambda session: released.append(session.peerID)
+    store = state.MemorySessionStore(maxSize=1, ttl=60, release=release)
+    store.put('a', self.makeSession('peer-a'))
+    store.put('a', self.makeSession('peer-a'))
+    self.assertEqual(released, [])
+    store.put('b', self.makeSession('peer-b'))
+    self.assertEqual(released, ['peer-a'])
+    store.delete('b')
+    self.assertEqual(released, ['peer-a', 'peer-b'])
+    store.ttl = -1
+    store.put('c', self.makeSession('peer-c'))
+    self.assertEqual(released, ['peer-a', 'peer-b', 'peer-c'])
+    released = []
+    store = state.DatabaseSessionStore(sa.create_engine('sqlite://'), ttl=60, release=release)
+    store.put('a', self.makeSession('peer-a'))
+    store.delete('a')
+    store.delete('a')
+    self.assertEqual(released, ['peer-a'])
+    store.ttl = -1
+    store.put('b', self.makeSession('peer-b'))
+    self.assertEqual(released, ['peer-a'])
+    store.ttl = 60
+    store.put('c', self.makeSession('peer-c'))
+    self.assertEqual(released, ['peer-a', 'peer-b'])
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------